@@ -0,0 +1,230 @@
+import sys
+import os
+import argparse
+import glob
+import json
+import time
+import multiprocessing
+from lsys.parser import parse_sources
+from lsys.interpreter import LSystemSpecification
+from lsys.renderer import LSystemRecordingRenderer, renderer_class
+from lsys.spec_cache import SpecificationCache, source_hash
+from lsys.result_cache import ResultCache
+from common import read_file, parse_int_list, positive_int
+
+# State of a pool worker, set up by _init_worker: the specifications of all batch
+# sources and the hashes of the sources, keyed by file name, and a cache of expanded
+# generations. The specifications are passed as initializer arguments, so workers
+# get them with every start method (fork, spawn, forkserver)
+_specs: dict[str, LSystemSpecification] = None
+_source_hashes: dict[str, str] = None
+_result_cache: ResultCache = None
+
+
+def load_jobs(args) -> list[dict]:
+    """ Collects the jobs from the manifest file and/or the file patterns """
+    jobs = []
+    if args.manifest != None:
+        with open(args.manifest) as file:
+            manifest = json.load(file)
+        if type(manifest) == dict:
+            manifest = manifest["jobs"]
+        for entry in manifest:
+            jobs.append({
+                "file": entry["file"],
+                "seed": entry.get("seed"),
+                "iterations": entry.get("iterations"),
+                "out": entry.get("out"),
+            })
+
+    seeds = parse_int_list(args.seeds) if args.seeds != None else [None]
+    iterations = parse_int_list(args.iterations) if args.iterations != None else [None]
+    for pattern in args.patterns:
+        file_names = sorted(glob.glob(pattern, recursive=True))
+        if len(file_names) == 0:
+            print(f"Warning: pattern '{pattern}' does not match any file", file=sys.stderr)
+        for file_name in file_names:
+            for seed in seeds:
+                for iteration_count in iterations:
+                    jobs.append({"file": file_name, "seed": seed, "iterations": iteration_count, "out": None})
+
+    for job in jobs:
+        if job["out"] == None and args.out_dir != None:
+            stem = os.path.splitext(os.path.basename(job["file"]))[0]
+            seed = "" if job["seed"] == None else f"_s{job['seed']}"
+            iteration_count = "" if job["iterations"] == None else f"_i{job['iterations']}"
+            job["out"] = os.path.join(args.out_dir, f"{stem}{seed}{iteration_count}.svg")
+    return jobs
+
+
+def build_specs(file_names, spec_cache: SpecificationCache = None, processes: int = None) -> tuple[dict, dict, dict]:
+    """ Parses every source once, the sources missing from the cache with a process
+        pool. Returns the specifications and source hashes of the files parsed, and
+        the error message for each file that failed """
+    specs = {}
+    source_hashes = {}
+    errors = {}
+    sources = {}
+    for file_name in file_names:
+        try:
+            source = read_file(file_name)
+        except Exception as e:
+            errors[file_name] = f"{type(e).__name__}: {e}"
+            continue
+        source_hashes[file_name] = source_hash(source)
+        spec = spec_cache.get(source) if spec_cache != None else None
+        if spec != None:
+            specs[file_name] = spec
+        else:
+            sources[file_name] = source
+
+    roots = parse_sources(list(sources.values()), processes)
+    for (file_name, source), root in zip(sources.items(), roots):
+        try:
+            if isinstance(root, Exception):
+                raise root
+            specs[file_name] = LSystemSpecification.create(root)
+            if spec_cache != None:
+                spec_cache.put(source, specs[file_name])
+        except Exception as e:
+            errors[file_name] = f"{type(e).__name__}: {e}"
+    return specs, source_hashes, errors
+
+
+def _init_worker(specs: dict, source_hashes: dict, max_memory_mb: int, result_cache_mb: int):
+    global _specs, _source_hashes, _result_cache
+    _specs = specs
+    _source_hashes = source_hashes
+    _result_cache = ResultCache(result_cache_mb * 1024 * 1024)
+    if max_memory_mb != None:
+        import resource
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def run_job(job: dict) -> dict:
+    """ Expands and renders a single job inside a pool worker """
+    result = dict(job)
+    result["pid"] = os.getpid()
+    timings = {}
+    try:
+        start = time.perf_counter()
+        file_name = job["file"]
+        instance = _result_cache.expand(_specs[file_name], _source_hashes[file_name], job["seed"], job["iterations"])
+        timings["iterate"] = time.perf_counter() - start
+        result["iteration_count"] = instance._iteration_count
+        result["symbol_count"] = len(instance.l_string)
+
+        start = time.perf_counter()
+        if job["out"] != None:
+            renderer = renderer_class("svg")(job["out"])
+        else:
+            renderer = LSystemRecordingRenderer()
+        renderer.render(instance)
+        timings["render"] = time.perf_counter() - start
+
+        result["line_count"] = renderer._line_count
+        result["complexity_rating"] = renderer._complexity_rating
+    except MemoryError:
+        result["error"] = "MemoryError: worker memory limit exceeded"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["timings"] = timings
+    return result
+
+
+def run_job_group(jobs: list[dict]) -> list[dict]:
+    """ Runs a chunk of jobs of the same file and seed, in the shallowest first order
+        of group_jobs, so that deeper expansions resume from the generations cached by
+        the previous ones """
+    return [run_job(job) for job in jobs]
+
+
+def group_jobs(jobs: list[dict], chunk_size: int) -> list[list[dict]]:
+    """ Groups the jobs by file and seed, sorted shallowest first, and splits the
+        groups into chunks of at most chunk_size jobs, one pool task per chunk """
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job["file"], job["seed"]), []).append(job)
+    chunks = []
+    for group in groups.values():
+        group.sort(key=lambda job: job["iterations"] or 0)
+        chunks += [group[i:i + chunk_size] for i in range(0, len(group), chunk_size)]
+    return chunks
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Renders many L-system sources, seeds and iteration counts with a process pool")
+    arg_parser.add_argument("patterns", nargs="*", help="glob patterns of L-system source files")
+    arg_parser.add_argument("--manifest", help="JSON file with a list of jobs ({file, seed, iterations, out})")
+    arg_parser.add_argument("--seeds", help="seeds to render every matched file with, eg. '1,2,10-20'")
+    arg_parser.add_argument("--iterations", help="iteration counts to render every matched file with, eg. '3-6'")
+    arg_parser.add_argument("--out-dir", help="directory for the rendered SVG files (no files are written if omitted)")
+    arg_parser.add_argument("--summary", default="batch_summary.json", help="JSON summary file (default: batch_summary.json)")
+    arg_parser.add_argument("--spec-cache", metavar="DIR", default=None, help="directory for caching compiled specifications")
+    arg_parser.add_argument("--processes", type=int, default=None, help="pool size (default: number of CPUs)")
+    arg_parser.add_argument("--max-tasks-per-child", type=int, default=100,
+        help="jobs after which a worker is replaced, to bound its memory growth, "
+        "rounded down to whole chunks (default: 100)")
+    arg_parser.add_argument("--chunk-size", type=positive_int, default=4,
+        help="jobs of the same file and seed run as one pool task, so that they share cached generations "
+        "(default: 4, at most --max-tasks-per-child)")
+    arg_parser.add_argument("--max-memory", type=int, default=None, metavar="MB", help="address space limit per worker")
+    arg_parser.add_argument("--result-cache-size", type=int, default=64, metavar="MB",
+        help="size of the per-worker cache of expanded generations (default: 64)")
+    return arg_parser.parse_args(argv)
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    jobs = load_jobs(args)
+    if len(jobs) == 0:
+        print("No jobs to run.")
+        return 1
+    if args.out_dir != None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    total_start = time.perf_counter()
+    file_names = list(dict.fromkeys(job["file"] for job in jobs))
+    print(f"Parsing {len(file_names)} source file(s)...")
+    spec_cache = SpecificationCache(args.spec_cache) if args.spec_cache != None else None
+    specs, source_hashes, parse_errors = build_specs(file_names, spec_cache, args.processes)
+    for file_name, error in parse_errors.items():
+        print(f"  {file_name}: {error}", file=sys.stderr)
+
+    runnable = [job for job in jobs if job["file"] in specs]
+    # a worker runs whole chunks, so it is replaced after at most max_tasks_per_child jobs
+    chunk_size = max(1, min(args.chunk_size, args.max_tasks_per_child))
+    print(f"Running {len(runnable)} job(s)...")
+    results = []
+    with multiprocessing.Pool(
+        args.processes,
+        initializer=_init_worker,
+        initargs=(specs, source_hashes, args.max_memory, args.result_cache_size),
+        maxtasksperchild=max(1, args.max_tasks_per_child // chunk_size)
+    ) as pool:
+        for group_results in pool.imap(run_job_group, group_jobs(runnable, chunk_size)):
+            results += group_results
+            for result in group_results:
+                if "error" in result:
+                    print(f"  {result['file']} (seed {result['seed']}): {result['error']}", file=sys.stderr)
+
+    for job in jobs:
+        if job["file"] in parse_errors:
+            results.append(dict(job, error=parse_errors[job["file"]], timings={}))
+
+    failed = len([result for result in results if "error" in result])
+    summary = {
+        "total_time": time.perf_counter() - total_start,
+        "job_count": len(results),
+        "failed_count": failed,
+        "jobs": results,
+    }
+    with open(args.summary, "w") as file:
+        json.dump(summary, file, indent=2)
+    print(f"All done, {failed} of {len(results)} job(s) failed. Summary written to '{args.summary}'.")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
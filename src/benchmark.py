@@ -0,0 +1,369 @@
+import sys
+import os
+import argparse
+import gc
+import glob
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from lsys.tokenizer import Tokenizer, TokenType
+from lsys.parser import Parser, parse_sources
+from lsys.interpreter import LSystemSpecification
+from lsys.instance import LSystemInstance
+from lsys.renderer import LSystemRecordingRenderer, LSystemStreamingSVGRenderer
+from lsys.svg_renderer import LSystemSVGRenderer
+from common import read_file, parse_int_list, positive_int
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_DEFAULT_PATTERN = os.path.join(_ROOT, "test_files", "*.lsys")
+_MAIN = os.path.join(_ROOT, "src", "main.py")
+
+# Renderer backends, by name. Each returns the renderer after rendering an instance
+BACKENDS = {
+    "recording": lambda instance: _render(LSystemRecordingRenderer(), instance),
+    "svg": lambda instance: _render(LSystemSVGRenderer(), instance),
+    "svg-stream": lambda instance: _render_to_temp_file(LSystemStreamingSVGRenderer, instance),
+    "svg-merged": lambda instance: _render(_merging(LSystemSVGRenderer()), instance),
+}
+
+
+def _render(renderer, instance):
+    renderer.render(instance)
+    return renderer
+
+
+def _merging(renderer):
+    renderer.merge_segments = True
+    return renderer
+
+
+def _render_to_temp_file(renderer_class, instance):
+    fd, path = tempfile.mkstemp(suffix=".svg")
+    os.close(fd)
+    try:
+        return _render(renderer_class(path), instance)
+    finally:
+        os.remove(path)
+
+
+def tokenize(source: str) -> int:
+    """ Runs the tokenizer over a source, returning the number of tokens """
+    tokenizer = Tokenizer()
+    tokenizer.initialize(source)
+    count = 0
+    while True:
+        if tokenizer.get_next_token().token_type == TokenType.EOF:
+            return count
+        count += 1
+
+
+def synthetic_source(rules: int, seed: int = 1) -> str:
+    """ Source of a machine-generated looking grammar with the given number of
+        rules. Rule strings grow with the rule count, and every rule has a bias
+        expression with nested groups """
+    rng = random.Random(seed)
+    symbols = [f"S{i}" for i in range(max(1, rules // 4))]
+    lines = ["def v = random(1, 3);", "iterate 3;", "axiom " + " ".join(symbols[:8]) + ";"]
+    for i in range(rules):
+        elements = []
+        for _ in range(8 + rules // 100):
+            choice = rng.random()
+            if choice < 0.1:
+                elements.append("[ + " + rng.choice(symbols) + " ]")
+            elif choice < 0.2:
+                elements.append(rng.choice(["+", "-"]))
+            else:
+                elements.append(rng.choice(symbols))
+        bias = "v"
+        for _ in range(rng.randint(1, 6)):
+            bias = f"({bias} * {rng.randint(1, 9)} + depth / {rng.randint(1, 9)})"
+        lines.append(f"rule {rng.choice(symbols)} = {' '.join(elements)} bias {bias};")
+    return "\n".join(lines) + "\n"
+
+
+def bench_parser_scaling(sizes: list[int], repeat: int) -> dict:
+    """ Tokenizes and parses synthetic grammars of growing size. Linear scaling
+        shows as a constant time per kilobyte """
+    results = {}
+    for rules in sizes:
+        source = synthetic_source(rules)
+        stages = {
+            "tokenize": measure(lambda: tokenize(source), repeat),
+            "parse": measure(lambda: Parser().parse(source), repeat),
+        }
+        for stage in stages.values():
+            stage["time_per_kb"] = stage["time"] / (len(source) / 1024)
+        results[str(rules)] = {"characters": len(source), "stages": stages}
+    return results
+
+
+def print_parser_scaling(results: dict):
+    for rules, result in results.items():
+        line = f"{rules:>7} rules, {_format_bytes(result['characters']):>9}:"
+        for stage_name, stage in result["stages"].items():
+            line += f"  {stage_name} {_format_time(stage['time']):>9} ({_format_time(stage['time_per_kb'])}/KiB)"
+        print(line)
+
+
+def expand(spec: LSystemSpecification, seed: int, iterations: int) -> LSystemInstance:
+    instance = LSystemInstance(spec, seed=seed)
+    instance.iterate(iterations)
+    return instance
+
+
+def measure(func, repeat: int) -> dict:
+    """ Best wall time of a number of runs, and the peak of memory allocated by
+        Python during one more (traced, so slower) run """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.clear_traces()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time": best, "peak_memory": peak}
+
+
+def declared_iterations(spec: LSystemSpecification, seed: int) -> int:
+    instance = LSystemInstance(spec, seed=seed)
+    instance.begin()
+    return instance._max_iterations
+
+
+def bench_startup(file_name: str, repeat: int) -> dict:
+    """ Runs main.py on a source file without iterations or rendering, in fresh
+        interpreters. Stages are the startup imports of main.py, as reported by its
+        --import-profile, and the whole process. Peak memory is not measured """
+    imports = process = None
+    with tempfile.TemporaryDirectory() as directory:
+        profile_name = os.path.join(directory, "imports.json")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, _MAIN, file_name, "--iterations", "0", "--dry-run", "--import-profile", profile_name],
+                stdout=subprocess.DEVNULL, check=True)
+            elapsed = time.perf_counter() - start
+            with open(profile_name) as file:
+                profile = json.load(file)
+            imports = profile["import_time"] if imports == None else min(imports, profile["import_time"])
+            process = elapsed if process == None else min(process, elapsed)
+    return {
+        "modules": profile["modules"],
+        "third_party": profile["third_party"],
+        "stages": {
+            "imports": {"time": imports, "peak_memory": 0},
+            "process": {"time": process, "peak_memory": 0},
+        },
+    }
+
+
+def print_startup(startup: dict):
+    print(f"startup: {startup['modules']} modules, third party: {', '.join(startup['third_party']) or 'none'}")
+    for stage_name, stage in startup["stages"].items():
+        print(f"  {stage_name:<18} {_format_time(stage['time']):>9}")
+
+
+def bench_file(file_name: str, depth_offsets: list[int], backends: list[str], seed: int, repeat: int) -> dict:
+    """ Benchmarks all stages for one source file, at its declared iteration count
+        shifted by every depth offset. Returns results keyed by iteration count """
+    source = read_file(file_name)
+    results = {}
+
+    front_end = {
+        "tokenize": measure(lambda: tokenize(source), repeat),
+        "parse": measure(lambda: Parser().parse(source), repeat),
+    }
+    root = Parser().parse(source)
+    front_end["spec"] = measure(lambda: LSystemSpecification.create(root), repeat)
+    spec = LSystemSpecification.create(root)
+
+    declared = declared_iterations(spec, seed)
+    for iterations in sorted(set(max(0, declared + offset) for offset in depth_offsets)):
+        stages = dict(front_end)
+        stages["expand"] = measure(lambda: expand(spec, seed, iterations), repeat)
+        instance = expand(spec, seed, iterations)
+        symbols = len(instance.l_string)
+        stages["expand"]["throughput"] = symbols / max(stages["expand"]["time"], 1e-9)
+
+        segments = None
+        for backend in backends:
+            render = BACKENDS[backend]
+            # transforms may draw random numbers, every render starts from the same state
+            rng_state = instance.ctx.rng.getstate()
+            def run_backend():
+                instance.ctx.rng.setstate(rng_state)
+                return render(instance)
+            stage = measure(run_backend, repeat)
+            segments = run_backend()._line_count
+            stage["throughput"] = segments / max(stage["time"], 1e-9)
+            stages["render:" + backend] = stage
+
+        results[str(iterations)] = {"symbols": symbols, "segments": segments, "stages": stages}
+    return results
+
+
+def bench_file_isolated(file_name: str, depth_offsets: list[int], backends: list[str], seed: int, repeat: int) -> dict:
+    """ Runs bench_file() in a fresh interpreter, so caches and allocator state left by
+        other files don't change the results of a file """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(bench_file, file_name, depth_offsets, backends, seed, repeat).result()
+
+
+def compare(results: dict, baseline: dict, time_threshold: float, memory_threshold: float, min_time: float, min_memory: int) -> list[str]:
+    """ Returns a description of every stage that got slower or needs more memory
+        than the baseline allows. Differences below min_time and min_memory are
+        considered noise """
+    regressions = []
+    for file_name, depths in results.items():
+        for iterations, result in depths.items():
+            base = baseline.get(file_name, {}).get(iterations)
+            if base == None:
+                continue
+            regressions += compare_stages(f"{os.path.basename(file_name)} @{iterations}", result["stages"], base["stages"],
+                time_threshold, memory_threshold, min_time, min_memory)
+    return regressions
+
+
+def compare_stages(label: str, stages: dict, base_stages: dict, time_threshold: float, memory_threshold: float, min_time: float, min_memory: int) -> list[str]:
+    regressions = []
+    for stage_name, stage in stages.items():
+        base_stage = base_stages.get(stage_name)
+        if base_stage == None:
+            continue
+        stage_label = f"{label} {stage_name}"
+        if stage["time"] > base_stage["time"] * (1.0 + time_threshold) and stage["time"] - base_stage["time"] > min_time:
+            regressions.append(f"{stage_label}: time {_format_time(base_stage['time'])} -> {_format_time(stage['time'])}")
+        if stage["peak_memory"] > base_stage["peak_memory"] * (1.0 + memory_threshold) \
+                and stage["peak_memory"] - base_stage["peak_memory"] > min_memory:
+            regressions.append(f"{stage_label}: peak memory {_format_bytes(base_stage['peak_memory'])} -> {_format_bytes(stage['peak_memory'])}")
+    return regressions
+
+
+def _format_time(t: float) -> str:
+    if t < 1e-3:
+        return f"{t * 1e6:.0f}µs"
+    if t < 1.0:
+        return f"{t * 1e3:.1f}ms"
+    return f"{t:.2f}s"
+
+
+def _format_bytes(size: int) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f}KiB"
+    return f"{size / (1024 * 1024):.1f}MiB"
+
+
+def print_results(file_name: str, depths: dict):
+    for iterations, result in depths.items():
+        print(f"{os.path.basename(file_name)} @{iterations}: {result['symbols']} symbols, {result['segments']} segments")
+        for stage_name, stage in result["stages"].items():
+            line = f"  {stage_name:<18} {_format_time(stage['time']):>9} {_format_bytes(stage['peak_memory']):>10}"
+            if "throughput" in stage:
+                unit = "symbols/s" if stage_name == "expand" else "segments/s"
+                line += f" {stage['throughput']:>12.0f} {unit}"
+            print(line)
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the stages of the L-system pipeline over a corpus of source files")
+    arg_parser.add_argument("patterns", nargs="*", default=[_DEFAULT_PATTERN], help="glob patterns of L-system source files (default: test_files/*.lsys)")
+    arg_parser.add_argument("--depth-offsets", default="-2,-1,0",
+        help="iteration depths to benchmark, relative to the declared iteration count, eg. --depth-offsets=-3,0 (default: -2,-1,0)")
+    arg_parser.add_argument("--backends", default=",".join(BACKENDS), help=f"renderer backends (default: {','.join(BACKENDS)})")
+    arg_parser.add_argument("--seed", type=int, default=1, help="seed for the random number generator (default: 1)")
+    arg_parser.add_argument("--repeat", type=positive_int, default=3, help="runs per measurement, the best time is kept (default: 3)")
+    arg_parser.add_argument("--parser-scaling", default=None, metavar="RULES",
+        help="instead of the corpus, benchmark the parser on synthetic grammars with these rule counts, eg. 1000,10000,50000")
+    arg_parser.add_argument("--skip-startup", action="store_true",
+        help="don't benchmark the startup of main.py (imports and a dry run in a fresh interpreter)")
+    arg_parser.add_argument("--out", default=None, help="JSON file to write the results to")
+    arg_parser.add_argument("--baseline", default=None,
+        help="JSON results of an earlier run on the same machine to compare against, eg. one written by --out")
+    arg_parser.add_argument("--time-threshold", type=float, default=0.25,
+        help="allowed relative slowdown against the baseline (default: 0.25)")
+    arg_parser.add_argument("--memory-threshold", type=float, default=0.25,
+        help="allowed relative growth of peak memory against the baseline (default: 0.25)")
+    arg_parser.add_argument("--min-time", type=float, default=0.002,
+        help="slowdowns of less than this many seconds are ignored (default: 0.002)")
+    arg_parser.add_argument("--min-memory", type=int, default=64 * 1024, metavar="BYTES",
+        help="peak memory growth of less than this many bytes is ignored (default: 65536)")
+    return arg_parser.parse_args(argv)
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    backends = [backend for backend in args.backends.split(",") if backend != ""]
+    for backend in backends:
+        if backend not in BACKENDS:
+            print(f"Unknown backend '{backend}'", file=sys.stderr)
+            return 2
+
+    if args.parser_scaling != None:
+        results = bench_parser_scaling(parse_int_list(args.parser_scaling), args.repeat)
+        print_parser_scaling(results)
+        if args.out != None:
+            with open(args.out, "w") as file:
+                json.dump({"python": platform.python_version(), "parser_scaling": results}, file, indent=2)
+        return 0
+
+    file_names = []
+    for pattern in args.patterns:
+        file_names += sorted(glob.glob(pattern, recursive=True))
+    if len(file_names) == 0:
+        print("No source files to benchmark.", file=sys.stderr)
+        return 2
+
+    depth_offsets = parse_int_list(args.depth_offsets)
+    startup = None
+    if not args.skip_startup:
+        startup = bench_startup(file_names[0], args.repeat)
+        print_startup(startup)
+
+    results = {}
+    for file_name in file_names:
+        # relative to the repository, so baselines don't depend on the working directory
+        key = os.path.relpath(os.path.abspath(file_name), _ROOT)
+        results[key] = bench_file_isolated(file_name, depth_offsets, backends, args.seed, args.repeat)
+        print_results(file_name, results[key])
+
+    if args.out != None:
+        with open(args.out, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "seed": args.seed,
+                "startup": startup,
+                "results": results,
+            }, file, indent=2)
+
+    if args.baseline != None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("seed") != args.seed:
+            print(f"Warning: baseline was recorded with seed {baseline.get('seed')}", file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.time_threshold, args.memory_threshold, args.min_time, args.min_memory)
+        if startup != None and baseline.get("startup") != None:
+            regressions += compare_stages("startup", startup["stages"], baseline["startup"]["stages"],
+                args.time_threshold, args.memory_threshold, args.min_time, args.min_memory)
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} regression(s) against '{args.baseline}':")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print(f"\nNo regressions against '{args.baseline}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
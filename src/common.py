@@ -0,0 +1,33 @@
+# Helpers shared by the command line tools (main.py, batch.py, benchmark.py)
+import argparse
+
+
+def read_file(file_name):
+    file_string = ""
+    with open(file_name) as file:
+        for line in file.readlines():
+            file_string += line
+    return file_string
+
+
+def parse_int_list(string: str) -> list[int]:
+    """ Parses comma separated integers and integer ranges, eg. '1,2,5-8' """
+    values = []
+    for part in string.split(","):
+        if "-" in part[1:]:
+            first, last = part.split("-", 1)
+            values += list(range(int(first), int(last) + 1))
+        else:
+            values.append(int(part))
+    return values
+
+
+def positive_int(string: str) -> int:
+    """ Argument type for counts which must be at least 1 """
+    try:
+        value = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{string}'")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
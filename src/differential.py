@@ -0,0 +1,421 @@
+import sys
+import os
+import argparse
+import random
+import time
+from lsys.parser import Parser
+from lsys.interpreter import LSystemSpecification
+from lsys.instance import LSystemInstance
+from lsys.renderer import LSystemRecordingRenderer, OP_LINE
+from lsys.hashcons import HashConsedInstance, render_shared
+from lsys.parallel import render_parallel
+from lsys.pipeline import LSystemPipeline
+from lsys.codegen import compile_specification
+from lsys.seed_batch import LSystemSeedBatch
+
+
+######################
+# Grammar generation #
+######################
+
+_SYMBOLS = ["A", "B", "C", "F", "G", "X", "Y", "Z"]
+_TRANSFORM_NAMES = ["+", "-", "L", "R", "M", "T"]
+
+
+class GrammarGenerator:
+    """ Generates random, valid L-system sources covering brackets, fills,
+        stochastic rule sets and expressions over variables, depth and random() """
+
+    def __init__(self, rng: random.Random):
+        self._rng = rng
+        self._vars: list[str] = []
+        self._random_allowed = True
+
+
+    def source(self) -> str:
+        rng = self._rng
+        self._vars = []
+        # grammars without random() in expressions can take the shared geometry
+        # and lattice paths of the optimized engines
+        self._random_allowed = rng.random() < 0.5
+        lines = []
+
+        for i in range(rng.randint(0, 3)):
+            name = f"v{i}"
+            lines.append(f"def {name} = {self.expr(2, allow_depth=False)};")
+            self._vars.append(name)
+
+        if rng.random() < 0.5:
+            lines.append(f"length {self.positive_expr(allow_random=True)};")
+        if rng.random() < 0.5:
+            lines.append(f"width {self.positive_expr(allow_random=True)};")
+        if rng.random() < 0.5:
+            lines.append(f"color {self.color()};")
+
+        transforms = rng.sample(_TRANSFORM_NAMES, rng.randint(1, len(_TRANSFORM_NAMES)))
+        for name in transforms:
+            lines.append(self.transform(name))
+
+        symbols = rng.sample(_SYMBOLS, rng.randint(1, 4))
+        alphabet = symbols + transforms
+        lines.append(f"axiom {self.rule_string(alphabet, rng.randint(1, 4))};")
+        lines.append(f"iterate {rng.randint(1, 4)};")
+
+        for symbol in symbols:
+            rule_count = rng.choice([0, 1, 1, 1, 2, 3])
+            for _ in range(rule_count):
+                line = f"rule {symbol} = {self.rule_string(alphabet, rng.randint(1, 6))}"
+                if rule_count > 1:
+                    line += f" bias {self.bias()}"
+                lines.append(line + ";")
+
+        return "\n".join(lines) + "\n"
+
+
+    def transform(self, name: str) -> str:
+        rng = self._rng
+        kind = rng.random()
+        if kind < 0.45:
+            if rng.random() < 0.6:
+                angle = str(rng.choice([15, 30, 45, 60, 90, 120, 22.5, 25.7]))
+            else:
+                angle = self.expr(2)
+            return f"transform {name} rotate {angle} {rng.choice(['deg', 'deg', 'rad'])};"
+
+        if kind < 0.9:
+            line = f"transform {name} translate {self.positive_expr(allow_random=True)}"
+        else:
+            line = f"transform {name} translate {self.expr(1)}, {self.expr(1)}"
+        if rng.random() < 0.4:
+            line += f" width {self.positive_expr(allow_random=True)}"
+        if rng.random() < 0.3:
+            line += f" color {self.color()}"
+        return line + ";"
+
+
+    def rule_string(self, alphabet: list[str], length: int) -> str:
+        """ Random sequence of symbols with properly nested brackets and fills """
+        rng = self._rng
+        elements = []
+        open_brackets = 0
+        fill_open = False
+        for _ in range(length):
+            choice = rng.random()
+            if choice < 0.12:
+                elements.append("[")
+                open_brackets += 1
+            elif choice < 0.22 and open_brackets > 0:
+                elements.append("]")
+                open_brackets -= 1
+            elif choice < 0.26 and not fill_open and open_brackets == 0:
+                elements.append("{")
+                fill_open = True
+            elif choice < 0.30 and fill_open and open_brackets == 0:
+                elements.append("}")
+                fill_open = False
+            else:
+                elements.append(rng.choice(alphabet))
+        elements += ["]"] * open_brackets
+        if fill_open:
+            elements.append("}")
+        return " ".join(elements)
+
+
+    def bias(self) -> str:
+        # biases are evaluated twice per selection, so they must not draw random numbers
+        rng = self._rng
+        if rng.random() < 0.5:
+            return str(rng.randint(1, 5))
+        return f"max(0.5, {rng.randint(0, 3)} + depth * {rng.choice([-1, 0.5, 1, 2])})"
+
+
+    def color(self) -> str:
+        return ", ".join(self.positive_expr(allow_random=True, scale=255) for _ in range(3))
+
+
+    def positive_expr(self, allow_random: bool = False, scale: float = 2.0) -> str:
+        rng = self._rng
+        choice = rng.random()
+        if allow_random and self._random_allowed and choice < 0.3:
+            return f"random({round(scale * 0.1, 2)}, {round(scale, 2)})"
+        if choice < 0.5 and len(self._vars) > 0:
+            return f"max(0.1, {rng.choice(self._vars)})"
+        return str(round(rng.uniform(0.1, scale), 2))
+
+
+    def expr(self, depth: int, allow_depth: bool = True) -> str:
+        rng = self._rng
+        choice = rng.random()
+        if depth <= 0 or choice < 0.3:
+            leaves = [str(round(rng.uniform(0, 10), 2))]
+            leaves += self._vars
+            if allow_depth:
+                leaves.append("depth")
+            return rng.choice(leaves)
+        if choice < 0.45 and self._random_allowed:
+            return f"random({rng.randint(-20, 0)}, {rng.randint(1, 20)})"
+        if choice < 0.55:
+            return f"{rng.choice(['min', 'max'])}({self.expr(depth - 1, allow_depth)}, {self.expr(depth - 1, allow_depth)})"
+        if choice < 0.65:
+            return f"({self.expr(depth - 1, allow_depth)})"
+        if choice < 0.7:
+            return f"-{self.expr(depth - 1, allow_depth)}"
+        if choice < 0.8:
+            # only divide by non-zero constants
+            return f"{self.expr(depth - 1, allow_depth)} / {rng.randint(1, 9)}"
+        op = rng.choice(["+", "-", "*"])
+        return f"{self.expr(depth - 1, allow_depth)} {op} {self.expr(depth - 1, allow_depth)}"
+
+
+###########
+# Engines #
+###########
+
+class EngineSkipped(Exception):
+    pass
+
+
+def _record(renderer_func) -> LSystemRecordingRenderer:
+    recorder = LSystemRecordingRenderer()
+    renderer_func(recorder)
+    return recorder
+
+
+def _result(l_string, recorder: LSystemRecordingRenderer, expand_time: float, render_time: float) -> dict:
+    return {
+        "symbols": [id(node) for node in l_string] if l_string != None else None,
+        "ops": recorder.ops,
+        "line_count": recorder._line_count,
+        "complexity_rating": recorder._complexity_rating,
+        "expand_time": expand_time,
+        "render_time": render_time,
+    }
+
+
+def _expand(instance: LSystemInstance, iterations: int) -> tuple[LSystemInstance, float]:
+    start = time.perf_counter()
+    instance.iterate(iterations)
+    return instance, time.perf_counter() - start
+
+
+def engine_reference(spec, seed, iterations) -> dict:
+    instance, expand_time = _expand(LSystemInstance(spec, seed=seed), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: recorder.render(instance))
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_lattice(spec, seed, iterations) -> dict:
+    instance, expand_time = _expand(LSystemInstance(spec, seed=seed), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: recorder.render(instance, lattice=True))
+    if not recorder.lattice_active:
+        raise EngineSkipped("grammar not eligible")
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_hashcons(spec, seed, iterations) -> dict:
+    instance, expand_time = _expand(HashConsedInstance(spec, seed=seed), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: render_shared(recorder, instance))
+    render_time = time.perf_counter() - start
+    return _result(instance.l_string, recorder, expand_time, render_time)
+
+
+def engine_spill(spec, seed, iterations) -> dict:
+    instance, expand_time = _expand(LSystemInstance(spec, seed=seed, spill_threshold=0), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: recorder.render(instance))
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_parallel(spec, seed, iterations) -> dict:
+    # grammars with random transforms are rendered in this process (see render_parallel)
+    instance, expand_time = _expand(LSystemInstance(spec, seed=seed), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: render_parallel(recorder, instance, processes=2))
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_pipeline(spec, seed, iterations) -> dict:
+    instance = LSystemInstance(spec, seed=seed)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: LSystemPipeline(chunk_size=64, queue_size=2).run(instance, recorder, iterations))
+    # the last generation is streamed, not stored
+    return _result(None, recorder, 0.0, time.perf_counter() - start)
+
+
+def engine_compiled(spec, seed, iterations) -> dict:
+    instance = LSystemInstance(spec, seed=seed)
+    instance.compiled = compile_specification(spec)
+    instance, expand_time = _expand(instance, iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: recorder.render(instance))
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_indexed(spec, seed, iterations) -> dict:
+    instance, expand_time = _expand(LSystemInstance(spec, seed=seed, index_brackets=True), iterations)
+    start = time.perf_counter()
+    recorder = _record(lambda recorder: render_parallel(recorder, instance, processes=2))
+    return _result(instance.l_string, recorder, expand_time, time.perf_counter() - start)
+
+
+def engine_seed_batch(spec, seed, iterations) -> dict:
+    # neighbouring seeds share generations with the checked one as long as they agree
+    batch = LSystemSeedBatch(spec, [seed, seed + 1, seed + 2])
+    start = time.perf_counter()
+    batch.iterate(iterations)
+    expand_time = time.perf_counter() - start
+    start = time.perf_counter()
+    recorders = {}
+    batch.render(lambda batch_seed: recorders.setdefault(batch_seed, LSystemRecordingRenderer()))
+    return _result(batch.instances[0].l_string, recorders[seed], expand_time, time.perf_counter() - start)
+
+
+# Alternative engines compared against engine_reference, by name
+ENGINES = {
+    "lattice": engine_lattice,
+    "hashcons": engine_hashcons,
+    "spill": engine_spill,
+    "parallel": engine_parallel,
+    "pipeline": engine_pipeline,
+    "compiled": engine_compiled,
+    "indexed": engine_indexed,
+    "seed_batch": engine_seed_batch,
+}
+
+
+##############
+# Comparison #
+##############
+
+def _close(a: float, b: float, tolerance: float) -> bool:
+    return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+
+def compare_results(reference: dict, result: dict, tolerance: float) -> str:
+    """ Returns a description of the first difference, or None """
+    if result["symbols"] != None and result["symbols"] != reference["symbols"]:
+        for i, (a, b) in enumerate(zip(reference["symbols"], result["symbols"])):
+            if a != b:
+                return f"symbol streams differ at index {i}"
+        return f"symbol streams differ in length ({len(reference['symbols'])} vs {len(result['symbols'])})"
+    if len(result["ops"]) != len(reference["ops"]):
+        return f"segment arrays differ in length ({len(reference['ops'])} vs {len(result['ops'])})"
+    for i, (a, b) in enumerate(zip(reference["ops"], result["ops"])):
+        if a[0] != b[0]:
+            return f"operation {i} differs: {a} vs {b}"
+        if a[0] == OP_LINE:
+            values_a = a[1:6] + tuple(a[6])
+            values_b = b[1:6] + tuple(b[6])
+            if not all(_close(x, y, tolerance) for x, y in zip(values_a, values_b)):
+                return f"segment {i} differs: {a} vs {b}"
+    for key in ("line_count", "complexity_rating"):
+        if result[key] != reference[key]:
+            return f"{key} differs ({reference[key]} vs {result[key]})"
+    return None
+
+
+def check_source(source: str, engines: dict, seeds: list[int], iterations: int, tolerance: float) -> list[dict]:
+    """ Runs a source through the reference and all engines with every seed """
+    spec = LSystemSpecification.create(Parser().parse(source))
+    outcomes = []
+    for seed in seeds:
+        try:
+            reference = engine_reference(spec, seed, iterations)
+        except Exception as e:
+            outcomes += [{"engine": name, "seed": seed, "status": f"skipped (reference failed: {type(e).__name__})"} for name in engines]
+            continue
+        for name, engine in engines.items():
+            outcome = {"engine": name, "seed": seed, "reference_time": reference["expand_time"] + reference["render_time"]}
+            try:
+                result = engine(spec, seed, iterations)
+            except EngineSkipped as e:
+                outcome["status"] = f"skipped ({e})"
+            except Exception as e:
+                outcome["status"] = "error"
+                outcome["detail"] = f"{type(e).__name__}: {e}"
+            else:
+                outcome["time"] = result["expand_time"] + result["render_time"]
+                difference = compare_results(reference, result, tolerance)
+                outcome["status"] = "ok" if difference == None else "mismatch"
+                if difference != None:
+                    outcome["detail"] = difference
+            outcomes.append(outcome)
+    return outcomes
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Compares optimized expansion and rendering engines against the reference implementation on random grammars")
+    arg_parser.add_argument("files", nargs="*", help="L-system source files to check in addition to the generated ones")
+    arg_parser.add_argument("--count", type=int, default=50, help="number of random grammars (default: 50)")
+    arg_parser.add_argument("--generator-seed", type=int, default=0, help="seed of the grammar generator (default: 0)")
+    arg_parser.add_argument("--seeds", default="1,2", help="seeds every grammar is expanded with (default: 1,2)")
+    arg_parser.add_argument("--iterations", type=int, default=None, help="overrides the iteration count of all grammars")
+    arg_parser.add_argument("--engines", default=",".join(ENGINES), help=f"engines to compare (default: {','.join(ENGINES)})")
+    arg_parser.add_argument("--tolerance", type=float, default=1e-6, help="relative tolerance for coordinates, widths and colors (default: 1e-6)")
+    arg_parser.add_argument("--max-symbols", type=int, default=200000,
+        help="generated grammars whose reference expansion exceeds this are replaced (default: 200000)")
+    arg_parser.add_argument("--failures", metavar="DIR", default=None, help="directory to save sources with mismatches to")
+    return arg_parser.parse_args(argv)
+
+
+def _generate_sources(args) -> list[tuple[str, str]]:
+    generator = GrammarGenerator(random.Random(args.generator_seed))
+    sources = []
+    while len(sources) < args.count:
+        source = generator.source()
+        instance = LSystemInstance(LSystemSpecification.create(Parser().parse(source)), seed=0)
+        instance.iterate(args.iterations)
+        if len(instance.l_string) <= args.max_symbols:
+            sources.append((f"generated-{len(sources)}", source))
+    return sources
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    engines = {}
+    for name in args.engines.split(","):
+        if name not in ENGINES:
+            print(f"Unknown engine '{name}'", file=sys.stderr)
+            return 2
+        engines[name] = ENGINES[name]
+    seeds = [int(seed) for seed in args.seeds.split(",")]
+
+    sources = _generate_sources(args)
+    for file_name in args.files:
+        with open(file_name) as file:
+            sources.append((file_name, file.read()))
+
+    totals = {name: {"ok": 0, "mismatch": 0, "error": 0, "skipped": 0, "time": 0.0, "reference_time": 0.0} for name in engines}
+    failed = 0
+    for label, source in sources:
+        outcomes = check_source(source, engines, seeds, args.iterations, args.tolerance)
+        problems = [outcome for outcome in outcomes if outcome["status"] in ("mismatch", "error")]
+        for outcome in outcomes:
+            total = totals[outcome["engine"]]
+            total[outcome["status"].split(" ")[0]] += 1
+            if "time" in outcome:
+                total["time"] += outcome["time"]
+                total["reference_time"] += outcome["reference_time"]
+        if len(problems) > 0:
+            failed += 1
+            print(f"{label}:")
+            for outcome in problems:
+                print(f"  {outcome['engine']} (seed {outcome['seed']}): {outcome['status']}, {outcome['detail']}")
+            if args.failures != None:
+                os.makedirs(args.failures, exist_ok=True)
+                with open(os.path.join(args.failures, os.path.basename(label) + ".lsys"), "w") as file:
+                    file.write(source)
+
+    print(f"\n{len(sources)} grammar(s), seeds {args.seeds}")
+    print(f"{'engine':<10} {'ok':>5} {'mismatch':>9} {'error':>6} {'skipped':>8} {'time':>9} {'reference':>10}")
+    for name, total in totals.items():
+        print(f"{name:<10} {total['ok']:>5} {total['mismatch']:>9} {total['error']:>6} {total['skipped']:>8} "
+            f"{total['time']:>8.3f}s {total['reference_time']:>9.3f}s")
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))
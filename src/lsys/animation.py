@@ -0,0 +1,138 @@
+from .instance import LSystemInstance
+from .renderer import LSystemRecordingRenderer, svg_bounds, OP_LINE
+from .svg_renderer import LSystemSVGRenderer
+from dataclasses import dataclass
+import math
+import pickle
+import tempfile
+
+
+@dataclass
+class _RecordedGeneration:
+    iteration_count: int
+    ops: list[tuple]
+    line_count: int
+    complexity_rating: int
+
+
+class LSystemAnimator:
+    """ Renders the growth of an instance into a sequence of SVG frames.
+
+        Every generation is derived from the previous one and walked by the turtle.
+        With frames_per_generation > 1, the frames in between morph the drawing of the
+        previous generation into the next one: the segments of the next generation are
+        spread evenly along the path of the previous one in turtle order, and move
+        from there to their place. All frames share the same bounds: either the given
+        ones, which allows writing every frame as soon as its generation is expanded,
+        or the union of all generations. Then the recorded generations are spooled to
+        a temporary file, and the frames are written from it once all generations are
+        walked. Either way, every generation is expanded and walked once, and only the
+        ops of two generations are held in memory at a time.
+
+        Expressions calling random() while rendering draw from a copy of the random
+        state, so the expansion (and the last frame) match a plain render with the
+        same seed. """
+
+    def __init__(self, file_pattern: str, frames_per_generation: int = 1, bounds: list[float] = None):
+        self._file_pattern = file_pattern
+        self._frames_per_generation = max(1, frames_per_generation)
+        self._bounds = bounds
+        self._frame = 0
+        self.file_names: list[str] = []
+
+
+    def render(self, instance: LSystemInstance, iterations: int = None) -> list[str]:
+        """ Expands the instance from the axiom, writing the frames of every generation.
+            Returns the names of the written files """
+        self._frame = 0
+        self.file_names = []
+        if self._bounds != None:
+            previous = None
+            for generation in self._generations(instance, iterations):
+                self._write_generation(instance, previous, generation, self._bounds)
+                previous = generation
+            return self.file_names
+
+        bounds = None
+        generation_count = 0
+        with tempfile.TemporaryFile() as spool:
+            for generation in self._generations(instance, iterations):
+                bounds = svg_bounds(generation.ops, bounds)
+                pickle.dump(generation, spool, pickle.HIGHEST_PROTOCOL)
+                generation_count += 1
+            spool.seek(0)
+            previous = None
+            for _ in range(generation_count):
+                generation = pickle.load(spool)
+                self._write_generation(instance, previous, generation, bounds)
+                previous = generation
+        return self.file_names
+
+
+    def _generations(self, instance: LSystemInstance, iterations: int):
+        """ Expands the instance from the axiom, recording every generation """
+        instance.reset()
+        instance.begin(iterations)
+        yield self._record(instance)
+        while instance._iteration_count < instance._max_iterations and instance.advance(1) > 0:
+            yield self._record(instance)
+
+
+    def _record(self, instance: LSystemInstance) -> _RecordedGeneration:
+        rng_state = instance.ctx.rng.getstate()
+        recorder = LSystemRecordingRenderer()
+        recorder.render(instance)
+        instance.ctx.rng.setstate(rng_state)
+        return _RecordedGeneration(instance._iteration_count, recorder.ops, recorder._line_count, recorder._complexity_rating)
+
+
+    def _write_generation(self, instance: LSystemInstance, previous: _RecordedGeneration, generation: _RecordedGeneration, bounds: list[float]):
+        frame_count = 1 if previous == None else self._frames_per_generation
+        for frame in range(1, frame_count):
+            self._write_frame(instance, generation, _interpolate(previous.ops, generation.ops, frame / frame_count), bounds)
+        self._write_frame(instance, generation, generation.ops, bounds)
+
+
+    def _write_frame(self, instance: LSystemInstance, generation: _RecordedGeneration, ops: list[tuple], bounds: list[float]):
+        file_name = self._file_pattern.format(frame=self._frame, generation=generation.iteration_count)
+        renderer = LSystemSVGRenderer(file_name, bounds=bounds)
+        renderer._begin(instance)
+        renderer._replay(ops)
+        renderer._line_count = generation.line_count
+        renderer._complexity_rating = generation.complexity_rating
+        renderer._finalize()
+        self.file_names.append(file_name)
+        self._frame += 1
+
+
+def _interpolate(previous_ops: list[tuple], ops: list[tuple], t: float) -> list[tuple]:
+    """ Ops with the lines moved the part t of the way from the path of the previous
+        generation to their place. Line j of m starts at j / m of the way along the n
+        previous lines (counting lines, not their lengths) and ends at (j + 1) / m. Without
+        previous lines, every line grows from its start """
+    path = [op for op in previous_ops if op[0] == OP_LINE]
+    line_count = sum(1 for op in ops if op[0] == OP_LINE)
+
+    def path_point(position: float, x: float, y: float) -> tuple[float, float]:
+        if len(path) == 0:
+            return x, y
+        index = min(math.floor(position), len(path) - 1)
+        _, x1, y1, x2, y2, _, _ = path[index]
+        fraction = position - index
+        return x1 + (x2 - x1) * fraction, y1 + (y2 - y1) * fraction
+
+    interpolated = []
+    line = 0
+    for op in ops:
+        if op[0] != OP_LINE:
+            interpolated.append(op)
+            continue
+        _, x1, y1, x2, y2, width, color = op
+        start_x, start_y = path_point(line * len(path) / line_count, x1, y1)
+        end_x, end_y = path_point((line + 1) * len(path) / line_count, x1, y1)
+        interpolated.append((OP_LINE,
+            start_x + (x1 - start_x) * t, start_y + (y1 - start_y) * t,
+            end_x + (x2 - end_x) * t, end_y + (y2 - end_y) * t,
+            width, color))
+        line += 1
+    return interpolated
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from .runtime_context import TurtleState, EvalContext
 import math
 
@@ -8,6 +8,18 @@ def _zerorize(value: float) -> float:
     return 0.0 if abs(value) < 1e-10 else value
 
 
+def walk(node):
+    """ Yields the node and all nodes below it (depth first) """
+    stack = [node]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack += reversed(node)
+        elif isinstance(node, ASTNode):
+            yield node
+            stack += reversed([getattr(node, f.name) for f in fields(node)])
+
+
 @dataclass
 class ASTNode:
     pass
@@ -125,7 +137,7 @@ class VarDeclarationNode(DeclarationNode):
 class RuleDeclarationNode(DeclarationNode):
     rule_name: IdentifierNode
     rule_elements: list[ASTNode]
-    rule_bias: EvalNode = field(default=NumNode(1.0), init=False)
+    rule_bias: EvalNode = field(default_factory=lambda: NumNode(1.0), init=False)
 
 
 @dataclass
@@ -0,0 +1,139 @@
+from .ast_nodes import *
+from array import array
+
+
+class BracketIndex:
+    """ Index of the brackets of an L-string. For every position it stores:
+            match: position of the matching bracket for '[' and ']', -1 for all other
+                symbols and for unmatched brackets
+            depth: number of '[' enclosing the symbol, which is the turtle depth it
+                is walked at ('[' and ']' count as outside of their branch)
+
+        Skipping a branch, or finding the branches in a range, is a lookup instead of
+        a scan for the matching bracket. LSystemInstance keeps the index of its
+        generations up to date with index_brackets set, deriving it from the index of
+        the previous generation (see derive()) """
+
+    def __init__(self, match: array, depth: array, unmatched: int = 0):
+        self.match = match
+        self.depth = depth
+        # number of brackets without a match
+        self.unmatched = unmatched
+
+
+    @classmethod
+    def build(cls, l_string: list[ASTNode]) -> "BracketIndex":
+        """ Indexes an L-string by scanning it """
+        match = array("q", bytes(8 * len(l_string)))
+        depth = array("i", bytes(4 * len(l_string)))
+        stack = []
+        unmatched = 0
+        for i, node in enumerate(l_string):
+            match[i] = -1
+            if type(node) == PushNode:
+                depth[i] = len(stack)
+                stack.append(i)
+            elif type(node) == PopNode:
+                if len(stack) > 0:
+                    start = stack.pop()
+                    match[start] = i
+                    match[i] = start
+                else:
+                    unmatched += 1
+                depth[i] = len(stack)
+            else:
+                depth[i] = len(stack)
+        return cls(match, depth, unmatched + len(stack))
+
+
+    def __len__(self) -> int:
+        return len(self.match)
+
+
+    def skip(self, position: int) -> int:
+        """ Position after the branch opened at position, or after the symbol if it
+            doesn't open a branch """
+        end = self.match[position]
+        return end + 1 if end > position else position + 1
+
+
+    def subtree(self, position: int) -> tuple[int, int]:
+        """ Range of the branch a '[' or ']' belongs to, including both brackets """
+        other = self.match[position]
+        if other == -1:
+            raise Exception(f"No matching bracket for position {position}")
+        return (min(position, other), max(position, other))
+
+
+    def branches(self, start: int = 0, stop: int = None) -> list[tuple[int, int]]:
+        """ Ranges ('[' to ']') of the outermost branches between start and stop,
+            visiting only the symbols outside of them """
+        stop = len(self.match) if stop == None else stop
+        match = self.match
+        branches = []
+        i = start
+        while i < stop:
+            end = match[i]
+            if end > i and end < stop:
+                branches.append((i, end))
+                i = end + 1
+            else:
+                i += 1
+        return branches
+
+
+    def branches_from_depth(self, depth: int) -> list[tuple[int, int]]:
+        """ Ranges of the branches opened at the given depth or deeper which are not
+            nested in another one of them, in order. Only the symbols outside of these
+            branches are visited """
+        result = []
+        pending = self.branches()
+        pending.reverse()
+        while len(pending) > 0:
+            start, stop = pending.pop()
+            if self.depth[start] >= depth:
+                result.append((start, stop))
+            else:
+                inner = self.branches(start + 1, stop)
+                inner.reverse()
+                pending += inner
+        return result
+
+
+    def derive(self, l_string: list[ASTNode], expansions: list) -> "BracketIndex":
+        """ Index of the next generation, given this index of the current one and for
+            every position the rule elements it was replaced by (None if the symbol
+            was kept), with their index as a pair. The positions of kept brackets are
+            moved and the indices of the rule elements are pasted in at the depth of
+            the replaced symbol. If a rule has unmatched brackets, the new L-string is
+            scanned instead """
+        starts = array("q", bytes(8 * (len(expansions) + 1)))
+        position = 0
+        for i, expansion in enumerate(expansions):
+            starts[i] = position
+            if expansion == None:
+                position += 1
+            else:
+                elements, elements_index = expansion
+                if elements_index.unmatched != 0:
+                    return BracketIndex.build(l_string)
+                position += len(elements)
+        starts[len(expansions)] = position
+
+        old_match = self.match
+        old_depth = self.depth
+        match = array("q")
+        depth = array("i")
+        for i, expansion in enumerate(expansions):
+            if expansion == None:
+                other = old_match[i]
+                match.append(starts[other] if other != -1 else -1)
+                depth.append(old_depth[i])
+            else:
+                start = starts[i]
+                base = old_depth[i]
+                elements_index = expansion[1]
+                match.extend([other + start if other != -1 else -1 for other in elements_index.match])
+                depth.extend([d + base for d in elements_index.depth])
+        return BracketIndex(match, depth, self.unmatched)
+
@@ -0,0 +1,455 @@
+from .ast_nodes import *
+from .runtime_context import *
+from .runtime_context import _ctx_random, _ctx_min, _ctx_max
+from .interpreter import LSystemSpecification
+from .parser import PARSER_VERSION
+from .spec_cache import source_hash
+import hashlib
+import importlib.util
+import os
+import tempfile
+import weakref
+
+
+# Part of the cache key, to be increased whenever the generated code changes
+CODEGEN_VERSION = 1
+
+# Per-user, as the cached modules are executed when loaded
+_DEFAULT_CACHE_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "lsys", "codegen")
+
+# Loaded modules by file path, so every module is only executed once per process
+_loaded_modules: dict = {}
+
+
+class _ExpressionCompiler:
+    """ Translates expression nodes into Python expressions over the local names of
+        the generated code. Name lookup follows the evaluation context of the
+        reference implementation: the state variables set by the instance or the
+        renderer hide the declared variables, which hide the constants pi and e """
+
+    def __init__(self, var_indices: dict[str, int], state_vars: dict[str, str], var_function: str, var_args: str):
+        self._var_indices = var_indices
+        self._state_vars = state_vars
+        self._var_function = var_function
+        self._var_args = var_args
+
+
+    def compile(self, node: EvalNode) -> str:
+        if type(node) == NumNode:
+            return repr(node.value)
+        elif type(node) == IdentifierNode:
+            if node.ident in self._state_vars:
+                return self._state_vars[node.ident]
+            if node.ident in self._var_indices:
+                return f"{self._var_function}{self._var_indices[node.ident]}({self._var_args})"
+            if node.ident == "pi":
+                return repr(math.pi)
+            if node.ident == "e":
+                return repr(math.e)
+            return f"missing({node.ident!r})"
+        elif type(node) == FunctionNode:
+            params = ", ".join(self.compile(param) for param in node.param_list)
+            if node.name.ident == "random":
+                return f"random_([{params}])"
+            elif node.name.ident == "min":
+                return f"min_([{params}])"
+            elif node.name.ident == "max":
+                return f"max_([{params}])"
+            return f"no_function({str(node.name)!r})"
+        elif type(node) == GroupNode:
+            return f"({self.compile(node.content)})"
+        elif type(node) == AddOpNode:
+            return f"({self.compile(node.left_node)} + {self.compile(node.right_node)})"
+        elif type(node) == SubOpNode:
+            return f"({self.compile(node.left_node)} - {self.compile(node.right_node)})"
+        elif type(node) == MulOpNode:
+            return f"({self.compile(node.left_node)} * {self.compile(node.right_node)})"
+        elif type(node) == DivOpNode:
+            return f"({self.compile(node.left_node)} / {self.compile(node.right_node)})"
+        elif type(node) == NegOpNode:
+            return f"({self.compile(node.node)} * (-1))"
+        raise Exception(f"Code generation for '{type(node).__name__}' is not supported")
+
+
+class _CodeWriter:
+
+    def __init__(self):
+        self.lines: list[str] = []
+        self._indent = 0
+
+
+    def line(self, text: str = ""):
+        self.lines.append("    " * self._indent + text if text != "" else "")
+
+
+    def indent(self):
+        self._indent += 1
+
+
+    def dedent(self):
+        self._indent -= 1
+
+
+    def zerorize(self, name: str):
+        """ Inlined _zerorize() of a local """
+        self.line(f"if -1e-10 < {name} < 1e-10:")
+        self.indent()
+        self.line(f"{name} = 0.0")
+        self.dedent()
+
+
+def generate_code(spec: LSystemSpecification) -> str:
+    """ Generates the source of a Python module specialized to the specification.
+        Its bind(env) function returns two functions:
+
+            expand(l_string, depth, iterations) -> (new l_string, some rule matched)
+            walk(l_string, iterations, line, start_polygon, stop_polygon)
+                -> (x, y, heading, depth, stack, line count, complexity rating)
+
+        Expressions become inline arithmetic, rule selection is unrolled per symbol
+        and the turtle keeps its state in locals. The order of evaluations and of
+        random draws is the same as in LSystemInstance and LSystemRenderer """
+    var_names = []
+    for var_decl in spec.var_nodes:
+        if var_decl.var_name.ident not in var_names:
+            var_names.append(var_decl.var_name.ident)
+    var_indices = {name: i for i, name in enumerate(var_names)}
+    var_values = {var_decl.var_name.ident: var_decl.var_value for var_decl in spec.var_nodes}
+
+    expand_compiler = _ExpressionCompiler(var_indices, {"depth": "depth", "iterations": "iterations"}, "ev_", "depth, iterations")
+    render_compiler = _ExpressionCompiler(
+        var_indices,
+        {"x": "x", "y": "y", "heading": "heading", "depth": "depth", "iterations": "iterations"},
+        "rv_",
+        "x, y, heading, depth, iterations"
+    )
+
+    rule_sets = {}
+    for i, rule in enumerate(spec.rule_nodes):
+        rule_sets.setdefault(rule.rule_name.ident, []).append(i)
+    transform_names = []
+    transforms = []
+    for transform in spec.transform_nodes:
+        if transform.transform_name.ident not in transform_names:
+            transform_names.append(transform.transform_name.ident)
+            transforms.append(transform)
+    default_transform = ForwardTranslateTransformNode("?", spec.length_node.length, spec.width_node.width, spec.color_node.color)
+
+    out = _CodeWriter()
+    out.line("# Generated by lsys.codegen from an L-system specification, do not edit")
+    out.line("import math")
+    out.line()
+    out.line(f"CODEGEN_VERSION = {CODEGEN_VERSION}")
+    out.line(f"RULE_COUNT = {len(spec.rule_nodes)}")
+    out.line(f"TRANSFORM_NAMES = {transform_names!r}")
+    out.line()
+    out.line()
+    out.line("def bind(env):")
+    out.indent()
+    for name in ["random_", "min_", "max_", "missing", "no_function", "IdentifierNode", "PushNode", "PopNode", "BeginFillNode", "StopFillNode"]:
+        out.line(f"{name} = env[{name!r}]")
+    out.line("rng_random = env['rng'].random")
+    out.line("cos = math.cos")
+    out.line("sin = math.sin")
+    out.line("rules = env['rules']")
+    for i in range(len(spec.rule_nodes)):
+        out.line(f"E{i} = rules[{i}].rule_elements")
+
+    # variables are evaluated on every use, as they may call random()
+    for name in var_names:
+        out.line()
+        out.line(f"def ev_{var_indices[name]}(depth, iterations):")
+        out.line(f"    return {expand_compiler.compile(var_values[name])}")
+        out.line()
+        out.line(f"def rv_{var_indices[name]}(x, y, heading, depth, iterations):")
+        out.line(f"    return {render_compiler.compile(var_values[name])}")
+
+    # see LSystemSpecification.select_rule()
+    selectors = {}
+    for rule_name, indices in rule_sets.items():
+        if len(indices) == 1:
+            continue
+        selectors[rule_name] = f"select_{len(selectors)}"
+        out.line()
+        out.line(f"def {selectors[rule_name]}(depth, iterations):")
+        out.indent()
+        out.line("total = 0.0")
+        for i in indices:
+            out.line(f"total = total + {expand_compiler.compile(spec.rule_nodes[i].rule_bias)}")
+        out.line("r = rng_random() * total")
+        for i in indices:
+            out.line("if not r > 0:")
+            if i == indices[0]:
+                out.line("    raise UnboundLocalError(\"local variable 'last_rule' referenced before assignment\")")
+            else:
+                out.line(f"    return E{previous}")
+            out.line(f"r -= {expand_compiler.compile(spec.rule_nodes[i].rule_bias)}")
+            previous = i
+        out.line("if not r > 0:")
+        out.line(f"    return E{previous}")
+        out.line("raise IndexError('list index out of range')")
+        out.dedent()
+
+    out.line()
+    out.line("fixed = {" + ", ".join(f"{name!r}: E{indices[0]}" for name, indices in rule_sets.items() if len(indices) == 1) + "}")
+    out.line("selectors = {" + ", ".join(f"{name!r}: {function}" for name, function in selectors.items()) + "}")
+    out.line()
+    out.line("def expand(l_string, depth, iterations):")
+    out.indent()
+    out.line("new_l_string = []")
+    out.line("append = new_l_string.append")
+    out.line("extend = new_l_string.extend")
+    out.line("fixed_get = fixed.get")
+    out.line("selectors_get = selectors.get")
+    out.line("some_rule_matched = False")
+    out.line("for node in l_string:")
+    out.line("    if type(node) is IdentifierNode:")
+    out.line("        elements = fixed_get(node.ident)")
+    out.line("        if elements is None:")
+    out.line("            select = selectors_get(node.ident)")
+    out.line("            if select is not None:")
+    out.line("                elements = select(depth, iterations)")
+    out.line("        if elements is not None:")
+    out.line("            extend(elements)")
+    out.line("            some_rule_matched = True")
+    out.line("            continue")
+    out.line("    append(node)")
+    out.line("return new_l_string, some_rule_matched")
+    out.dedent()
+
+    out.line()
+    out.line("transform_indices = {" + ", ".join(f"{name!r}: {i}" for i, name in enumerate(transform_names)) + "}")
+    out.line()
+    out.line("def walk(l_string, iterations, line, start_polygon, stop_polygon):")
+    out.indent()
+    out.line(f"x, y, heading = 0.0, 0.0, {math.pi / 2.0!r}")
+    out.line("depth = 0")
+    out.line("stack = []")
+    out.line("line_count = 0")
+    out.line("complexity_rating = 0")
+    out.line("transform_index = transform_indices.get")
+    out.line("for node in l_string:")
+    out.indent()
+    out.line("node_type = type(node)")
+    out.line("if node_type is IdentifierNode:")
+    out.indent()
+    out.line(f"k = transform_index(node.ident, {len(transforms)})")
+    out.line("complexity_rating += depth")
+    for i, transform in enumerate(transforms + [default_transform]):
+        out.line(("if" if i == 0 else "elif") + f" k == {i}:")
+        out.indent()
+        _generate_transform(out, render_compiler, transform)
+        out.dedent()
+    out.dedent()
+    out.line("elif node_type is PushNode:")
+    out.line("    stack.append((x, y, heading))")
+    out.line("    depth += 1")
+    out.line("elif node_type is PopNode:")
+    out.line("    if len(stack) == 0:")
+    out.line("        raise IndexError('list index out of range')")
+    out.line("    x, y, heading = stack.pop()")
+    out.line("    depth -= 1")
+    out.line("elif node_type is BeginFillNode:")
+    out.line("    start_polygon()")
+    out.line("elif node_type is StopFillNode:")
+    out.line("    stop_polygon()")
+    out.dedent()
+    out.line("return x, y, heading, depth, stack, line_count, complexity_rating")
+    out.dedent()
+
+    out.line()
+    out.line("return expand, walk")
+    out.dedent()
+    return "\n".join(out.lines) + "\n"
+
+
+def _generate_transform(out: _CodeWriter, compiler: _ExpressionCompiler, transform: TransformDeclarationNode):
+    """ Straight-line code of TransformDeclarationNode.apply() and of the line
+        drawn by LSystemRenderer._apply_transform() """
+    if type(transform) == RotateTransformNode:
+        out.line(f"angle = {compiler.compile(transform.angle)}")
+        if type(transform.unit) == DegUnitNode:
+            out.line(f"angle = (angle / 360.0) * 2.0 * {math.pi!r}")
+            out.zerorize("angle")
+        out.line("heading = heading + angle")
+        out.zerorize("heading")
+        return
+
+    if type(transform) == ForwardTranslateTransformNode:
+        out.line(f"distance = {compiler.compile(transform.dist)}")
+        out.line("new_x = x + distance * cos(heading)")
+        out.zerorize("new_x")
+        out.line("new_y = y + distance * sin(heading)")
+        out.zerorize("new_y")
+    elif type(transform) == AbsTranslateTransformNode:
+        out.line(f"new_x = x + {compiler.compile(transform.x)}")
+        out.zerorize("new_x")
+        out.line(f"new_y = y + {compiler.compile(transform.y)}")
+        out.zerorize("new_y")
+    else:
+        raise Exception(f"Code generation for '{type(transform).__name__}' is not supported")
+    # width and color see the new position
+    out.line("prev_x, prev_y = x, y")
+    out.line("x, y = new_x, new_y")
+    out.line(f"width = {compiler.compile(transform.width)}")
+    if type(transform.color) == RGBColorNode:
+        out.line(f"color = ({compiler.compile(transform.color.r)}, {compiler.compile(transform.color.g)}, {compiler.compile(transform.color.b)})")
+    else:
+        out.line("color = (0, 0, 0)")
+    out.line("line(prev_x, prev_y, x, y, width, color)")
+    out.line("line_count += 1")
+
+
+def _missing(name: str):
+    raise ValueError(f"No variable with name '{name}' exists")
+
+
+def _no_function(name: str):
+    raise ValueError(f"No function with name '{name} exists")
+
+
+class CompiledSpecification:
+    """ Specification together with the Python module generated for it. Assigned to
+        LSystemInstance.compiled, it becomes the fast path of the expansion and of
+        LSystemRenderer.render() """
+
+    def __init__(self, spec: LSystemSpecification, module, code: str):
+        self.spec = spec
+        self.module = module
+        self.code = code
+        # functions bound to a random state, by random state
+        self._bound = weakref.WeakKeyDictionary()
+
+
+    def __reduce__(self):
+        # generated modules are not picklable, other processes execute the code again
+        return (_from_code, (self.spec, self.code))
+
+
+    def functions(self, rng) -> tuple:
+        """ The expand and walk functions drawing from a random state """
+        functions = self._bound.get(rng)
+        if functions == None:
+            functions = self.module.bind({
+                "random_": partial(_ctx_random, rng),
+                "min_": _ctx_min,
+                "max_": _ctx_max,
+                "rng": rng,
+                "missing": _missing,
+                "no_function": _no_function,
+                "rules": self.spec.rule_nodes,
+                "IdentifierNode": IdentifierNode,
+                "PushNode": PushNode,
+                "PopNode": PopNode,
+                "BeginFillNode": BeginFillNode,
+                "StopFillNode": StopFillNode,
+            })
+            self._bound[rng] = functions
+        return functions
+
+
+    def expand(self, instance) -> bool:
+        """ Does one iteration of the instance, see LSystemInstance._do_iteration() """
+        expand, _ = self.functions(instance.ctx.rng)
+        instance.l_string, some_rule_matched = expand(instance.l_string, instance._iteration_count, instance._max_iterations)
+        return some_rule_matched
+
+
+    def walk(self, renderer, instance):
+        """ Replaces LSystemRenderer._walk() after _begin(), leaving the renderer in the
+            same state """
+        _, walk = self.functions(instance.ctx.rng)
+        x, y, heading, depth, stack, line_count, complexity_rating = walk(
+            instance.l_string,
+            instance._max_iterations,
+            renderer._line,
+            renderer._start_polygon,
+            renderer._stop_polygon
+        )
+        renderer._turtle_stack = [TurtleState(*state) for state in stack] + [TurtleState(x, y, heading)]
+        renderer._depth = depth
+        renderer._line_count = line_count
+        renderer._complexity_rating = complexity_rating
+        renderer._set_state_vars()
+
+
+def _from_code(spec: LSystemSpecification, code: str) -> CompiledSpecification:
+    module = type(os)("lsys_compiled")
+    exec(compile(code, "<lsys_compiled>", "exec"), module.__dict__)
+    return CompiledSpecification(spec, module, code)
+
+
+def _load_module(path: str, name: str):
+    module = _loaded_modules.get(path)
+    if module == None:
+        module_spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        _loaded_modules[path] = module
+    return module
+
+
+def _is_trusted(path: str) -> bool:
+    """ Checks that a cache directory or entry is owned by the current user and can't
+        be written by anyone else, so nobody else can place code to be executed """
+    if not hasattr(os, "getuid"):
+        return True
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_uid == os.getuid() and stat.st_mode & 0o022 == 0
+
+
+def compile_specification(spec: LSystemSpecification, source: str = None, cache_directory: str = None) -> CompiledSpecification:
+    """ Returns the compiled specification, generating its module on a cache miss.
+        Modules are cached in a directory as regular Python files (so the bytecode is
+        cached by the import system as well), keyed by the hash of the L-system
+        source, or of the generated code if no source is given. The directory is
+        created private to the current user; if it or one of its entries belongs to
+        someone else or can be written by others, the module is compiled in memory
+        instead """
+    directory = cache_directory or _DEFAULT_CACHE_DIRECTORY
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not _is_trusted(directory):
+        return _from_code(spec, generate_code(spec))
+    code = None
+    if source != None:
+        key = f"{source_hash(source)[:32]}_p{PARSER_VERSION}_c{CODEGEN_VERSION}"
+    else:
+        code = generate_code(spec)
+        key = hashlib.sha256(code.encode("utf-8")).hexdigest()[:32]
+    name = f"lsys_compiled_{key}"
+    path = os.path.join(directory, name + ".py")
+
+    module = None
+    if os.path.exists(path):
+        if not _is_trusted(path):
+            return _from_code(spec, generate_code(spec))
+        try:
+            module = _load_module(path, name)
+        except Exception:
+            # unreadable or damaged entry, generated again below
+            module = None
+        if module != None and (getattr(module, "CODEGEN_VERSION", None) != CODEGEN_VERSION or module.RULE_COUNT != len(spec.rule_nodes)):
+            module = None
+        if module == None:
+            _loaded_modules.pop(path, None)
+
+    if module == None:
+        code = code or generate_code(spec)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(code)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        module = _load_module(path, name)
+    else:
+        with open(path) as file:
+            code = file.read()
+    return CompiledSpecification(spec, module, code)
@@ -0,0 +1,184 @@
+from .renderer import LSystemRenderer, SVG_SCALE, svg_rgb
+from dataclasses import dataclass
+import shutil
+import tempfile
+
+
+@dataclass
+class DetailLevel:
+    """ Output settings of one level of detail:
+            stream: file name or writable text stream the SVG document is written to
+            min_segment: connected segments of the same style are joined until they
+                are at least this long (in SVG units), shorter rests are dropped
+            precision: decimal places of coordinates, all if None
+            scale: SVG units per turtle unit, stroke widths are scaled along """
+    stream: object
+    min_segment: float = 0.0
+    precision: int = None
+    scale: float = SVG_SCALE
+
+
+class _LevelWriter:
+    """ Simplifies and formats the geometry of one level. Elements are spooled to
+        temporary files, as the document size is only known at the end """
+
+    def __init__(self, level: DetailLevel):
+        self.level = level
+        self.segments = 0
+        self._scale = level.scale
+        self._width_scale = level.scale / SVG_SCALE
+        self._min_squared = level.min_segment * level.min_segment
+        self._body = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self._polygons = None
+        self._polygon_points = None
+        self._polygon_last = None
+        self._polygon_close = (0, 0)
+        # pending segments: start, end and style of the chain not written yet
+        self._chain = False
+        self._start_x = self._start_y = self._end_x = self._end_y = 0.0
+        self._width = self._color = None
+
+
+    def _number(self, value: float) -> str:
+        if self.level.precision == None:
+            return str(value)
+        return f"{value:.{self.level.precision}f}"
+
+
+    def line(self, x1, y1, x2, y2, width, color):
+        x1, y1, x2, y2 = x1 * self._scale, -y1 * self._scale, x2 * self._scale, -y2 * self._scale
+        if not self._chain or self._end_x != x1 or self._end_y != y1 or self._width != width or self._color != color:
+            self._start_x, self._start_y = x1, y1
+            self._width, self._color = width, color
+            self._chain = True
+        self._end_x, self._end_y = x2, y2
+        dx = x2 - self._start_x
+        dy = y2 - self._start_y
+        if dx * dx + dy * dy >= self._min_squared:
+            self._write_line(self._start_x, self._start_y, x2, y2, width, color)
+            self._start_x, self._start_y = x2, y2
+
+
+    def _write_line(self, x1, y1, x2, y2, width, color):
+        r, g, b = color
+        number = self._number
+        self._body.write(f'<line stroke="{svg_rgb(r, g, b)}" stroke-width="{width * self._width_scale}" '
+            f'x1="{number(x1)}" x2="{number(x2)}" y1="{number(y1)}" y2="{number(y2)}" />')
+        self.segments += 1
+
+
+    def start_polygon(self):
+        self._chain = False
+        self._polygon_points = []
+        self._polygon_last = None
+
+
+    def polygon_line(self, x1, y1, x2, y2):
+        x1, y1 = x1 * self._scale, -y1 * self._scale
+        self._polygon_close = (x2 * self._scale, -y2 * self._scale)
+        if self._polygon_last != None:
+            dx = x1 - self._polygon_last[0]
+            dy = y1 - self._polygon_last[1]
+            if dx * dx + dy * dy < self._min_squared:
+                return
+        self._polygon_points.append(f"{self._number(x1)},{self._number(y1)}")
+        self._polygon_last = (x1, y1)
+
+
+    def stop_polygon(self):
+        if self._polygons == None:
+            self._polygons = tempfile.TemporaryFile("w+", encoding="utf-8")
+        x, y = self._polygon_close
+        self._polygon_points.append(f"{self._number(x)},{self._number(y)}")
+        self._polygons.write(f'<polygon fill="black" points="{" ".join(self._polygon_points)}" stroke="black" />')
+        self._polygon_points = None
+
+
+    def finish(self, bounds: list[float]):
+        """ Writes the document, bounds are the drawn extent in turtle units """
+        min_x, min_y, max_x, max_y = bounds[0] * self._scale, -bounds[3] * self._scale, bounds[2] * self._scale, -bounds[1] * self._scale
+        width = max_x - min_x
+        height = max_y - min_y
+        stream = self.level.stream
+        file = open(stream, "w", encoding="utf-8") if type(stream) == str else stream
+        try:
+            file.write('<?xml version="1.0" encoding="utf-8" ?>\n<svg baseProfile="full" version="1.1" '
+                'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink"'
+                f' height="{height}" viewBox="{min_x} {min_y} {width} {height}" width="{width}"><defs />')
+            for spool in (self._body, self._polygons):
+                if spool != None:
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, file)
+            file.write("</svg>")
+        finally:
+            if file is not stream:
+                file.close()
+            self.close()
+
+
+    def close(self):
+        for spool in (self._body, self._polygons):
+            if spool != None:
+                spool.close()
+
+
+class LSystemMultiResolutionRenderer(LSystemRenderer):
+    """ Writes several levels of detail (see DetailLevel) from a single turtle walk,
+        in the format of LSystemStreamingSVGRenderer. Coarse levels mostly compare
+        segment lengths, so a thumbnail next to the full resolution output costs
+        little extra. The number of segments written per level is kept in
+        level_segments """
+
+    def __init__(self, levels: list[DetailLevel]):
+        self.levels = levels
+        self.level_segments: list[int] = []
+
+
+    def _reset(self):
+        self._writers = [_LevelWriter(level) for level in self.levels]
+        self._bounds = [0, 0, 0, 0]
+        self._polygon_mode = False
+
+
+    def _line(self, x1, y1, x2, y2, width, color):
+        if self._polygon_mode:
+            for writer in self._writers:
+                writer.polygon_line(x1, y1, x2, y2)
+        else:
+            for writer in self._writers:
+                writer.line(x1, y1, x2, y2, width, color)
+
+        self._bounds = [
+            min(self._bounds[0], x1, x2),
+            min(self._bounds[1], y1, y2),
+            max(self._bounds[2], x1, x2),
+            max(self._bounds[3], y1, y2),
+        ]
+
+
+    def _start_polygon(self):
+        self._polygon_mode = True
+        for writer in self._writers:
+            writer.start_polygon()
+
+
+    def _stop_polygon(self):
+        self._polygon_mode = False
+        for writer in self._writers:
+            writer.stop_polygon()
+
+
+    def _finalize(self):
+        try:
+            for writer in self._writers:
+                writer.finish(self._bounds)
+        finally:
+            for writer in self._writers:
+                writer.close()
+        self.level_segments = [writer.segments for writer in self._writers]
+
+
+    def _abort(self):
+        for writer in self._writers:
+            writer.close()
@@ -0,0 +1,117 @@
+from .ast_nodes import *
+from array import array
+import mmap
+import os
+import tempfile
+import weakref
+
+
+# Number of symbols encoded or decoded at a time
+CHUNK_SIZE = 64 * 1024
+
+
+class SymbolTable:
+    """ Numbers the symbol nodes of a specification, so a generation can be stored
+        as an array of 32 bit codes. Generations only ever contain nodes of the axiom
+        and the rules, but unknown nodes are numbered on first use as well """
+
+    def __init__(self, nodes: list[ASTNode] = ()):
+        self.nodes: list[ASTNode] = []
+        self._codes: dict[int, int] = {}
+        for node in nodes:
+            self.code(node)
+
+
+    def code(self, node: ASTNode) -> int:
+        code = self._codes.get(id(node))
+        if code == None:
+            code = len(self.nodes)
+            self._codes[id(node)] = code
+            self.nodes.append(node)
+        return code
+
+
+    def encode(self, nodes: list[ASTNode]) -> array:
+        codes = self._codes
+        try:
+            return array("I", [codes[id(node)] for node in nodes])
+        except KeyError:
+            return array("I", map(self.code, nodes))
+
+
+class MappedGeneration:
+    """ Read-only generation stored in a memory-mapped file. Supports what the
+        renderers need from an L-string: sequential iteration (decoding one chunk at
+        a time), len() and indexing. The file is removed once the generation is
+        garbage collected """
+
+    def __init__(self, path: str, length: int, symbols: SymbolTable, owner: bool = True):
+        self.path = path
+        self._length = length
+        self._symbols = symbols
+        self._mmap = None
+        self._codes = memoryview(b"").cast("I")
+        if length > 0:
+            with open(path, "rb") as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._codes = memoryview(self._mmap).cast("I")
+        if owner:
+            weakref.finalize(self, _release, self._codes, self._mmap, path)
+
+
+    def __len__(self) -> int:
+        return self._length
+
+
+    def __iter__(self):
+        nodes = self._symbols.nodes
+        for start in range(0, self._length, CHUNK_SIZE):
+            yield from map(nodes.__getitem__, self._codes[start:start + CHUNK_SIZE].tolist())
+
+
+    def __getitem__(self, index):
+        nodes = self._symbols.nodes
+        if isinstance(index, slice):
+            return list(map(nodes.__getitem__, self._codes[index].tolist()))
+        return nodes[self._codes[index]]
+
+
+    def __reduce__(self):
+        # copies sent to other processes map the same file, but don't own it
+        return (MappedGeneration, (self.path, self._length, self._symbols, False))
+
+
+def _release(codes: memoryview, mapping: mmap.mmap, path: str):
+    codes.release()
+    if mapping != None:
+        mapping.close()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class GenerationWriter:
+    """ Appends symbols to a temporary file, chunk by chunk, which is mapped into
+        memory as a MappedGeneration when finished """
+
+    def __init__(self, symbols: SymbolTable, directory: str = None):
+        self._symbols = symbols
+        fd, self._path = tempfile.mkstemp(prefix="lsys-generation-", suffix=".bin", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self._length = 0
+
+
+    def extend(self, nodes: list[ASTNode]):
+        self._symbols.encode(nodes).tofile(self._file)
+        self._length += len(nodes)
+
+
+    def finish(self) -> MappedGeneration:
+        self._file.close()
+        return MappedGeneration(self._path, self._length, self._symbols)
+
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._path)
@@ -0,0 +1,319 @@
+from .instance import LSystemInstance
+from .interpreter import LSystemSpecification
+from .ast_nodes import *
+from .ast_nodes import _zerorize
+from .runtime_context import *
+from .renderer import LSystemRenderer, LSystemRecordingRenderer, OP_LINE, OP_START_POLYGON, OP_STOP_POLYGON
+from .lattice import is_constant
+from dataclasses import dataclass
+import math
+
+
+@dataclass(eq=False)
+class Subtree:
+    """ Interned sequence of symbols and subtrees. Two subtrees with the same items
+        are the same object, so equal parts of a generation are stored once """
+    items: tuple
+    length: int # number of symbols when flattened
+    identifiers: int # number of identifiers when flattened, ie. of turtle transforms
+    open: bool # contains a symbol with rules
+    stochastic: bool # contains a symbol with more than one rule
+    min_depth: int # lowest bracket depth relative to the start
+    net_depth: int # bracket depth at the end relative to the start
+
+
+class HashConsedInstance(LSystemInstance):
+    """ Instance which stores its generations as a DAG of interned subtrees.
+
+        Every generation is derived from the previous one in the same order as by
+        LSystemInstance, so with the same seed, the same rules are chosen. Symbols with
+        a single rule draw no random numbers, so a subtree without symbols that have
+        several rules always expands to the same subtree, which is only done once.
+        Subtrees with such symbols are expanded symbol by symbol, and identical
+        results are merged again.
+
+        l_string is flattened on access. Assigning a flat L-string (which restore()
+        does) gives up sharing for that generation. """
+
+    def __init__(self, spec: LSystemSpecification, seed=None):
+        self._table: dict[tuple, Subtree] = {}
+        self._expanded: dict[int, tuple[Subtree, Subtree]] = {} # id of a deterministic subtree -> (subtree, expansion)
+        self._root: Subtree = None
+        self._flat: list[ASTNode] = None
+        super().__init__(spec, seed)
+
+
+    @property
+    def l_string(self) -> list[ASTNode]:
+        if self._flat == None:
+            self._flat = []
+            _flatten(self._root, self._flat)
+        return self._flat
+
+
+    @l_string.setter
+    def l_string(self, l_string: list[ASTNode]):
+        self._root = self._intern(l_string)
+        self._flat = l_string
+
+
+    @property
+    def root(self) -> Subtree:
+        return self._root
+
+
+    def dedup_stats(self) -> dict:
+        """ Size of the flattened generation compared to the size of its DAG. The
+            ratio is the number of symbols per stored item """
+        subtrees = {}
+        pending = [self._root]
+        while len(pending) > 0:
+            subtree = pending.pop()
+            if id(subtree) not in subtrees:
+                subtrees[id(subtree)] = subtree
+                pending += [item for item in subtree.items if type(item) == Subtree]
+        stored_items = sum(len(subtree.items) for subtree in subtrees.values())
+        return {
+            "symbols": self._root.length,
+            "subtrees": len(subtrees),
+            "stored_items": stored_items,
+            "ratio": self._root.length / max(stored_items, 1),
+        }
+
+
+    def _do_iteration(self) -> bool:
+        self._matched = False
+        self._select_rule = self._rule_selector()
+        self._root = self._expand(self._root)
+        self._flat = None
+        # subtrees of older generations are not needed anymore
+        self._table = {}
+        self._register(self._root)
+        return self._matched
+
+
+    def _register(self, root: Subtree):
+        pending = [root]
+        while len(pending) > 0:
+            subtree = pending.pop()
+            key = tuple(map(id, subtree.items))
+            if key not in self._table:
+                self._table[key] = subtree
+                pending += [item for item in subtree.items if type(item) == Subtree]
+        self._expanded = {
+            key: entry for key, entry in self._expanded.items()
+            if entry[0] is self._table.get(tuple(map(id, entry[0].items)))
+            }
+
+
+    def _expand(self, item):
+        if type(item) != Subtree:
+            if issubclass(type(item), IdentifierNode):
+                chosen_rule = self._select_rule(item.ident, self.ctx)
+                if chosen_rule != None:
+                    self._matched = True
+                    return self._intern(chosen_rule.rule_elements)
+            return item
+
+        if not item.open:
+            return item
+        self._matched = True
+        if not item.stochastic:
+            entry = self._expanded.get(id(item))
+            if entry != None:
+                return entry[1]
+
+        expanded = self._intern([self._expand(child) for child in item.items])
+        if not item.stochastic:
+            self._expanded[id(item)] = (item, expanded)
+        return expanded
+
+
+    def _intern(self, items: list) -> Subtree:
+        key = tuple(map(id, items))
+        subtree = self._table.get(key)
+        if subtree != None:
+            return subtree
+
+        length = 0
+        identifiers = 0
+        is_open = False
+        stochastic = False
+        depth = 0
+        min_depth = 0
+        for item in items:
+            if type(item) == Subtree:
+                length += item.length
+                identifiers += item.identifiers
+                is_open = is_open or item.open
+                stochastic = stochastic or item.stochastic
+                min_depth = min(min_depth, depth + item.min_depth)
+                depth += item.net_depth
+            else:
+                length += 1
+                if issubclass(type(item), IdentifierNode):
+                    identifiers += 1
+                    rule_count = len(self.spec.rule_set(item.ident))
+                    is_open = is_open or rule_count > 0
+                    stochastic = stochastic or rule_count > 1
+                elif type(item) == PushNode:
+                    depth += 1
+                elif type(item) == PopNode:
+                    depth -= 1
+                    min_depth = min(min_depth, depth)
+
+        subtree = Subtree(tuple(items), length, identifiers, is_open, stochastic, min_depth, depth)
+        self._table[key] = subtree
+        return subtree
+
+
+def _flatten(subtree: Subtree, out: list[ASTNode]):
+    for item in subtree.items:
+        if type(item) == Subtree:
+            _flatten(item, out)
+        else:
+            out.append(item)
+
+
+@dataclass
+class _Geometry:
+    """ Output of a subtree walked from the origin with heading 0 at depth 0 """
+    ops: list[tuple]
+    headings: list[float] # of the lines of ops
+    line_count: int
+    complexity_rating: int
+    transforms: int
+    end_state: TurtleState
+
+
+def shared_geometry_supported(spec: LSystemSpecification, ctx: EvalContext, default_transform: TransformDeclarationNode) -> bool:
+    """ Checks if a subtree draws the same shape (up to rotation and translation)
+        wherever it is walked, ie. if all transforms are turns and forward moves with
+        constant parameters, widths and colors """
+    for transform in spec.transform_nodes + [default_transform]:
+        if type(transform) == RotateTransformNode:
+            if not is_constant(transform.angle, ctx):
+                return False
+        elif type(transform) == ForwardTranslateTransformNode:
+            if not (is_constant(transform.dist, ctx) and is_constant(transform.width, ctx) and is_constant(transform.color, ctx)):
+                return False
+        else:
+            return False
+    return True
+
+
+class _SharedGeometryWalker:
+    """ Walks the DAG of a HashConsedInstance. A balanced subtree met for the second
+        time is walked once on its own, and its recorded output is rotated and moved
+        into place for this and every later occurrence """
+
+    def __init__(self, instance: HashConsedInstance):
+        self._instance = instance
+        self._seen: set[int] = set()
+        self._geometry: dict[int, _Geometry] = {}
+        self.placed = 0
+
+
+    def walk(self, renderer: LSystemRenderer, subtree: Subtree):
+        for item in subtree.items:
+            if type(item) != Subtree:
+                renderer._walk((item,))
+                continue
+
+            geometry = self._geometry.get(id(item))
+            if geometry == None and id(item) in self._seen and item.min_depth >= 0 and item.net_depth == 0:
+                geometry = self._record(item)
+                self._geometry[id(item)] = geometry
+            self._seen.add(id(item))
+
+            if geometry != None:
+                self._place(renderer, geometry)
+            else:
+                self.walk(renderer, item)
+
+
+    def _record(self, subtree: Subtree) -> _Geometry:
+        recorder = LSystemRecordingRenderer()
+        recorder.record_moves = True
+        recorder._begin(self._instance)
+        recorder._update(TurtleState(0.0, 0.0, 0.0))
+        self.walk(recorder, subtree)
+        headings = [heading for _, heading in recorder.moves]
+        return _Geometry(recorder.ops, headings, recorder._line_count, recorder._complexity_rating, subtree.identifiers, recorder._state())
+
+
+    def _place(self, renderer: LSystemRenderer, geometry: _Geometry):
+        state = renderer._state()
+        x, y = state.x, state.y
+        cos_h = math.cos(state.heading)
+        sin_h = math.sin(state.heading)
+        if renderer.merge_segments or renderer.drop_zero_length \
+                or (issubclass(type(renderer), LSystemRecordingRenderer) and renderer.record_moves):
+            self._place_moves(renderer, geometry, state, cos_h, sin_h)
+        else:
+            for op in geometry.ops:
+                if op[0] == OP_LINE:
+                    _, x1, y1, x2, y2, width, color = op
+                    renderer._line(
+                        x + x1 * cos_h - y1 * sin_h, y + x1 * sin_h + y1 * cos_h,
+                        x + x2 * cos_h - y2 * sin_h, y + x2 * sin_h + y2 * cos_h,
+                        width, color
+                        )
+                elif op[0] == OP_START_POLYGON:
+                    renderer._start_polygon()
+                elif op[0] == OP_STOP_POLYGON:
+                    renderer._stop_polygon()
+            renderer._line_count += geometry.line_count
+        renderer._complexity_rating += geometry.complexity_rating + renderer._depth * geometry.transforms
+        end = geometry.end_state
+        renderer._update(TurtleState(
+            _zerorize(x + end.x * cos_h - end.y * sin_h),
+            _zerorize(y + end.x * sin_h + end.y * cos_h),
+            _zerorize(state.heading + end.heading)
+            ))
+        self.placed += 1
+
+
+    def _place_moves(self, renderer: LSystemRenderer, geometry: _Geometry, state: TurtleState, cos_h: float, sin_h: float):
+        """ Places the segments of a geometry through LSystemRenderer._draw(), so
+            they are merged or dropped like the segments of the walk. All segments
+            are forward moves, as required by shared_geometry_supported() """
+        x, y = state.x, state.y
+        forward = renderer._default_transform
+        line = 0
+        for op in geometry.ops:
+            if op[0] == OP_LINE:
+                _, x1, y1, x2, y2, width, color = op
+                heading = _zerorize(state.heading + geometry.headings[line])
+                line += 1
+                renderer._draw(
+                    forward,
+                    TurtleState(x + x1 * cos_h - y1 * sin_h, y + x1 * sin_h + y1 * cos_h, heading),
+                    TurtleState(x + x2 * cos_h - y2 * sin_h, y + x2 * sin_h + y2 * cos_h, heading),
+                    width, color
+                    )
+            elif op[0] == OP_START_POLYGON:
+                renderer._flush_line()
+                renderer._start_polygon()
+            elif op[0] == OP_STOP_POLYGON:
+                renderer._flush_line()
+                renderer._stop_polygon()
+
+
+def render_shared(renderer: LSystemRenderer, instance: LSystemInstance) -> bool:
+    """ Renders an instance like LSystemRenderer.render(). For a HashConsedInstance
+        whose transforms are all constant (see shared_geometry_supported), subtrees
+        that occur more than once are walked once. Returns whether that was the
+        case; otherwise the flattened L-string is walked as usual, which is also
+        done to skip branches for the renderer's max_branch_depth """
+    renderer._begin(instance)
+    if type(instance) != HashConsedInstance or renderer.max_branch_depth != None \
+            or not shared_geometry_supported(instance.spec, renderer._ctx, renderer._default_transform):
+        renderer._walk_instance(instance, False)
+        renderer._finalize()
+        return False
+
+    _SharedGeometryWalker(instance).walk(renderer, instance.root)
+    renderer._flush_line()
+    renderer._finalize()
+    return True
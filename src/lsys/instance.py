@@ -1,13 +1,47 @@
 from .interpreter import *
 from .ast_nodes import *
+from .generation_buffer import SymbolTable, GenerationWriter, CHUNK_SIZE
+from .bracket_index import BracketIndex
+from .progress import ProgressTracker, CancellationToken, PROGRESS_CHUNK
+from dataclasses import dataclass
 import math
+import random
+
+
+@dataclass
+class GenerationSnapshot:
+    """ Expansion state of an instance after a number of iterations. Generations are
+        never modified in place, so a snapshot only keeps a reference to the L-string """
+    l_string: list[ASTNode]
+    rng_state: tuple
+    max_iterations: int
+    iteration_count: int
+    exhausted: bool # no rule matched in the last iteration, deeper generations are identical
+    stripped: frozenset = frozenset() # see LSystemInstance.optimization
+
 
 class LSystemInstance:
+    """ Expansion state of a specification. With a spill threshold, generations with
+        more symbols than that are written to memory-mapped files (see
+        lsys.generation_buffer) instead of being kept in lists. With index_brackets
+        set, bracket_index is kept up to date for every generation (see
+        lsys.bracket_index) """
 
-    def __init__(self, spec: LSystemSpecification):
+    # see lsys.instrumentation
+    instrumentation = None
+    # CompiledSpecification of the spec, used for expansion and rendering (see lsys.codegen)
+    compiled = None
+    # set while iterate() reports progress or can be cancelled
+    _progress: ProgressTracker = None
+    # SpecOptimization of the spec, strips symbols not contributing to the drawing
+    # from every generation (see lsys.optimizer). Not for HashConsedInstance
+    optimization = None
+
+    def __init__(self, spec: LSystemSpecification, seed=None, spill_threshold: int = None, spill_directory: str = None, index_brackets: bool = False):
         self.spec: LSystemSpecification = spec
         self.l_string: list[ASTNode] = spec.axiom_node.axiom
-        self.ctx: EvalContext = EvalContext.create()
+        self.seed = seed
+        self.ctx: EvalContext = EvalContext.create(random.Random(seed))
         self.ctx.vars = {
             "pi": NumNode(math.pi),
             "e": NumNode(math.e),
@@ -17,28 +51,184 @@ class LSystemInstance:
             self.ctx.vars[var_decl.var_name.ident] = var_decl.var_value
 
         self._iteration_count: int = 0
+        self._max_iterations: int = None
+        self._exhausted: bool = False
+        self.spill_threshold = spill_threshold
+        self.spill_directory = spill_directory
+        self._symbols: SymbolTable = None
+        self.index_brackets = index_brackets
+        self.bracket_index: BracketIndex = BracketIndex.build(self.l_string) if index_brackets else None
+        self._rule_indices: dict[int, tuple[RuleDeclarationNode, BracketIndex]] = {}
+        # names of stripped symbols in the current generation which have rules
+        self._stripped: set[str] = set()
+        # generation, stripped names and bracket index before the last generation was
+        # stripped, to continue from if the instance is advanced further
+        self._unstripped: tuple = None
     
 
-    def iterate(self):
+    def iterate(self, iterations: int = None, progress=None, cancel: CancellationToken = None, progress_interval: float = 1.0):
+        """ Expands the axiom. The number of iterations is taken from the specification,
+            unless it is given explicitly.
+
+            progress is called with a lsys.progress.Progress at most every
+            progress_interval seconds and once at the end. If cancel is set, Cancelled
+            is raised and the instance is left at the last complete generation. Both
+            are checked every PROGRESS_CHUNK symbols """
+        self.reset()
+        self.begin(iterations)
+        if progress == None and cancel == None:
+            self.advance(self._max_iterations)
+            return
+        self._progress = ProgressTracker("expand", progress, cancel, progress_interval, self._max_iterations)
+        try:
+            self.advance(self._max_iterations)
+            self._progress.finish(self._iteration_count, len(self.l_string))
+        finally:
+            self._progress = None
+
+
+    def reset(self):
+        """ Goes back to the axiom. The random state is not reset """
+        self.l_string = self.spec.axiom_node.axiom
         self._iteration_count = 0
-        max_iterations = math.floor(self.spec.iterate_node.iterations.eval(self.ctx))
-        self.ctx.vars["iterations"] = NumNode(max_iterations)
-        self.ctx.vars["depth"] = NumNode(0)
-        for _ in range(max_iterations):
-            if not self._do_iteration():
-                break
+        self._max_iterations = None
+        self._exhausted = False
+        self._stripped = set()
+        self._unstripped = None
+        if self.index_brackets:
+            self.bracket_index = BracketIndex.build(self.l_string)
+
+
+    def begin(self, iterations: int = None):
+        """ Fixes the target number of iterations (the 'iterations' variable), evaluating
+            the iterate declaration unless it is given explicitly. Called by advance() if
+            necessary """
+        self.ctx.instrumentation = self.instrumentation
+        if iterations != None:
+            self._max_iterations = math.floor(iterations)
+        else:
+            self._max_iterations = math.floor(self.spec.iterate_node.iterations.eval(self.ctx))
+        self.ctx.vars["iterations"] = NumNode(self._max_iterations)
+        self.ctx.vars["depth"] = NumNode(self._iteration_count)
+
+
+    def advance(self, k: int = 1) -> int:
+        """ Extends the current generation by up to k iterations and returns the number
+            of iterations done. Stops early once no rule matches anymore """
+        if self._max_iterations == None:
+            self.begin()
+        self.ctx.instrumentation = self.instrumentation
+        if self.optimization != None and self._iteration_count == 0:
+            self._strip()
+        done = 0
+        while done < k and not self._exhausted:
+            if self._unstripped != None:
+                self._unstrip()
+            if self._progress != None:
+                self._progress.check(self._iteration_count + 1, 0)
+            span = self.instrumentation.begin_span("generation") if self.instrumentation != None else None
+            matched = self._do_iteration()
+            if self.optimization != None:
+                self._stripped, stripped_matched = self.optimization.expand_stripped(self._stripped)
+                matched = matched or stripped_matched
+            if span != None:
+                self.instrumentation.end_span(span, iteration=self._iteration_count + 1, symbols=len(self.l_string))
+                self.instrumentation.generation_done(self._iteration_count + 1, len(self.l_string))
+            if not matched:
+                self._exhausted = True
             else:
                 self._iteration_count += 1
                 self.ctx.vars["depth"] = NumNode(self._iteration_count)
+                done += 1
+                if self.optimization != None:
+                    self._strip()
+        return done
+
+
+    def _strip(self):
+        """ Removes the symbols which can't contribute to the drawing anymore (see
+            SpecOptimization), keeping the last generation as it was before. Generations
+            spilled to files are kept as they are """
+        if type(self.l_string) != list:
+            return
+        last = self._iteration_count >= self._max_iterations
+        l_string, stripped = self.optimization.strip(self.l_string, last)
+        if l_string is self.l_string:
+            return
+        if last:
+            self._unstripped = (self.l_string, set(self._stripped), self.bracket_index)
+        self.l_string = l_string
+        self._stripped |= stripped
+        if self.index_brackets:
+            self.bracket_index = BracketIndex.build(self.l_string)
+
+
+    def _unstrip(self):
+        """ Goes back to the last generation as it was before stripping it """
+        self.l_string, self._stripped, self.bracket_index = self._unstripped
+        self._unstripped = None
+
+
+    def snapshot(self) -> GenerationSnapshot:
+        if self._max_iterations == None:
+            self.begin()
+        # snapshots can be continued, so they keep the last generation unstripped
+        l_string, stripped, _ = self._unstripped if self._unstripped != None else (self.l_string, self._stripped, None)
+        return GenerationSnapshot(
+            l_string,
+            self.ctx.rng.getstate(),
+            self._max_iterations,
+            self._iteration_count,
+            self._exhausted,
+            frozenset(stripped)
+        )
+
+
+    def restore(self, snapshot: GenerationSnapshot):
+        """ Continues from a snapshot taken from this or another instance of the
+            same specification """
+        self.l_string = snapshot.l_string
+        if self.index_brackets:
+            self.bracket_index = BracketIndex.build(self.l_string)
+        self.ctx.rng.setstate(snapshot.rng_state)
+        self._iteration_count = snapshot.iteration_count
+        self._exhausted = snapshot.exhausted
+        self._stripped = set(snapshot.stripped)
+        self._unstripped = None
+        self.begin(snapshot.max_iterations)
     
 
+    def _rule_selector(self):
+        """ Returns the function rules are selected with, which is select_rule() of
+            the specification unless rule hits are counted """
+        if self.instrumentation == None:
+            return self.spec.select_rule
+
+        def select_rule(rule_name: str, ctx: EvalContext) -> RuleDeclarationNode:
+            chosen_rule = self.spec.select_rule(rule_name, ctx)
+            if chosen_rule != None:
+                self.instrumentation.rule_selected(rule_name, self.spec.rule_set(rule_name), chosen_rule)
+            return chosen_rule
+        return select_rule
+
+
     def _do_iteration(self) -> bool:
+        if self.spill_threshold != None:
+            some_rule_matched = self._do_spilling_iteration()
+            if self.index_brackets:
+                self.bracket_index = BracketIndex.build(self.l_string)
+            return some_rule_matched
+        if self.index_brackets:
+            return self._do_indexing_iteration()
+        if self.compiled != None and self.instrumentation == None and self._progress == None:
+            return self.compiled.expand(self)
+        select_rule = self._rule_selector()
         new_l_string = []
         some_rule_matched = False
-        for node in self.l_string:
+        for node in self._expanded_symbols():
             if issubclass(type(node), IdentifierNode):
                 rule_name = node.ident
-                chosen_rule = self.spec.select_rule(rule_name, self.ctx)
+                chosen_rule = select_rule(rule_name, self.ctx)
                 if chosen_rule != None:
                     some_rule_matched = True
                     new_l_string += chosen_rule.rule_elements
@@ -48,3 +238,90 @@ class LSystemInstance:
                 new_l_string.append(node)
         self.l_string = new_l_string
         return some_rule_matched
+
+
+    def _expanded_symbols(self):
+        """ The current generation, or while tracking progress, a generator checking
+            the progress between chunks of it """
+        if self._progress == None:
+            return self.l_string
+        return self._tracked_symbols(self.l_string)
+
+
+    def _tracked_symbols(self, l_string: list[ASTNode]):
+        generation = self._iteration_count + 1
+        total = len(l_string)
+        for start in range(0, total, PROGRESS_CHUNK):
+            self._progress.check(generation, start, total)
+            yield from l_string[start:start + PROGRESS_CHUNK]
+
+
+    def _do_indexing_iteration(self) -> bool:
+        """ Like _do_iteration(), but also derives the bracket index of the new
+            generation from the current one """
+        select_rule = self._rule_selector()
+        new_l_string = []
+        expansions = []
+        some_rule_matched = False
+        for node in self._expanded_symbols():
+            if issubclass(type(node), IdentifierNode):
+                chosen_rule = select_rule(node.ident, self.ctx)
+                if chosen_rule != None:
+                    some_rule_matched = True
+                    new_l_string += chosen_rule.rule_elements
+                    expansions.append((chosen_rule.rule_elements, self._rule_index(chosen_rule)))
+                    continue
+            new_l_string.append(node)
+            expansions.append(None)
+        self.bracket_index = self.bracket_index.derive(new_l_string, expansions)
+        self.l_string = new_l_string
+        return some_rule_matched
+
+
+    def _rule_index(self, rule: RuleDeclarationNode) -> BracketIndex:
+        entry = self._rule_indices.get(id(rule))
+        if entry == None or entry[0] is not rule:
+            entry = (rule, BracketIndex.build(rule.rule_elements))
+            self._rule_indices[id(rule)] = entry
+        return entry[1]
+
+
+    def _do_spilling_iteration(self) -> bool:
+        """ Like _do_iteration(), but once the new generation grows past the spill
+            threshold, it is written to a file chunk by chunk """
+        if self._symbols == None:
+            self._symbols = SymbolTable(self.spec.axiom_node.axiom + [node for rule in self.spec.rule_nodes for node in rule.rule_elements])
+        select_rule = self._rule_selector()
+        new_l_string = []
+        writer = None
+        some_rule_matched = False
+        try:
+            for node in self._expanded_symbols():
+                if issubclass(type(node), IdentifierNode):
+                    chosen_rule = select_rule(node.ident, self.ctx)
+                    if chosen_rule != None:
+                        some_rule_matched = True
+                        new_l_string += chosen_rule.rule_elements
+                    else:
+                        new_l_string.append(node)
+                else:
+                    new_l_string.append(node)
+
+                if len(new_l_string) >= CHUNK_SIZE:
+                    if writer == None and len(new_l_string) > self.spill_threshold:
+                        writer = GenerationWriter(self._symbols, self.spill_directory)
+                    if writer != None:
+                        writer.extend(new_l_string)
+                        new_l_string = []
+        except BaseException:
+            if writer != None:
+                writer.abort()
+            raise
+
+        if writer == None and len(new_l_string) > self.spill_threshold:
+            writer = GenerationWriter(self._symbols, self.spill_directory)
+        if writer != None:
+            writer.extend(new_l_string)
+            new_l_string = writer.finish()
+        self.l_string = new_l_string
+        return some_rule_matched
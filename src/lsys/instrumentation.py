@@ -0,0 +1,188 @@
+from .ast_nodes import *
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Instrumentation:
+    """ Collects timings and counters from the objects it is attached to, by setting
+        their 'instrumentation' attribute (Parser, LSystemInstance, LSystemRenderer).
+        Unattached objects only pay for a check of that attribute per stage, per
+        iteration and per transform application.
+
+        Recorded are:
+            spans: named time intervals (stages, generations)
+            generation sizes: symbols after every iteration
+            rule hits: how often every rule was chosen, by rule name and index in its
+                rule set, and how many bias expressions were evaluated for that
+            transform applications: by transform name
+            expression evaluations: evaluated expression nodes, only counted inside
+                counting_evaluations(), and only in the evaluation contexts of the
+                attached instances and renderers """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self.spans: list[dict] = []
+        self.generation_sizes: list[tuple[int, int]] = []
+        self.rule_hits: dict[str, int] = {}
+        self.bias_evaluations = 0
+        self.transform_applications: dict[str, int] = {}
+        self.expression_evaluations = 0
+
+
+    def attach(self, *targets):
+        """ Sets the instrumentation attribute of all targets to this object """
+        for target in targets:
+            target.instrumentation = self
+        return self
+
+
+    def begin_span(self, name: str) -> tuple:
+        return (name, time.perf_counter())
+
+
+    def end_span(self, span: tuple, **args):
+        name, start = span
+        self.spans.append({
+            "name": name,
+            "start": start - self._origin,
+            "duration": time.perf_counter() - start,
+            "thread": threading.get_ident(),
+            "args": args,
+        })
+
+
+    @contextmanager
+    def span(self, name: str, **args):
+        span = self.begin_span(name)
+        try:
+            yield
+        finally:
+            self.end_span(span, **args)
+
+
+    def generation_done(self, iteration: int, size: int):
+        self.generation_sizes.append((iteration, size))
+
+
+    def rule_selected(self, rule_name: str, rule_set: list[RuleDeclarationNode], chosen_rule: RuleDeclarationNode):
+        index = next(i for i, rule in enumerate(rule_set) if rule is chosen_rule)
+        key = f"{rule_name}#{index}"
+        self.rule_hits[key] = self.rule_hits.get(key, 0) + 1
+        if len(rule_set) > 1:
+            # select_rule evaluates all biases for the total weight, then the biases
+            # up to the chosen rule again
+            self.bias_evaluations += len(rule_set) + index + 1
+
+
+    def transform_applied(self, transform_node: TransformDeclarationNode):
+        name = transform_node.transform_name.ident if type(transform_node.transform_name) == IdentifierNode else "(default)"
+        self.transform_applications[name] = self.transform_applications.get(name, 0) + 1
+
+
+    @contextmanager
+    def counting_evaluations(self):
+        """ Counts the expression nodes evaluated in the calling thread while active,
+            in the contexts of the attached objects only. The eval calls are seen by a
+            profile function (see sys.setprofile()), which is only installed for that
+            time, so expression evaluation carries no hooks otherwise. Can be nested,
+            also with blocks of other instances of Instrumentation """
+        active = _counting_state().active
+        active.append(self)
+        if len(active) == 1:
+            _counting.previous = sys.getprofile()
+            sys.setprofile(_count_evaluations)
+        try:
+            yield
+        finally:
+            active.remove(self)
+            if len(active) == 0:
+                sys.setprofile(_counting.previous)
+
+
+    def to_dict(self) -> dict:
+        stage_times = {}
+        for span in self.spans:
+            stage_times[span["name"]] = stage_times.get(span["name"], 0.0) + span["duration"]
+        return {
+            "stage_times": stage_times,
+            "spans": self.spans,
+            "generation_sizes": [{"iteration": iteration, "symbols": size} for iteration, size in self.generation_sizes],
+            "rule_hits": self.rule_hits,
+            "bias_evaluations": self.bias_evaluations,
+            "transform_applications": self.transform_applications,
+            "expression_evaluations": self.expression_evaluations,
+        }
+
+
+    def write_json(self, file_name: str):
+        with open(file_name, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+    def write_chrome_trace(self, file_name: str):
+        """ Writes the spans and generation sizes in the Trace Event Format, which
+            chrome://tracing and Perfetto can open """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": pid,
+                "tid": span["thread"],
+                "args": span["args"],
+            })
+        for span in self.spans:
+            if span["name"] == "generation":
+                events.append({
+                    "name": "symbols",
+                    "ph": "C",
+                    "ts": (span["start"] + span["duration"]) * 1e6,
+                    "pid": pid,
+                    "args": {"symbols": span["args"]["symbols"]},
+                })
+        with open(file_name, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+# Per thread: instrumentations inside counting_evaluations(), and the profile
+# function that was set before the first of them
+_counting = threading.local()
+# Code objects of the eval methods of all expression node classes
+_eval_codes: set = None
+
+
+def _counting_state():
+    global _eval_codes
+    if _eval_codes == None:
+        _eval_codes = _collect_eval_codes()
+    if not hasattr(_counting, "active"):
+        _counting.active = []
+        _counting.previous = None
+    return _counting
+
+
+def _count_evaluations(frame, event, arg):
+    if event == "call" and frame.f_code in _eval_codes:
+        instrumentation = frame.f_locals["ctx"].instrumentation
+        if instrumentation != None and instrumentation in _counting.active:
+            instrumentation.expression_evaluations += 1
+    if _counting.previous != None:
+        _counting.previous(frame, event, arg)
+
+
+def _collect_eval_codes() -> set:
+    codes = set()
+    pending = [EvalNode]
+    while len(pending) > 0:
+        cls = pending.pop()
+        pending += cls.__subclasses__()
+        if "eval" in cls.__dict__:
+            codes.add(cls.__dict__["eval"].__code__)
+    return codes
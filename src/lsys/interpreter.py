@@ -1,11 +1,13 @@
 from .ast_nodes import *
 from dataclasses import dataclass, field
 from functools import reduce
-import pprint
-import random
 
 
 class LSystemSpecification:
+    """ Immutable description of an L-system. Specifications hold no runtime state
+        (that lives in LSystemInstance and the renderers), so one specification can be
+        shared by any number of instances and threads. It must not be modified once
+        it is in use, as the rule and transform lookup tables are built on first use """
     
     axiom_node: AxiomDeclarationNode = None
     length_node: LengthDeclarationNode = None
@@ -13,11 +15,18 @@ class LSystemSpecification:
     iterate_node: IterateDeclarationNode = None
     color_node: ColorDeclarationNode = None
 
-    transform_nodes: list[TransformDeclarationNode] = []
-    rule_nodes: list[RuleDeclarationNode] = []
-    var_nodes: list[VarDeclarationNode] = []
+    transform_nodes: list[TransformDeclarationNode]
+    rule_nodes: list[RuleDeclarationNode]
+    var_nodes: list[VarDeclarationNode]
 
 
+    def __init__(self):
+        self.transform_nodes = []
+        self.rule_nodes = []
+        self.var_nodes = []
+        self._rule_sets: dict[str, list[RuleDeclarationNode]] = None
+        self._transforms: dict[str, TransformDeclarationNode] = None
+
     @classmethod
     def _error(cls, msg: str):
         raise Exception(f"Interpreter Error: {msg}")
@@ -28,7 +37,9 @@ class LSystemSpecification:
         spec = LSystemSpecification()
         spec._create_defaults()
         error = LSystemSpecification._error
-        variable_names = []
+        variable_names = set()
+        # transforms by name, a redeclared transform moves to the end
+        transforms = {transform.transform_name.ident: transform for transform in spec.transform_nodes}
 
         iterate_declared = False
         length_declared = False
@@ -66,18 +77,22 @@ class LSystemSpecification:
             
             elif issubclass(type(node), TransformDeclarationNode):
                 # in case of redeclaration, remove existing transform
-                spec.transform_nodes = [transform for transform in spec.transform_nodes if transform.transform_name.ident != node.transform_name.ident]
-                spec.transform_nodes.append(node)
+                transforms.pop(node.transform_name.ident, None)
+                transforms[node.transform_name.ident] = node
 
             elif issubclass(type(node), VarDeclarationNode):
-                if node.var_name in variable_names:
+                if node.var_name.ident in variable_names:
                     error(f"Redeclaration of variable '{node.var_name.ident}'")
                 spec.var_nodes.append(node)
-                variable_names.append(node.var_name)
+                variable_names.add(node.var_name.ident)
 
+        spec.transform_nodes = list(transforms.values())
         return spec
     
     def __repr__(self):
+        # only needed for debugging, kept out of the startup imports
+        import pprint
+
         def ___list(list):
             string = ""
             for item in list:
@@ -107,8 +122,27 @@ class LSystemSpecification:
         self.color_node = ColorDeclarationNode(ColorNode())
 
 
+    def _build_lookup_tables(self):
+        rule_sets = {}
+        for rule in self.rule_nodes:
+            rule_sets.setdefault(rule.rule_name.ident, []).append(rule)
+        # the first declaration wins, like in a linear search through the transforms
+        transforms = {}
+        for transform in self.transform_nodes:
+            transforms.setdefault(transform.transform_name.ident, transform)
+        self._rule_sets = rule_sets
+        self._transforms = transforms
+
+
+    def rule_set(self, rule_identifier: str) -> list[RuleDeclarationNode]:
+        """ All rules for a symbol, in declaration order. The list must not be modified """
+        if self._rule_sets == None:
+            self._build_lookup_tables()
+        return self._rule_sets.get(rule_identifier, [])
+
+
     def select_rule(self, rule_identifier: str, ctx: EvalContext) -> RuleDeclarationNode:
-        rule_set = [rule for rule in self.rule_nodes if rule.rule_name.ident == rule_identifier]
+        rule_set = self.rule_set(rule_identifier)
 
         if len(rule_set) == 0:
             return None
@@ -117,18 +151,18 @@ class LSystemSpecification:
         
         total_weight = reduce((lambda total, rule: total + rule.rule_bias.eval(ctx)), rule_set, 0.0)
 
-        rng = random.random() * total_weight
+        rng = ctx.rng.random() * total_weight
 
+        i = 0
         while rng > 0:
-            last_rule = rule_set.pop(0)
+            last_rule = rule_set[i]
+            i += 1
             rng -= last_rule.rule_bias.eval(ctx)
             
         return last_rule
     
 
     def get_transform(self, transform_name: str) -> TransformDeclarationNode:
-        # TODO make lookup more efficient, use dicts!
-        for transform in self.transform_nodes:
-            if transform.transform_name.ident == transform_name:
-                return transform
-        return None
+        if self._transforms == None:
+            self._build_lookup_tables()
+        return self._transforms.get(transform_name)
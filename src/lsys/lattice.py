@@ -0,0 +1,155 @@
+from .ast_nodes import *
+from .runtime_context import *
+from .interpreter import LSystemSpecification
+from dataclasses import dataclass
+import math
+
+
+# Largest number of directions a lattice turtle will use
+MAX_DIRECTIONS = 360
+
+# Variables that change while the turtle walks
+_TURTLE_VARS = {"x", "y", "heading", "depth"}
+
+
+def is_constant(node: EvalNode, ctx: EvalContext, _visiting: set = None) -> bool:
+    """ Checks if an expression evaluates to the same value whenever it is evaluated
+        during a turtle walk, ie. it neither depends on the turtle state nor draws
+        random numbers """
+    _visiting = _visiting or set()
+    function_names = set()
+    for child in walk(node):
+        if type(child) == FunctionNode:
+            if child.name.ident not in ("min", "max"):
+                return False
+            function_names.add(id(child.name))
+        elif type(child) == IdentifierNode and id(child) not in function_names:
+            if child.ident in _TURTLE_VARS or child.ident in _visiting:
+                return False
+            value = ctx.vars.get(child.ident)
+            if value == None:
+                return False
+            if not is_constant(value, ctx, _visiting | {child.ident}):
+                return False
+    return True
+
+
+def _direction_count(angle_deg: float) -> int:
+    """ Smallest n for which the angle is a multiple of 360/n degrees, or None """
+    for n in range(1, MAX_DIRECTIONS + 1):
+        steps = angle_deg * n / 360.0
+        if abs(steps - round(steps)) < 1e-9:
+            return n
+    return None
+
+
+@dataclass
+class LatticeTurtleState(TurtleState):
+    """ Turtle state on a lattice. The heading is an index into the direction table
+        (not reduced modulo the number of directions, like the float heading), the
+        rounding errors of x and y are carried along in x_error and y_error """
+    heading_index: int
+    x_error: float
+    y_error: float
+
+
+    def clone(self):
+        return LatticeTurtleState(self.x, self.y, self.heading, self.heading_index, self.x_error, self.y_error)
+
+
+class LatticePlan:
+    """ Exact turtle for specifications whose rotations are all constant multiples of
+        360/N degrees and whose translations are all forward moves by constant
+        distances. A step adds the precomputed vector of its distance and direction
+        to the position, with compensated summation, so positions don't drift however
+        long the walk is. """
+
+    def __init__(self, directions: int, rotations: dict, distances: list[float], translations: dict):
+        self.directions = directions
+        self._rotations = rotations # id(transform) -> heading steps
+        self._heading_step = 2.0 * math.pi / directions
+
+        # step vectors by direction, for every distance. The second half of the
+        # directions are negations of the first, so opposite steps cancel exactly
+        half = directions // 2
+        unit_x = [_exact_cos(k, directions) for k in range(half)]
+        unit_y = [_exact_cos(k - directions // 4, directions) for k in range(half)]
+        steps = []
+        for d in distances:
+            forward = [(d * ux, d * uy) for ux, uy in zip(unit_x, unit_y)]
+            steps.append(forward + [(-dx, -dy) for dx, dy in forward])
+        self._steps = {key: steps[index] for key, index in translations.items()} # id(transform) -> step vectors
+
+
+    def initial_state(self) -> LatticeTurtleState:
+        heading_index = self.directions // 4 # facing up
+        return LatticeTurtleState(0.0, 0.0, heading_index * self._heading_step, heading_index, 0.0, 0.0)
+
+
+    def apply(self, transform_node: TransformDeclarationNode, state: LatticeTurtleState) -> LatticeTurtleState:
+        steps = self._rotations.get(id(transform_node))
+        if steps != None:
+            heading_index = state.heading_index + steps
+            return LatticeTurtleState(state.x, state.y, heading_index * self._heading_step, heading_index, state.x_error, state.y_error)
+
+        dx, dy = self._steps[id(transform_node)][state.heading_index % self.directions]
+        # compensated sums (Knuth's TwoSum), inlined as this runs for every step
+        x = state.x
+        s = x + dx
+        t = s - x
+        x_error = state.x_error + (x - (s - t)) + (dx - t)
+        x = s + x_error
+        x_error -= x - s
+        y = state.y
+        s = y + dy
+        t = s - y
+        y_error = state.y_error + (y - (s - t)) + (dy - t)
+        y = s + y_error
+        y_error -= y - s
+        return LatticeTurtleState(x, y, state.heading, state.heading_index, x_error, y_error)
+
+
+def _exact_cos(k: int, n: int) -> float:
+    """ cos(2 pi k / n), exact for multiples of 90 degrees """
+    k = k % n
+    if (4 * k) % n == 0:
+        return [1.0, 0.0, -1.0, 0.0][4 * k // n]
+    return math.cos(2.0 * math.pi * k / n)
+
+
+def build_lattice_plan(spec: LSystemSpecification, ctx: EvalContext, default_transform: TransformDeclarationNode) -> LatticePlan:
+    """ Returns a lattice plan for the specification, or None if it has transforms a
+        lattice turtle can't represent """
+    angles = {}
+    distances = []
+    translations = {}
+    for transform in spec.transform_nodes + [default_transform]:
+        if type(transform) == RotateTransformNode:
+            if not is_constant(transform.angle, ctx):
+                return None
+            angle = transform.angle.eval(ctx)
+            if type(transform.unit) == RadUnitNode:
+                angle = math.degrees(angle)
+            angles[id(transform)] = angle
+        elif type(transform) == ForwardTranslateTransformNode:
+            if not is_constant(transform.dist, ctx):
+                return None
+            distance = float(transform.dist.eval(ctx))
+            if distance not in distances:
+                distances.append(distance)
+            translations[id(transform)] = distances.index(distance)
+        else:
+            return None
+
+    # the turtle starts facing up, so quarter turns are always needed
+    directions = 4
+    for angle in angles.values():
+        n = _direction_count(angle)
+        if n == None:
+            return None
+        directions = directions * n // math.gcd(directions, n)
+        if directions > MAX_DIRECTIONS:
+            return None
+
+    rotations = {key: round(angle * directions / 360.0) for key, angle in angles.items()}
+    return LatticePlan(directions, rotations, distances, translations)
@@ -0,0 +1,102 @@
+from .ast_nodes import *
+from .runtime_context import *
+from .interpreter import LSystemSpecification
+from .lattice import is_constant
+from .pipeline import draws_random
+
+
+def is_no_op(transform: TransformDeclarationNode, ctx: EvalContext) -> bool:
+    """ Checks if applying a transform provably leaves the turtle where it is,
+        without drawing random numbers. Translations by zero still draw a zero-length
+        segment, which is not visible """
+    if type(transform) == RotateTransformNode:
+        return is_constant(transform.angle, ctx) and transform.angle.eval(ctx) == 0
+    if type(transform) == ForwardTranslateTransformNode:
+        moves = not is_constant(transform.dist, ctx) or transform.dist.eval(ctx) != 0
+    elif type(transform) == AbsTranslateTransformNode:
+        moves = not is_constant(transform.x, ctx) or not is_constant(transform.y, ctx) \
+            or transform.x.eval(ctx) != 0 or transform.y.eval(ctx) != 0
+    else:
+        return False
+    # the style is evaluated for the segment, which must not change the random state
+    return not moves and not draws_random([transform.width, transform.color], ctx)
+
+
+class SpecOptimization:
+    """ Analysis of a specification for stripping symbols that don't contribute to
+        the drawing from the generations of an instance (see
+        LSystemInstance.optimization):
+
+            no_op: identifiers whose transform does nothing (see is_no_op())
+            inert: no-op identifiers which only ever rewrite into inert symbols with a
+                single rule each (choosing a rule draws no random numbers then), or
+                have no rules, so they don't contribute after any number of iterations
+
+        Inert symbols are stripped from every generation, and once an instance has
+        done its iterations, every no-op identifier is stripped from the last one. A
+        stripped symbol still counts as matching a rule, so instances end after the
+        same number of iterations (see LSystemInstance.advance()). The complexity
+        rating only counts the transforms applied to the remaining symbols """
+
+    def __init__(self, spec: LSystemSpecification, ctx: EvalContext):
+        self.spec = spec
+        default_transform = ForwardTranslateTransformNode(
+            "?",
+            spec.length_node.length,
+            spec.width_node.width,
+            spec.color_node.color
+            )
+        names = set()
+        for node in spec.axiom_node.axiom + [node for rule in spec.rule_nodes for node in rule.rule_elements]:
+            if type(node) == IdentifierNode:
+                names.add(node.ident)
+        for rule in spec.rule_nodes:
+            names.add(rule.rule_name.ident)
+        self.no_op: frozenset[str] = frozenset(
+            name for name in names if is_no_op(spec.get_transform(name) or default_transform, ctx))
+        inert = self.no_op
+        while True:
+            narrowed = frozenset(name for name in inert if self._rewrites_into(name, inert))
+            if narrowed == inert:
+                break
+            inert = narrowed
+        self.inert: frozenset[str] = inert
+
+
+    def _rewrites_into(self, name: str, symbols: frozenset[str]) -> bool:
+        rule_set = self.spec.rule_set(name)
+        if len(rule_set) == 0:
+            return True
+        if len(rule_set) > 1:
+            return False
+        return all(type(node) == IdentifierNode and node.ident in symbols for node in rule_set[0].rule_elements)
+
+
+    def strip(self, l_string: list[ASTNode], last: bool) -> tuple[list[ASTNode], set[str]]:
+        """ Removes the inert symbols from a generation, or all no-op symbols from the
+            last one. Returns the new generation and the names of the removed symbols
+            which have rules """
+        symbols = self.no_op if last else self.inert
+        if len(symbols) == 0:
+            return l_string, set()
+        kept = []
+        stripped = set()
+        for node in l_string:
+            if type(node) == IdentifierNode and node.ident in symbols:
+                stripped.add(node.ident)
+            else:
+                kept.append(node)
+        if len(stripped) == 0:
+            return l_string, set()
+        return kept, {name for name in stripped if len(self.spec.rule_set(name)) > 0}
+
+
+    def expand_stripped(self, stripped: set[str]) -> tuple[set[str], bool]:
+        """ Expands the names of stripped symbols like a generation. Returns the names
+            of the next generation which have rules, and whether any rule matched """
+        expanded = set()
+        for name in stripped:
+            for node in self.spec.rule_set(name)[0].rule_elements:
+                if type(node) == IdentifierNode and len(self.spec.rule_set(node.ident)) > 0:
+                    expanded.add(node.ident)
+        return expanded, len(stripped) > 0
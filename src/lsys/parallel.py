@@ -0,0 +1,161 @@
+from .instance import LSystemInstance
+from .ast_nodes import *
+from .runtime_context import *
+from .renderer import LSystemRenderer, LSystemRecordingRenderer
+from .bracket_index import BracketIndex
+from .pipeline import draws_random
+import multiprocessing
+import os
+
+
+# State of a pool worker, set up once by _init_worker
+_worker_instance: LSystemInstance = None
+_worker_lattice = False
+_worker_max_branch_depth: int = None
+_worker_record_moves = False
+
+
+def _init_worker(instance: LSystemInstance, lattice: bool, max_branch_depth: int, record_moves: bool):
+    global _worker_instance, _worker_lattice, _worker_max_branch_depth, _worker_record_moves
+    _worker_instance = instance
+    _worker_lattice = lattice
+    _worker_max_branch_depth = max_branch_depth
+    _worker_record_moves = record_moves
+
+
+def _render_branches(branches: list[tuple[int, int, TurtleState]]) -> list[tuple[list, list, int, int]]:
+    """ Renders a batch of top-level branches inside a pool worker. Every branch is
+        given as the range of its '[' ... ']' pair and the turtle state at the '[' """
+    recorder = LSystemRecordingRenderer()
+    recorder.record_moves = _worker_record_moves
+    recorder.max_branch_depth = _worker_max_branch_depth
+    recorder._begin(_worker_instance, _worker_lattice)
+    l_string = _worker_instance.l_string
+
+    results = []
+    for start, stop, state in branches:
+        _restart(recorder, state)
+        branch = l_string[start:stop + 1]
+        if _worker_max_branch_depth != None:
+            # the branch starts at the top level, so its depths are those of the L-string
+            recorder._walk_pruned(branch, BracketIndex.build(branch))
+        else:
+            recorder._walk(branch)
+        results.append((recorder.ops, recorder.moves, recorder._line_count, recorder._complexity_rating))
+    return results
+
+
+def _restart(recorder: LSystemRecordingRenderer, state: TurtleState):
+    """ Puts the recorder back to top-level depth with the given turtle state and
+        an empty operation list """
+    recorder._turtle_stack = [state]
+    recorder._depth = 0
+    recorder._line_count = 0
+    recorder._complexity_rating = 0
+    recorder._set_state_vars()
+    recorder._reset()
+
+
+def find_top_level_branches(l_string: list[ASTNode]) -> list[tuple[int, int]]:
+    """ Returns the index ranges of all '[' ... ']' pairs which are not nested
+        inside another pair """
+    branches = []
+    depth = 0
+    start = 0
+    for i, node in enumerate(l_string):
+        if type(node) == PushNode:
+            if depth == 0:
+                start = i
+            depth += 1
+        elif type(node) == PopNode:
+            depth -= 1
+            if depth == 0:
+                branches.append((start, i))
+    return branches
+
+
+def render_parallel(renderer: LSystemRenderer, instance: LSystemInstance, processes: int = None, batches_per_process: int = 4, lattice: bool = False):
+    """ Renders an instance like LSystemRenderer.render(), but hands the top-level
+        branches to a process pool.
+
+        The main process only walks the top-level symbols (which is enough to know the
+        turtle state at every top-level '['), the workers walk the branches and return
+        the recorded backend calls, which are then replayed in order into the renderer.
+        Grammars whose transforms call random() are rendered in the calling process,
+        as each worker would draw from a copy of the same random state. If the instance
+        keeps a bracket index, the branches are looked up instead of scanning the
+        L-string.
+
+        The renderer's max_branch_depth, merge_segments and drop_zero_length are
+        honoured: workers skip the pruned branches, and with merging or dropping on
+        they record the moves of their segments, which are merged or dropped in order
+        while replaying. """
+    processes = processes or os.cpu_count() or 1
+    l_string = instance.l_string
+    if instance.bracket_index != None:
+        branches = instance.bracket_index.branches()
+    else:
+        branches = find_top_level_branches(l_string)
+
+    spec = instance.spec
+    randomized = draws_random([spec.length_node.length, spec.width_node.width, spec.color_node.color] + spec.transform_nodes, instance.ctx)
+    pruned = renderer.max_branch_depth != None and renderer.max_branch_depth <= 0
+    if processes < 2 or len(branches) < 2 or randomized or pruned:
+        renderer.render(instance, lattice)
+        return
+    record_moves = renderer.merge_segments or renderer.drop_zero_length
+
+    # group consecutive branches into batches of roughly equal symbol count
+    batch_size = len(l_string) // (processes * batches_per_process) + 1
+
+    # walk the top level, collecting the recorded top-level segments and the
+    # branch batches in the order in which their output has to be replayed
+    recorder = LSystemRecordingRenderer()
+    recorder.record_moves = record_moves
+    recorder._begin(instance, lattice)
+    pieces = []
+    batch = []
+    batch_symbols = 0
+    pos = 0
+
+    initargs = (instance, lattice, renderer.max_branch_depth, record_moves)
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+        for start, stop in branches:
+            recorder._walk(l_string[pos:start])
+            if len(recorder.ops) > 0:
+                if len(batch) > 0:
+                    pieces.append(pool.apply_async(_render_branches, (batch,)))
+                    batch, batch_symbols = [], 0
+                pieces.append([(recorder.ops, recorder.moves, 0, 0)])
+                recorder.ops = []
+                recorder.moves = []
+
+            batch.append((start, stop, recorder._state().clone()))
+            batch_symbols += stop - start + 1
+            if batch_symbols >= batch_size:
+                pieces.append(pool.apply_async(_render_branches, (batch,)))
+                batch, batch_symbols = [], 0
+            pos = stop + 1
+
+        if len(batch) > 0:
+            pieces.append(pool.apply_async(_render_branches, (batch,)))
+        recorder._walk(l_string[pos:])
+        pieces.append([(recorder.ops, recorder.moves, 0, 0)])
+
+        renderer._begin(instance, lattice)
+        renderer._complexity_rating = recorder._complexity_rating
+        if not record_moves:
+            renderer._line_count = recorder._line_count
+        for piece in pieces:
+            results = piece if type(piece) == list else piece.get()
+            for ops, moves, line_count, complexity_rating in results:
+                if record_moves:
+                    # counted by _draw()
+                    renderer._replay_moves(ops, moves)
+                else:
+                    renderer._replay(ops)
+                    renderer._line_count += line_count
+                renderer._complexity_rating += complexity_rating
+        renderer._flush_line()
+
+    renderer._finalize()
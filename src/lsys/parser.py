@@ -1,6 +1,10 @@
 from .tokenizer import *
 from .ast_nodes import *
 
+# Bumped whenever the produced syntax tree (or the specification built from it)
+# changes, so cached specifications created by an older version are not reused
+PARSER_VERSION = 3
+
 # Lookup table for operator priority
 _OPERATOR_PRIORITY = {
     TokenType.PLUS: 0,
@@ -9,8 +13,16 @@ _OPERATOR_PRIORITY = {
     TokenType.SLASH: 1,
 }
 
+# Token types ending a rule string
+_RULE_STRING_END = frozenset([TokenType.BIAS, TokenType.SEMICOLON])
+
 class Parser:
-    """ Recursive descent parser for L-System grammar """
+    """ Recursive descent parser for L-System grammar. Nested expressions are
+        parsed with an explicit stack of productions (see _run()), so the nesting
+        depth of the source is not limited by the recursion limit of Python """
+
+    # see lsys.instrumentation
+    instrumentation = None
     
     def __init__(self):
         self._tokenizer = Tokenizer()
@@ -19,6 +31,13 @@ class Parser:
     def parse(self, string):
         """ Takes a source string and parses it, returning the root node of
             the generated abstract syntax tree """
+        if self.instrumentation != None:
+            with self.instrumentation.span("parse", characters=len(string)):
+                return self._parse(string)
+        return self._parse(string)
+
+
+    def _parse(self, string):
         self._tokenizer.initialize(string)
         self._lookahead = self._tokenizer.get_next_token()
         return self._prod_root()
@@ -29,14 +48,14 @@ class Parser:
         return self._lookahead.token_type == token_type
     
 
-    def _is_next_any(self, token_types: list[TokenType]) -> bool:
+    def _is_next_any(self, token_types: frozenset[TokenType]) -> bool:
         """ Checks if the current lookahead token is one of the specified token types """
         return self._lookahead.token_type in token_types
 
 
     def _is_next_op(self) -> bool:
         """ Checks if the current lookahead token is an operator """
-        return self._lookahead.token_type in _OPERATOR_PRIORITY.keys()
+        return self._lookahead.token_type in _OPERATOR_PRIORITY
     
     def _syntax_error(self, message, raise_as_exception=True, buffered_pos=True):
         """ Raises an exception when the parser encounters a syntax error in the source """
@@ -51,10 +70,16 @@ class Parser:
     def _consume(self, expected_token_type: TokenType, optional=False) -> RawToken:
         """ Consumes a token of the specified token type. If another token type is encountered
             a syntax error is raised (if the optional flag is set, None is returned instead) """
-        return self._consume_any([expected_token_type], optional=optional)
+        token = self._lookahead
+        if token.token_type == expected_token_type:
+            self._lookahead = self._tokenizer.get_next_token()
+            return token
+        if optional:
+            return None
+        return self._consume_any((expected_token_type,))
     
 
-    def _consume_any(self, expected_token_types: list[TokenType], optional=False) -> RawToken:
+    def _consume_any(self, expected_token_types: tuple[TokenType], optional=False) -> RawToken:
         """ Consumes a token of one of the specified token types. If an unspecified token type is encountered
             a syntax error is raised (if the optional flag is set, None is returned instead) """
         token = self._lookahead
@@ -63,7 +88,7 @@ class Parser:
             if optional:
                 return None
             else:
-                self._syntax_error(f"Unexpected end of input, expected '{str(expected_token_type)}'")
+                self._syntax_error(f"Unexpected end of input, expected '{str(list(expected_token_types))}'")
         
         if token.token_type in expected_token_types:
             self._lookahead = self._tokenizer.get_next_token()
@@ -71,13 +96,13 @@ class Parser:
         elif optional:
             return None
         else:
-            self._syntax_error(f"Unexpected token '{str(token.token_type)}', expected: '{str(expected_token_types)}'")
+            self._syntax_error(f"Unexpected token '{str(token.token_type)}', expected: '{str(list(expected_token_types))}'")
 
 
     def _prod_root(self):
         """ Production rule: root node """
         nodes = []
-        while self._lookahead != TokenType.EOF:
+        while self._lookahead.token_type != TokenType.EOF:
             nodes.append(self._prod_decl())
         return RootNode(nodes)
     
@@ -114,7 +139,7 @@ class Parser:
         self._consume(TokenType.TRANSFORM)
 
         # special case for '+' or '-' as transform names, otherwise invalid identifiers
-        plus_or_minus_token = self._consume_any([TokenType.PLUS, TokenType.MINUS], optional=True)
+        plus_or_minus_token = self._consume_any((TokenType.PLUS, TokenType.MINUS), optional=True)
         if plus_or_minus_token != None:
             name_node = IdentifierNode(plus_or_minus_token.value)
         else:
@@ -250,34 +275,33 @@ class Parser:
         rule_elements = []
         push_pop_balance = 0
         begin_stop_fill_balance = 0
-
-        while not self._is_next_any([TokenType.BIAS, TokenType.SEMICOLON]):
-            next_node = None
-            if self._is_next(TokenType.IDENTIFIER):
-                next_node = self._prod_id()
-            elif self._is_next(TokenType.OPEN_BRACKET):
-                next_node = self._prod_push()
+        tokenizer = self._tokenizer
+
+        while self._lookahead.token_type not in _RULE_STRING_END:
+            token = self._lookahead
+            token_type = token.token_type
+            if token_type == TokenType.IDENTIFIER or token_type == TokenType.PLUS or token_type == TokenType.MINUS:
+                next_node = IdentifierNode(token.value)
+            elif token_type == TokenType.OPEN_BRACKET:
+                next_node = PushNode()
                 push_pop_balance += 1
-            elif self._is_next(TokenType.CLOSE_BRACKET):
-                next_node = self._prod_pop()
+            elif token_type == TokenType.CLOSE_BRACKET:
+                next_node = PopNode()
                 push_pop_balance -= 1
-            elif self._is_next(TokenType.OPEN_CURLY):
-                next_node = self._prod_begin_fill()
+            elif token_type == TokenType.OPEN_CURLY:
+                next_node = BeginFillNode()
                 begin_stop_fill_balance += 1
-            elif self._is_next(TokenType.CLOSE_CURLY):
-                next_node = self._prod_stop_fill()
+            elif token_type == TokenType.CLOSE_CURLY:
+                next_node = StopFillNode()
                 begin_stop_fill_balance -= 1
-            elif self._is_next(TokenType.PLUS) or self._is_next(TokenType.MINUS):
-                next_token = self._consume_any([TokenType.PLUS, TokenType.MINUS])
-                next_node = IdentifierNode(next_token.value)
+            else:
+                self._syntax_error(f"Unexpected token type '{str(token_type)}")
+            self._lookahead = tokenizer.get_next_token()
             
             if push_pop_balance < 0:
                 self._syntax_error("Unmatched closing ']'")
             if begin_stop_fill_balance < 0:
                 self._syntax_error("Unmatched closing '}'")
-
-            if next_node == None:
-                self._syntax_error(f"Unexpected token type '{str(self._lookahead.token_type)}")
             
             rule_elements.append(next_node)
         
@@ -289,64 +313,71 @@ class Parser:
         return rule_elements
 
 
-    def _prod_push(self):
-        """ Production rule: rule string push operator """
-        self._consume(TokenType.OPEN_BRACKET)
-        return PushNode()
-    
-
-    def _prod_pop(self):
-        """ Production rule: rule string pop operator """
-        self._consume(TokenType.CLOSE_BRACKET)
-        return PopNode()
-
-    
-
-    def _prod_begin_fill(self):
-        self._consume(TokenType.OPEN_CURLY)
-        return BeginFillNode()
-    
-
-    def _prod_stop_fill(self):
-        self._consume(TokenType.CLOSE_CURLY)
-        return StopFillNode()
-
-
     def _prod_eval(self, op_mode=False):
+        """ Production rule: generic evaluated node """
+        if self._lookahead.token_type == TokenType.NUM:
+            # plain numbers don't need the production stack
+            node = self._prod_num()
+            if op_mode or not self._is_next_op():
+                return node
+            return self._run(self._expr_steps(node))
+        return self._run(self._eval_steps(op_mode))
+
+
+    def _run(self, production):
+        """ Runs a production given as a generator. Productions yield the generators
+            of the productions they depend on and are sent back their results, so
+            nesting grows a list instead of the call stack """
+        stack = [production]
+        result = None
+        while True:
+            try:
+                dependency = stack[-1].send(result)
+            except StopIteration as stop:
+                stack.pop()
+                if len(stack) == 0:
+                    return stop.value
+                result = stop.value
+                continue
+            stack.append(dependency)
+            result = None
+
+
+    def _eval_steps(self, op_mode=False):
         """ Production rule: generic evaluated node """
         lookahead_type = self._lookahead.token_type
         node = None
 
-        if self._is_next(TokenType.NUM): # numbers
+        if lookahead_type == TokenType.NUM: # numbers
             node = self._prod_num()
-        elif self._is_next(TokenType.IDENTIFIER): # identifiers (eg. var names)
+        elif lookahead_type == TokenType.IDENTIFIER: # identifiers (eg. var names)
             id_node = self._prod_id()
             if self._is_next(TokenType.OPEN_PAREN): # parentheses after id -> function
-                node = self._prod_function(id_node)
+                node = yield self._function_steps(id_node)
             else:
                 node = id_node
-        elif self._is_next(TokenType.OPEN_PAREN): # bracket term (aka group)
-            node = self._prod_group()
-        elif self._is_next(TokenType.MINUS): # negated value
-            node = self._prod_neg_eval()
+        elif lookahead_type == TokenType.OPEN_PAREN: # bracket term (aka group)
+            node = yield self._group_steps()
+        elif lookahead_type == TokenType.MINUS: # negated value
+            node = yield self._neg_eval_steps()
         
         if node == None:
             self._syntax_error(f"Unexpected token: '{str(lookahead_type)}', expected value")
 
         # if next token is operator, node is part of a math expression
         if not op_mode and self._is_next_op():
-            node = self._prod_expr(node)
+            node = yield self._expr_steps(node)
         
         return node
 
 
-    def _prod_neg_eval(self):
+    def _neg_eval_steps(self):
         """ Production rule: negation eval node """
         self._consume(TokenType.MINUS)
-        return NegOpNode(10, self._prod_eval())
+        return NegOpNode(10, (yield self._eval_steps()))
 
 
-    def _prod_expr(self, start_node):
+    def _expr_steps(self, start_node):
         """ Production rule: math expression eval node """
         # start with first left sided operand
         stack = [start_node]
@@ -357,7 +388,10 @@ class Parser:
             op_token_type = self._lookahead.token_type
             self._consume(op_token_type)
             stack.append(op_token_type)
-            stack.append(self._prod_eval(op_mode=True)) # op mode to avoid recursively calling _prod_expr()
+            if self._lookahead.token_type == TokenType.NUM:
+                stack.append(self._prod_num())
+            else:
+                stack.append((yield self._eval_steps(op_mode=True))) # op mode to avoid starting another expression
 
             # if another operator is coming up, check if it has higher priority.
             # if it has not, produce operations down the stack until the operation on top
@@ -396,15 +430,15 @@ class Parser:
             raise Exception(f"Parser: Unsupported operator '{str(op_type)}'")
 
 
-    def _prod_group(self):
+    def _group_steps(self):
         """ Production rule: bracket term node """
         self._consume(TokenType.OPEN_PAREN)
-        content_node = self._prod_eval()
+        content_node = yield self._eval_steps()
         self._consume(TokenType.CLOSE_PAREN)
         return GroupNode(content_node)
 
 
-    def _prod_function(self, name_node):
+    def _function_steps(self, name_node):
         """ Production rule: function call node """
         self._consume(TokenType.OPEN_PAREN)
 
@@ -416,7 +450,7 @@ class Parser:
 
         while not param_list_ends:
             # as long as we don't see closing parentheses, we expect a list of eval nodes
-            param_list.append(self._prod_eval())
+            param_list.append((yield self._eval_steps()))
 
             if self._consume(TokenType.CLOSE_PAREN, optional=True) != None:
                 param_list_ends = True
@@ -436,3 +470,20 @@ class Parser:
         """ Production rule: identifier node """
         token = self._consume(token_type)
         return IdentifierNode(token.value)
+
+
+def _parse_source(source: str):
+    try:
+        return Parser().parse(source)
+    except Exception as e:
+        return e
+
+
+def parse_sources(sources: list[str], processes: int = None) -> list:
+    """ Parses several sources with a process pool. Returns the root node for every
+        source, or the exception raised while parsing it """
+    if processes == 1 or len(sources) < 2:
+        return [_parse_source(source) for source in sources]
+    import multiprocessing
+    with multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(sources))) as pool:
+        return pool.map(_parse_source, sources, chunksize=1)
@@ -0,0 +1,243 @@
+from .instance import LSystemInstance
+from .ast_nodes import *
+from .runtime_context import *
+from .renderer import LSystemRenderer, LSystemRecordingRenderer
+import queue
+import threading
+import time
+
+
+# Marks the end of a stage's output
+_DONE = object()
+# Follows the last symbol chunk
+_LAST = object()
+
+
+def draws_random(nodes: list[ASTNode], ctx: EvalContext) -> bool:
+    """ Checks if evaluating any of the expressions can call random(), following
+        variables to their definitions """
+    pending = list(nodes)
+    visited = set()
+    while len(pending) > 0:
+        for node in walk(pending.pop()):
+            if type(node) == FunctionNode and node.name.ident == "random":
+                return True
+            if type(node) == IdentifierNode and node.ident not in visited:
+                visited.add(node.ident)
+                if node.ident in ctx.vars:
+                    pending.append(ctx.vars[node.ident])
+    return False
+
+
+class LSystemPipeline:
+    """ Expands and renders an instance with three overlapping stages, connected by
+        bounded queues:
+
+            expansion: derives all but the last generation as usual, then rewrites
+                the second to last generation into the last one chunk by chunk,
+                without ever storing the last generation
+            turtle: walks the symbol chunks, producing batches of recorded backend
+                calls
+            writer: replays the batches into the renderer (in the calling thread)
+
+        Expansion and turtle run on threads. With LSystemStreamingSVGRenderer, the
+        memory held at any time is bounded by the queue sizes, apart from the second
+        to last generation.
+
+        Rule selection and transforms draw from the same random state, so if any
+        transform can call random(), the turtle stage doesn't start before the
+        expansion is done, and the result equals a sequential render.
+
+        The merge_segments and drop_zero_length settings of the renderer, and the
+        optimization of the instance, are honoured. max_branch_depth is not, as the
+        last generation has no bracket index. """
+
+    def __init__(self, chunk_size: int = 4096, queue_size: int = 8):
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.stats: dict = {}
+        # random state of the instance before the streamed last generation
+        self._rng_state: tuple = None
+
+
+    def run(self, instance: LSystemInstance, renderer: LSystemRenderer, iterations: int = None, lattice: bool = False):
+        """ Expands the instance from the axiom and renders the last generation.
+            Unless the expansion ended early, the instance is left at the second to last
+            generation afterwards, including its iteration count and random state, so
+            advancing it derives the same last generation again """
+        self._rng_state = None
+        instance.reset()
+        instance.begin(iterations)
+        if renderer.max_branch_depth != None:
+            raise Exception("LSystemPipeline can't render with max_branch_depth")
+        recorder = LSystemRecordingRenderer()
+        recorder.merge_segments = renderer.merge_segments
+        recorder.drop_zero_length = renderer.drop_zero_length
+        recorder._begin(instance, lattice)
+        default_transform = recorder._default_transform
+        transform_nodes = [default_transform] + instance.spec.transform_nodes
+        overlapped = not draws_random(transform_nodes, instance.ctx)
+
+        # without overlap, the symbol queue has to hold the whole last generation
+        symbol_queue = queue.Queue(self.queue_size if overlapped else 0)
+        op_queue = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        expansion_done = threading.Event()
+        errors = []
+        self.stats = {
+            "overlapped": overlapped,
+            "symbols": 0,
+            "chunks": 0,
+            "batches": 0,
+            "expansion_time": 0.0,
+            "turtle_time": 0.0,
+            "writer_time": 0.0,
+        }
+
+        def expansion_stage():
+            start = time.perf_counter()
+            for chunk in self._final_generation_chunks(instance, stop):
+                self.stats["symbols"] += len(chunk)
+                self.stats["chunks"] += 1
+                _put(symbol_queue, chunk, stop)
+            # draws the segment held back for merging
+            _put(symbol_queue, _LAST, stop)
+            expansion_done.set()
+            self.stats["expansion_time"] = time.perf_counter() - start
+
+        def turtle_stage():
+            if not overlapped:
+                while not expansion_done.wait(0.1):
+                    if stop.is_set():
+                        raise _Stopped()
+            start = time.perf_counter()
+            while True:
+                chunk = _get(symbol_queue, stop)
+                if chunk is _DONE:
+                    break
+                if chunk is _LAST:
+                    recorder._flush_line()
+                else:
+                    recorder._walk(chunk)
+                if len(recorder.ops) > 0:
+                    _put(op_queue, recorder.ops, stop)
+                    self.stats["batches"] += 1
+                    recorder.ops = []
+            self.stats["turtle_time"] = time.perf_counter() - start
+
+        renderer._begin(instance, lattice)
+        threads = [
+            threading.Thread(target=_run_stage, args=(expansion_stage, symbol_queue, stop, errors), name="lsys-expansion", daemon=True),
+            threading.Thread(target=_run_stage, args=(turtle_stage, op_queue, stop, errors), name="lsys-turtle", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            start = time.perf_counter()
+            while True:
+                ops = _get(op_queue, stop)
+                if ops is _DONE:
+                    break
+                renderer._replay(ops)
+            renderer._line_count = recorder._line_count
+            renderer._complexity_rating = recorder._complexity_rating
+            renderer._finalize()
+            self.stats["writer_time"] = time.perf_counter() - start
+        except _Stopped:
+            pass
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            # the last generation was streamed, not stored
+            if self._rng_state != None:
+                instance.ctx.rng.setstate(self._rng_state)
+        # report the error that stopped the pipeline, not the ones it caused
+        if len(errors) > 0:
+            raise errors[0]
+
+
+    def _final_generation_chunks(self, instance: LSystemInstance, stop: threading.Event):
+        """ Yields the last generation in chunks. If it has to be derived, the instance
+            stays at the previous generation, whose random state is kept for run() to
+            restore """
+        if instance._max_iterations > 0:
+            instance.advance(instance._max_iterations - 1)
+        if instance._iteration_count == instance._max_iterations or instance._exhausted:
+            for start in range(0, len(instance.l_string), self.chunk_size):
+                yield instance.l_string[start:start + self.chunk_size]
+            return
+
+        self._rng_state = instance.ctx.rng.getstate()
+        select_rule = instance._rule_selector()
+        # stripped symbols still count as matching (see LSystemInstance.advance())
+        optimization = instance.optimization
+        some_rule_matched = optimization != None and len(instance._stripped) > 0
+        chunk = []
+        for node in instance.l_string:
+            if stop.is_set():
+                raise _Stopped()
+            if issubclass(type(node), IdentifierNode):
+                chosen_rule = select_rule(node.ident, instance.ctx)
+                if chosen_rule != None:
+                    some_rule_matched = True
+                    chunk += chosen_rule.rule_elements
+                else:
+                    chunk.append(node)
+            else:
+                chunk.append(node)
+            if len(chunk) >= self.chunk_size:
+                yield self._strip(optimization, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield self._strip(optimization, chunk)
+
+        if not some_rule_matched:
+            # the last generation equals the previous one
+            instance._exhausted = True
+
+
+    def _strip(self, optimization, chunk: list[ASTNode]) -> list[ASTNode]:
+        """ Strips a chunk of the last generation like LSystemInstance does """
+        if optimization == None:
+            return chunk
+        return optimization.strip(chunk, True)[0]
+
+
+class _Stopped(Exception):
+    """ Raised in a stage when another stage failed """
+    pass
+
+
+def _run_stage(stage, out_queue: queue.Queue, stop: threading.Event, errors: list):
+    """ Runs a stage and signals its end to the next stage. On failure, all
+        stages are stopped """
+    try:
+        stage()
+    except _Stopped:
+        return
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+        return
+    _put(out_queue, _DONE, stop)
+
+
+def _put(out_queue: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(in_queue: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return in_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
@@ -0,0 +1,102 @@
+from dataclasses import dataclass
+import threading
+import time
+
+
+# Symbols walked or expanded between two progress checks
+PROGRESS_CHUNK = 4096
+
+
+class Cancelled(Exception):
+    """ Raised by LSystemInstance.iterate() and LSystemRenderer.render() once their
+        cancellation token is set """
+    pass
+
+
+class CancellationToken:
+    """ Stops expansions and renders at their next chunk boundary once cancelled,
+        which can be done from any thread. To cancel from another process, pass an
+        event shared with it, like a multiprocessing.Manager().Event() """
+
+    def __init__(self, event=None):
+        self._event = event if event != None else threading.Event()
+
+
+    def cancel(self):
+        self._event.set()
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+    def cancel_after(self, seconds: float) -> threading.Timer:
+        """ Cancels once the given time has passed. Returns the timer, which can be
+            stopped with cancel() """
+        timer = threading.Timer(seconds, self.cancel)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+@dataclass
+class Progress:
+    """ Passed to progress callbacks:
+            stage: 'expand' or 'render'
+            generation: generation being derived (starting at 1) or rendered
+            generations: number of iterations expanded to
+            symbols: symbols processed so far, of the previous generation when
+                expanding and of the rendered one when rendering
+            total_symbols: symbols of that generation, None at generation boundaries
+                of an expansion
+            segments: segments emitted so far
+            elapsed: seconds since the stage started
+            done: set in the last report of a stage, which is always made """
+    stage: str
+    generation: int
+    generations: int
+    symbols: int
+    total_symbols: int
+    segments: int
+    elapsed: float
+    done: bool = False
+
+
+    @property
+    def fraction(self) -> float:
+        """ Part of the current generation processed, None if not known """
+        if self.total_symbols == None:
+            return None
+        return self.symbols / self.total_symbols if self.total_symbols > 0 else 1.0
+
+
+class ProgressTracker:
+    """ Checks the cancellation token and reports to the callback, at most once per
+        interval (in seconds). Used by LSystemInstance and LSystemRenderer while
+        iterating or rendering with a callback or a token """
+
+    def __init__(self, stage: str, callback=None, cancel: CancellationToken = None, interval: float = 1.0, generations: int = 0):
+        self.stage = stage
+        self.callback = callback
+        self.cancel = cancel
+        self.interval = interval
+        self.generations = generations
+        self._start = time.perf_counter()
+        self._next_report = self._start + interval
+
+
+    def check(self, generation: int, symbols: int, total_symbols: int = None, segments: int = 0):
+        if self.cancel != None and self.cancel.cancelled:
+            raise Cancelled(f"Cancelled while {'expanding' if self.stage == 'expand' else 'rendering'} generation {generation}")
+        if self.callback != None:
+            now = time.perf_counter()
+            if now >= self._next_report:
+                self._next_report = now + self.interval
+                self.callback(Progress(self.stage, generation, self.generations, symbols, total_symbols, segments, now - self._start))
+
+
+    def finish(self, generation: int, symbols: int, segments: int = 0):
+        if self.callback != None:
+            elapsed = time.perf_counter() - self._start
+            self.callback(Progress(self.stage, generation, self.generations, symbols, symbols, segments, elapsed, True))
@@ -0,0 +1,86 @@
+from .parser import Parser
+from .interpreter import LSystemSpecification
+from .instance import LSystemInstance
+from .renderer import LSystemRenderer, LSystemRecordingRenderer
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+import threading
+import time
+
+
+@dataclass
+class RenderJob:
+    source: str
+    seed: int = None
+    iterations: int = None
+    renderer_factory: Callable[[], LSystemRenderer] = LSystemRecordingRenderer
+
+
+@dataclass
+class RenderResult:
+    job: RenderJob
+    instance: LSystemInstance = None
+    renderer: LSystemRenderer = None
+    error: Exception = None
+    timings: dict = field(default_factory=dict)
+
+
+class _SpecificationTable:
+    """ Thread-safe table of specifications, each unique source is parsed once """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._specs: dict[str, LSystemSpecification] = {}
+        self._source_locks: dict[str, threading.Lock] = {}
+
+
+    def get(self, source: str) -> LSystemSpecification:
+        with self._lock:
+            spec = self._specs.get(source)
+            if spec != None:
+                return spec
+            source_lock = self._source_locks.setdefault(source, threading.Lock())
+
+        with source_lock:
+            with self._lock:
+                spec = self._specs.get(source)
+            if spec == None:
+                # parsers keep state while parsing, so every parse gets its own
+                spec = LSystemSpecification.create(Parser().parse(source))
+                spec._build_lookup_tables()
+                with self._lock:
+                    self._specs[source] = spec
+            return spec
+
+
+def render_job(job: RenderJob, specs: _SpecificationTable = None) -> RenderResult:
+    """ Parses (unless the specification is already known), expands and renders a job """
+    result = RenderResult(job)
+    try:
+        start = time.perf_counter()
+        spec = specs.get(job.source) if specs != None else LSystemSpecification.create(Parser().parse(job.source))
+        result.timings["parse"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result.instance = LSystemInstance(spec, seed=job.seed)
+        result.instance.iterate(job.iterations)
+        result.timings["iterate"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result.renderer = job.renderer_factory()
+        result.renderer.render(result.instance)
+        result.timings["render"] = time.perf_counter() - start
+    except Exception as e:
+        result.error = e
+    return result
+
+
+def render_many(jobs: list[RenderJob], max_workers: int = None) -> list[RenderResult]:
+    """ Renders many jobs concurrently in a thread pool, returning the results in job
+        order. Jobs with the same source share one specification; instances, random
+        states and renderers are never shared between jobs. Errors are reported in the
+        results instead of being raised """
+    specs = _SpecificationTable()
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(lambda job: render_job(job, specs), jobs))
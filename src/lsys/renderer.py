@@ -1,12 +1,85 @@
 from .instance import LSystemInstance
 from .ast_nodes import *
 from .runtime_context import *
-import svgwrite
+from .lattice import build_lattice_plan
+from .bracket_index import BracketIndex
+from .progress import ProgressTracker, CancellationToken, Cancelled, PROGRESS_CHUNK
+import importlib
 import math
+import os
+import shutil
+import sys
+import tempfile
+
+
+# Operation codes used by LSystemRecordingRenderer
+OP_LINE = 0
+OP_START_POLYGON = 1
+OP_STOP_POLYGON = 2
+
+# SVG units per turtle unit
+SVG_SCALE = 50
+
+# Renderer backends by name, as module and class name. A backend's module is only
+# imported once it is selected (see renderer_class()), so svgwrite is not loaded by
+# runs which don't use LSystemSVGRenderer. Every backend takes the output file
+# name as its only argument
+RENDERER_BACKENDS: dict[str, tuple[str, str]] = {
+    "svg": ("lsys.svg_renderer", "LSystemSVGRenderer"),
+    "svg-stream": ("lsys.renderer", "LSystemStreamingSVGRenderer"),
+    "debug": ("lsys.renderer", "LSystemDebugPrintRenderer"),
+}
+
+# Names which moved to another module, still importable from here
+_MOVED = {
+    "LSystemSVGRenderer": "lsys.svg_renderer",
+}
+
+
+def register_renderer(name: str, module_name: str, class_name: str):
+    """ Adds a backend to RENDERER_BACKENDS, without importing its module """
+    RENDERER_BACKENDS[name] = (module_name, class_name)
+
+
+def renderer_class(name: str) -> type:
+    """ Imports the module of a backend and returns its renderer class """
+    if name not in RENDERER_BACKENDS:
+        raise Exception(f"Unknown renderer backend '{name}', available: {', '.join(RENDERER_BACKENDS)}")
+    module_name, class_name = RENDERER_BACKENDS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_renderer(name: str, file_name: str = None) -> "LSystemRenderer":
+    return renderer_class(name)(file_name)
+
+
+def svg_rgb(r, g, b) -> str:
+    """ SVG color of color components, formatted like svgwrite.rgb() """
+    return f"rgb({int(r) & 255},{int(g) & 255},{int(b) & 255})"
+
+
+def __getattr__(name: str):
+    if name in _MOVED:
+        return getattr(importlib.import_module(_MOVED[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class LSystemRenderer:
 
+    # see lsys.instrumentation
+    instrumentation = None
+    # if set, branches opened at this turtle depth or deeper are skipped
+    max_branch_depth = None
+    # set while render() reports progress or can be cancelled
+    _progress: ProgressTracker = None
+    # if set, forward moves continuing the previous segment in the same direction
+    # and style are joined with it before they reach the backend (see _merge_line())
+    merge_segments = False
+    # segment held back while merging: x1, y1, x2, y2, width, color, heading
+    _pending_line: tuple = None
+    # if set, segments of zero length are not drawn (see lsys.optimizer)
+    drop_zero_length = False
+
     _turtle_stack: list[TurtleState]
     _ctx: EvalContext
     _depth: int
@@ -42,48 +115,221 @@ class LSystemRenderer:
 
     
     def _apply_transform(self, transform_node: TransformDeclarationNode):
+        if self.instrumentation != None:
+            self.instrumentation.transform_applied(transform_node)
         self._complexity_rating += self._depth
         prev_state = self._state()
-        self._update(transform_node.apply(prev_state, self._ctx))
+        if self._lattice != None:
+            self._update(self._lattice.apply(transform_node, prev_state))
+        else:
+            self._update(transform_node.apply(prev_state, self._ctx))
         if issubclass(type(transform_node), ForwardTranslateTransformNode | AbsTranslateTransformNode):
             width = transform_node.width.eval(self._ctx)
             color = transform_node.color.rgb(self._ctx)
-            self._line(prev_state.x, prev_state.y, self._state().x, self._state().y, width, color)
+            self._draw(transform_node, prev_state, self._state(), width, color)
+
+
+    def _draw(self, transform_node: TransformDeclarationNode, start: TurtleState, end: TurtleState, width, color):
+        """ Draws the segment of a move, unless it is dropped or merged """
+        if self.drop_zero_length and start.x == end.x and start.y == end.y:
+            return
+        if self.merge_segments:
+            self._merge_line(transform_node, start, end, width, color)
+            return
+        self._line(start.x, start.y, end.x, end.y, width, color)
+        self._line_count += 1
+
+
+    def _merge_line(self, transform_node: TransformDeclarationNode, start: TurtleState, end: TurtleState, width, color):
+        """ Joins a segment with the pending one if it is a forward move starting
+            where the pending one ends, with the same heading, width and color, and
+            not reversing it. Otherwise the pending segment is drawn and this one is
+            held back instead """
+        pending = self._pending_line
+        if pending != None and type(transform_node) == ForwardTranslateTransformNode and pending[6] == end.heading \
+                and pending[2] == start.x and pending[3] == start.y and pending[4] == width and pending[5] == color \
+                and (end.x - start.x) * (pending[2] - pending[0]) + (end.y - start.y) * (pending[3] - pending[1]) >= 0:
+            self._pending_line = (pending[0], pending[1], end.x, end.y, width, color, end.heading)
+            return
+        self._flush_line()
+        if type(transform_node) == ForwardTranslateTransformNode:
+            self._pending_line = (start.x, start.y, end.x, end.y, width, color, end.heading)
+        else:
+            self._line(start.x, start.y, end.x, end.y, width, color)
             self._line_count += 1
 
 
-    def render(self, instance: LSystemInstance):
-        self._turtle_stack: list[TurtleState] = [TurtleState(0.0, 0.0, math.pi / 2.0)]
+    def _flush_line(self):
+        """ Draws the segment held back by _merge_line() """
+        if self._pending_line != None:
+            x1, y1, x2, y2, width, color, _ = self._pending_line
+            self._pending_line = None
+            self._line(x1, y1, x2, y2, width, color)
+            self._line_count += 1
+
+
+    def render(self, instance: LSystemInstance, lattice: bool = False, progress=None, cancel: CancellationToken = None, progress_interval: float = 1.0):
+        """ Walks the L-string of an instance with the turtle. With lattice set, an exact
+            lattice turtle is used if the specification allows it (see lsys.lattice),
+            which is reported in lattice_active.
+
+            progress is called with a lsys.progress.Progress at most every
+            progress_interval seconds and once at the end. If cancel is set, the walk
+            stops with Cancelled and the output is abandoned (see _abort()). Both are
+            checked every PROGRESS_CHUNK symbols """
+        if progress == None and cancel == None:
+            self._render(instance, lattice)
+            return
+        self._progress = ProgressTracker("render", progress, cancel, progress_interval, instance._iteration_count)
+        try:
+            self._render(instance, lattice)
+            self._progress.finish(instance._iteration_count, len(instance.l_string), self._line_count)
+        except Cancelled:
+            self._abort()
+            raise
+        finally:
+            self._progress = None
+
+
+    def _render(self, instance: LSystemInstance, lattice: bool):
+        if self.instrumentation != None:
+            with self.instrumentation.span("render:walk"):
+                self._begin(instance, lattice)
+                self._walk_instance(instance, lattice)
+            with self.instrumentation.span("render:finalize", lines=self._line_count):
+                self._finalize()
+            return
+        self._begin(instance, lattice)
+        self._walk_instance(instance, lattice)
+        self._finalize()
+
+
+    def _walk_instance(self, instance: LSystemInstance, lattice: bool):
+        if self.max_branch_depth != None:
+            index = instance.bracket_index if instance.bracket_index != None else BracketIndex.build(instance.l_string)
+            self._walk_pruned(instance.l_string, index)
+        elif self._progress != None:
+            self._walk_range(instance.l_string, 0, len(instance.l_string))
+        elif instance.compiled != None and not lattice and self.instrumentation == None and not self.merge_segments \
+                and not self.drop_zero_length and self._uses_default_walk() and instance._max_iterations != None:
+            instance.compiled.walk(self, instance)
+        else:
+            self._walk(instance.l_string)
+        if self._pending_line != None:
+            self._flush_line()
+        if self._progress != None:
+            # once more before _finalize(), which may take a while as well
+            self._walked_symbols = len(instance.l_string)
+            self._check_cancelled()
+
+
+    def _walk_pruned(self, l_string: list[ASTNode], index: BracketIndex):
+        """ Walks like _walk(), jumping over the branches skipped because of
+            max_branch_depth with the bracket index """
+        position = 0
+        for start, stop in index.branches_from_depth(self.max_branch_depth):
+            self._walk_range(l_string, position, start)
+            position = stop + 1
+        self._walk_range(l_string, position, len(l_string))
+
+
+    def _walk_range(self, l_string: list[ASTNode], start: int, stop: int):
+        """ Walks l_string[start:stop], in chunks while tracking progress """
+        if self._progress == None:
+            self._walk(l_string[start:stop])
+            return
+        generation = self._progress.generations
+        for position in range(start, stop, PROGRESS_CHUNK):
+            self._progress.check(generation, position, len(l_string), self._line_count)
+            self._walk(l_string[position:min(position + PROGRESS_CHUNK, stop)])
+
+
+    def _check_cancelled(self):
+        """ Raises Cancelled once the render is cancelled. Also called by backends every
+            PROGRESS_CHUNK items while finalizing, as that can take as long as the walk """
+        if self._progress != None:
+            self._progress.check(self._progress.generations, self._walked_symbols, self._walked_symbols, self._line_count)
+
+
+    def _uses_default_walk(self) -> bool:
+        """ Compiled walks can only replace _walk() and _apply_transform() if they
+            are not overridden """
+        return type(self)._walk is LSystemRenderer._walk and type(self)._apply_transform is LSystemRenderer._apply_transform
+
+
+    def _begin(self, instance: LSystemInstance, lattice: bool = False):
+        self._spec = instance.spec
         self._ctx = EvalContext.create_from(instance.ctx)
+        self._ctx.instrumentation = self.instrumentation
         self._depth = 0
         self._complexity_rating = 0
         self._line_count = 0
+        self._pending_line = None
         self._default_transform = ForwardTranslateTransformNode(
             "?", 
             instance.spec.length_node.length,
             instance.spec.width_node.width,
             instance.spec.color_node.color
             )
+        self._lattice = build_lattice_plan(instance.spec, self._ctx, self._default_transform) if lattice else None
+        self.lattice_active = self._lattice != None
+        if self._lattice != None:
+            self._turtle_stack: list[TurtleState] = [self._lattice.initial_state()]
+        else:
+            self._turtle_stack: list[TurtleState] = [TurtleState(0.0, 0.0, math.pi / 2.0)]
         self._set_state_vars()
         self._reset()
 
-        for node in instance.l_string:
+
+    def _walk(self, l_string: list[ASTNode]):
+        for node in l_string:
             if type(node) == PushNode:
                 self._push()
             elif type(node) == PopNode:
                 self._pop()
             elif type(node) == BeginFillNode:
+                if self._pending_line != None:
+                    self._flush_line()
                 self._start_polygon()
             elif type(node) == StopFillNode:
+                if self._pending_line != None:
+                    self._flush_line()
                 self._stop_polygon()
             elif type(node) == IdentifierNode:
-                transform = instance.spec.get_transform(node.ident)
+                transform = self._spec.get_transform(node.ident)
                 if transform != None:
                     self._apply_transform(transform)
                 else:
                     self._apply_transform(self._default_transform)
-        
-        self._finalize()
+
+
+    def _replay(self, ops: list[tuple]):
+        """ Feeds backend calls captured by a LSystemRecordingRenderer into this renderer """
+        for op in ops:
+            if op[0] == OP_LINE:
+                self._line(*op[1:])
+            elif op[0] == OP_START_POLYGON:
+                self._start_polygon()
+            elif op[0] == OP_STOP_POLYGON:
+                self._stop_polygon()
+
+
+    def _replay_moves(self, ops: list[tuple], moves: list[tuple]):
+        """ Replays backend calls recorded with record_moves set, passing the
+            segments through _draw(), which counts them """
+        line = 0
+        for op in ops:
+            if op[0] == OP_LINE:
+                _, x1, y1, x2, y2, width, color = op
+                transform_node, heading = moves[line]
+                line += 1
+                self._draw(transform_node, TurtleState(x1, y1, heading), TurtleState(x2, y2, heading), width, color)
+            elif op[0] == OP_START_POLYGON:
+                self._flush_line()
+                self._start_polygon()
+            elif op[0] == OP_STOP_POLYGON:
+                self._flush_line()
+                self._stop_polygon()
 
     ####################
     # Template Methods #
@@ -109,80 +355,159 @@ class LSystemRenderer:
         pass
 
 
+    def _abort(self):
+        """ Called instead of _finalize() when a render is cancelled, to release what
+            _reset() acquired """
+        pass
+
+
+class LSystemRecordingRenderer(LSystemRenderer):
+    """ Records the backend calls of a turtle walk, so they can be replayed
+        into another renderer later on (or in another process) """
+
+    # if set, the transform and heading of every segment are recorded in moves, so
+    # that replaying them with _replay_moves() merges or drops segments like a walk.
+    # Only valid if the recorder itself neither merges nor drops segments
+    record_moves = False
+
+
+    def _reset(self):
+        self.ops = []
+        self.moves = []
+
+
+    def _draw(self, transform_node: TransformDeclarationNode, start: TurtleState, end: TurtleState, width, color):
+        if self.record_moves:
+            self.moves.append((transform_node, end.heading))
+        super()._draw(transform_node, start, end, width, color)
+
+
+    def _line(self, x1, y1, x2, y2, width, color):
+        self.ops.append((OP_LINE, x1, y1, x2, y2, width, color))
+
+
+    def _start_polygon(self):
+        self.ops.append((OP_START_POLYGON,))
+
+
+    def _stop_polygon(self):
+        self.ops.append((OP_STOP_POLYGON,))
+
+
+def svg_bounds(ops: list[tuple], bounds: list[float] = None) -> list[float]:
+    """ Extends bounds (lowest x, lowest y, highest x, highest y in SVG coordinates, as
+        computed by LSystemSVGRenderer) by the lines of recorded operations """
+    min_x, min_y, max_x, max_y = bounds if bounds != None else (0, 0, 0, 0)
+    for op in ops:
+        if op[0] == OP_LINE:
+            _, x1, y1, x2, y2, _, _ = op
+            min_x = min(min_x, x1, x2)
+            min_y = min(min_y, -y1, -y2)
+            max_x = max(max_x, x1, x2)
+            max_y = max(max_y, -y1, -y2)
+    return [min_x, min_y, max_x, max_y]
+
+
 class LSystemDebugPrintRenderer(LSystemRenderer):
+    """ Prints every line drawn, to a file if a name is given """
+
+    def __init__(self, file_name: str = None):
+        self._file_name = file_name
+
+
+    def _reset(self):
+        self._file = open(self._file_name, "w", encoding="utf-8") if self._file_name != None else sys.stdout
+
 
     def _line(self, x1, y1, x2, y2, width, color):
-        print(f"({x1}, {y1}) --> ({x2}, {y2}) width={width}, rgb={color}")
+        print(f"({x1}, {y1}) --> ({x2}, {y2}) width={width}, rgb={color}", file=self._file)
+
+
+    def _finalize(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+    def _abort(self):
+        self._finalize()
+
+
+class LSystemStreamingSVGRenderer(LSystemRenderer):
+    """ Renders to an SVG file, writing every line as soon as it is drawn, so no
+        geometry is kept in memory. Coordinates are not moved into the drawn extent
+        like by LSystemSVGRenderer, instead the size and viewBox attributes are
+        patched into space reserved in the <svg> tag once the extent is known.
+        Polygons are spooled to a temporary file and appended after the lines """
+
+    # room for the size and viewBox attributes
+    _RESERVED = 256
 
 
-class LSystemSVGRenderer(LSystemRenderer):
-    
     def __init__(self, file_name: str):
         self._file_name = file_name
 
 
     def _reset(self):
         self._bounds = [0, 0, 0, 0]
-        self._lines = []
-        self._polygon_mode = False
+        self._file = open(self._file_name, "w", encoding="utf-8")
+        self._file.write('<?xml version="1.0" encoding="utf-8" ?>\n<svg baseProfile="full" version="1.1" '
+            'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink"')
+        self._reserved_offset = self._file.tell()
+        self._file.write(" " * self._RESERVED + "><defs />")
+        self._polygon_file = None
+        self._polygon_points = None
         self._polygon_close = (0, 0)
-        self._polygons = []
 
 
     def _line(self, x1, y1, x2, y2, width, color):
-        line = (x1, -y1, x2, -y2, width, color)
-        if self._polygon_mode:
-            self._polygons[-1].append((line[0], line[1]))
-            self._polygon_close = (line[2], line[3])
+        x1, y1, x2, y2 = x1 * SVG_SCALE, -y1 * SVG_SCALE, x2 * SVG_SCALE, -y2 * SVG_SCALE
+        if self._polygon_points != None:
+            self._polygon_points.append(f"{x1},{y1}")
+            self._polygon_close = (x2, y2)
         else:
-            self._lines.append(line)
-        
+            r, g, b = color
+            self._file.write(f'<line stroke="{svg_rgb(r, g, b)}" stroke-width="{width}" x1="{x1}" x2="{x2}" y1="{y1}" y2="{y2}" />')
+
         self._bounds = [
-            min(self._bounds[0], x1, x2), # lowest x value
-            min(self._bounds[1], -y1, -y2), # lowest y value
-            max(self._bounds[2], x1, x2), # highest x value
-            max(self._bounds[3], -y1, -y2), # highest y value
+            min(self._bounds[0], x1, x2),
+            min(self._bounds[1], y1, y2),
+            max(self._bounds[2], x1, x2),
+            max(self._bounds[3], y1, y2),
         ]
 
 
     def _start_polygon(self):
-        self._polygon_mode = True
-        self._polygons.append([])
+        self._polygon_points = []
+
 
-    
     def _stop_polygon(self):
-        self._polygon_mode = False
-        self._polygons[-1].append(self._polygon_close)
-        # self._polygons[-1].append(self._polygons[-1][0])
+        if self._polygon_file == None:
+            self._polygon_file = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self._polygon_points.append(f"{self._polygon_close[0]},{self._polygon_close[1]}")
+        self._polygon_file.write(f'<polygon fill="black" points="{" ".join(self._polygon_points)}" stroke="black" />')
+        self._polygon_points = None
 
 
     def _finalize(self):
-        scale = 50
-
-        width = (self._bounds[2] - self._bounds[0]) * scale
-        height = (self._bounds[3] - self._bounds[1]) * scale
-        svg: svgwrite.Drawing = svgwrite.Drawing(self._file_name, size=(width, height))
-
-        offset = (-self._bounds[0], -self._bounds[1])
-        for x1, y1, x2, y2, width, color in self._lines:
-            r, g, b = color
-            svg.add(
-                svg.line(
-                    ((x1 + offset[0]) * scale, (y1 + offset[1]) * scale), 
-                    ((x2 + offset[0]) * scale, (y2 + offset[1]) * scale),
-                    stroke=svgwrite.rgb(r, g, b),
-                    stroke_width=width
-                )
-            )
-        
-        for points in self._polygons:
-            svg.add(
-                svg.polygon(
-                    points=[((x + offset[0]) * scale, (y + offset[1]) * scale) for x, y in points],
-                    fill="black",
-                    stroke="black"
-                )
-            )
-
-        svg.save()
-
+        if self._polygon_file != None:
+            self._polygon_file.seek(0)
+            shutil.copyfileobj(self._polygon_file, self._file)
+            self._polygon_file.close()
+        self._file.write("</svg>")
+
+        min_x, min_y, max_x, max_y = self._bounds
+        width = max_x - min_x
+        height = max_y - min_y
+        attributes = f' height="{height}" viewBox="{min_x} {min_y} {width} {height}" width="{width}"'
+        self._file.seek(self._reserved_offset)
+        self._file.write(attributes.ljust(self._RESERVED))
+        self._file.close()
+
+
+    def _abort(self):
+        """ Removes the incomplete file """
+        if self._polygon_file != None:
+            self._polygon_file.close()
+        self._file.close()
+        os.remove(self._file_name)
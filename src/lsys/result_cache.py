@@ -0,0 +1,176 @@
+from .interpreter import LSystemSpecification
+from .instance import LSystemInstance, GenerationSnapshot
+from .ast_nodes import *
+from .progress import ProgressTracker, CancellationToken
+from dataclasses import dataclass
+import time
+
+
+@dataclass
+class _CacheEntry:
+    value: object
+    size: int
+    cost: float
+    priority: float
+
+
+def references_iterations(spec: LSystemSpecification) -> bool:
+    """ Checks if rule selection can depend on the 'iterations' variable. If it can't,
+        the generations of an expansion don't depend on the requested iteration count """
+    nodes = [rule.rule_bias for rule in spec.rule_nodes] + [var.var_value for var in spec.var_nodes]
+    for root in nodes:
+        for node in walk(root):
+            if type(node) == IdentifierNode and node.ident == "iterations":
+                return True
+    return False
+
+
+class ResultCache:
+    """ In-memory cache of expanded generations and rendered artifacts.
+
+        With a fixed seed, an expansion is fully determined by the source, the seed
+        and the iteration count, so the state after every generation is cached
+        (including the random state). An expansion that is deeper than any cached one
+        resumes from the deepest cached generation.
+
+        Eviction follows the GreedyDual-Size policy: entries that were cheap to compute
+        relative to their size are evicted first, while recently used entries are
+        protected by the rising inflation value. """
+
+    def __init__(self, max_size: int = 256 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._entries: dict[tuple, _CacheEntry] = {}
+        self._inflation = 0.0
+        self._stats = {
+            "generation_hits": 0,
+            "generation_misses": 0,
+            "resumed_expansions": 0,
+            "artifact_hits": 0,
+            "artifact_misses": 0,
+            "evictions": 0,
+        }
+
+
+    def stats(self) -> dict:
+        """ Hit/miss counters, number of entries and their estimated size in bytes """
+        return dict(self._stats, entries=len(self._entries), size=self.size)
+
+
+    def expand(self, spec: LSystemSpecification, source_hash: str, seed, iterations: int = None, cancel: CancellationToken = None) -> LSystemInstance:
+        """ Returns an iterated instance, equal to the result of
+
+                instance = LSystemInstance(spec, seed)
+                instance.iterate(iterations, cancel=cancel)
+
+            but reusing cached generations. Expansions without a seed are not cached.
+            The generations completed before a cancellation stay cached. """
+        instance = LSystemInstance(spec, seed=seed)
+        if seed == None:
+            instance.iterate(iterations, cancel=cancel)
+            return instance
+
+        # evaluating the iterate declaration can draw random numbers, so expansions with
+        # and without explicit iteration count start from a different random state
+        instance.begin(iterations)
+        max_iterations = instance._max_iterations
+        iterations_key = max_iterations if references_iterations(spec) else None
+        base_key = ("generation", source_hash, seed, iterations != None, iterations_key)
+
+        snapshot = None
+        for count in range(max_iterations, -1, -1):
+            snapshot = self._get(base_key + (count,))
+            if snapshot != None:
+                break
+
+        if snapshot != None and (snapshot.iteration_count == max_iterations or snapshot.exhausted):
+            self._stats["generation_hits"] += 1
+            self._restore(instance, snapshot, max_iterations)
+            return instance
+
+        self._stats["generation_misses"] += 1
+        if snapshot != None:
+            self._stats["resumed_expansions"] += 1
+            self._restore(instance, snapshot, max_iterations)
+        else:
+            self._store_snapshot(base_key, instance.snapshot(), 0.0)
+
+        if cancel != None:
+            instance._progress = ProgressTracker("expand", None, cancel, generations=max_iterations)
+        try:
+            while instance._iteration_count < max_iterations and not instance._exhausted:
+                start = time.perf_counter()
+                instance.advance(1)
+                self._store_snapshot(base_key, instance.snapshot(), time.perf_counter() - start)
+        finally:
+            instance._progress = None
+
+        return instance
+
+
+    def render(self, spec: LSystemSpecification, source_hash: str, seed, iterations: int, options: tuple, render_func, cancel: CancellationToken = None) -> object:
+        """ Returns a rendered artifact. On a miss, the instance is expanded (through the
+            generation cache) and passed to render_func, whose result is cached under the
+            renderer options. Artifacts of expansions without a seed are not cached.
+            cancel only stops the expansion, render_func has to check it itself """
+        key = ("artifact", source_hash, seed, iterations, options)
+        artifact = self._get(key) if seed != None else None
+        if artifact != None:
+            self._stats["artifact_hits"] += 1
+            return artifact
+
+        self._stats["artifact_misses"] += 1
+        start = time.perf_counter()
+        instance = self.expand(spec, source_hash, seed, iterations, cancel)
+        artifact = render_func(instance)
+        if seed != None:
+            self._put(key, artifact, _artifact_size(artifact), time.perf_counter() - start)
+        return artifact
+
+
+    def _restore(self, instance: LSystemInstance, snapshot: GenerationSnapshot, max_iterations: int):
+        # the snapshot may come from an expansion with another target iteration count
+        instance.restore(snapshot)
+        instance.begin(max_iterations)
+
+
+    def _store_snapshot(self, base_key: tuple, snapshot: GenerationSnapshot, cost: float):
+        # list of references plus the random state (625 ints)
+        size = 8 * len(snapshot.l_string) + 5000
+        self._put(base_key + (snapshot.iteration_count,), snapshot, size, cost)
+
+
+    def _get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry == None:
+            return None
+        entry.priority = self._inflation + entry.cost / entry.size
+        return entry.value
+
+
+    def _put(self, key: tuple, value, size: int, cost: float):
+        size = max(size, 1)
+        if size > self.max_size:
+            return
+        if key in self._entries:
+            self.size -= self._entries[key].size
+        self._entries[key] = _CacheEntry(value, size, cost, self._inflation + cost / size)
+        self.size += size
+        while self.size > self.max_size:
+            self._evict()
+
+
+    def _evict(self):
+        key = min(self._entries, key=lambda key: self._entries[key].priority)
+        entry = self._entries.pop(key)
+        self._inflation = entry.priority
+        self.size -= entry.size
+        self._stats["evictions"] += 1
+
+
+def _artifact_size(artifact) -> int:
+    if isinstance(artifact, (str, bytes)):
+        return len(artifact)
+    if isinstance(artifact, tuple):
+        return sum(_artifact_size(item) for item in artifact)
+    return 64
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from functools import partial
 import math
 import random
 
@@ -7,13 +8,13 @@ def _param_count_error(name: str, expected: str, given: int):
     raise Exception(f"Function '{name}' takes {expected} parameter(s), but {given} were given")
 
 
-def _ctx_random(params):
+def _ctx_random(rng: random.Random, params):
     if len(params) == 0:
-        return random.random()
+        return rng.random()
     elif len(params) == 1:
-        return random.random() * params[0]
+        return rng.random() * params[0]
     elif len(params) == 2:
-        return random.random() * (params[1] - params[0]) + params[0]
+        return rng.random() * (params[1] - params[0]) + params[0]
     _param_count_error("random", "up to two", len(params))
 
 
@@ -32,13 +33,18 @@ def _ctx_max(params):
 class EvalContext:
     vars: dict
     funcs: dict
+    rng: random.Random
+    # Instrumentation counting the expressions evaluated in this context, set by
+    # the instance or renderer the context belongs to (see lsys.instrumentation)
+    instrumentation = None
 
     @classmethod
-    def create(cls):
+    def create(cls, rng: random.Random = None):
         ctx = EvalContext()
+        ctx.rng = rng if rng != None else random.Random()
 
         ctx.funcs = {
-            "random": _ctx_random,
+            "random": partial(_ctx_random, ctx.rng),
             "min": _ctx_min,
             "max": _ctx_max,
         }
@@ -51,6 +57,7 @@ class EvalContext:
         cpy = EvalContext()
         cpy.vars = dict(ctx.vars)
         cpy.funcs = dict(ctx.funcs)
+        cpy.rng = ctx.rng
         return cpy
 
 
@@ -0,0 +1,245 @@
+from .instance import LSystemInstance
+from .interpreter import LSystemSpecification
+from .ast_nodes import *
+from .runtime_context import *
+from .renderer import LSystemRenderer
+from .pipeline import draws_random
+from dataclasses import dataclass, field
+from array import array
+
+
+@dataclass
+class SeedMetrics:
+    """ Summary of every seed of a LSystemSeedBatch, in the order of its seeds.
+        Bounds are the drawn extent in turtle units """
+    seeds: list
+    iterations: array = field(default_factory=lambda: array("q"))
+    symbols: array = field(default_factory=lambda: array("q"))
+    line_count: array = field(default_factory=lambda: array("q"))
+    complexity_rating: array = field(default_factory=lambda: array("q"))
+    min_x: array = field(default_factory=lambda: array("d"))
+    min_y: array = field(default_factory=lambda: array("d"))
+    max_x: array = field(default_factory=lambda: array("d"))
+    max_y: array = field(default_factory=lambda: array("d"))
+
+
+class LSystemSeedBatch:
+    """ Expands and renders a specification with many seeds in lockstep, one
+        generation of all seeds at a time. Every seed gets the result of a run of its
+        own (an LSystemInstance with that seed), while:
+
+            seeds whose generations are the same list are expanded once as long as
+                their symbols have a single rule, so deterministic grammars and
+                deterministic prefixes of an expansion are shared
+            the rule sets with several rules are turned into weight tables once per
+                generation and seed, instead of evaluating the biases twice for
+                every symbol, unless a bias draws random numbers
+            the random numbers of a generation are drawn per seed in one block
+            seeds with the same L-string render once when collecting metrics, unless
+                the transforms draw random numbers """
+
+    def __init__(self, spec: LSystemSpecification, seeds: list):
+        self.spec = spec
+        self.seeds = list(seeds)
+        self.instances = [LSystemInstance(spec, seed=seed) for seed in self.seeds]
+        self._static_biases: dict[str, bool] = {}
+
+
+    def iterate(self, iterations: int = None):
+        """ Expands all seeds from the axiom, like LSystemInstance.iterate() """
+        for instance in self.instances:
+            instance.reset()
+            instance.begin(iterations)
+        while True:
+            active = [instance for instance in self.instances
+                if instance._iteration_count < instance._max_iterations and not instance._exhausted]
+            if len(active) == 0:
+                return
+            groups: dict[int, list[LSystemInstance]] = {}
+            for instance in active:
+                groups.setdefault(id(instance.l_string), []).append(instance)
+            for group in groups.values():
+                self._advance_group(group)
+
+
+    def _advance_group(self, group: list[LSystemInstance]):
+        """ Derives the next generation of seeds sharing the current one """
+        l_string = group[0].l_string
+        stochastic = set()
+        for node in l_string:
+            if issubclass(type(node), IdentifierNode) and len(self.spec.rule_set(node.ident)) > 1:
+                stochastic.add(node.ident)
+        if len(stochastic) == 0:
+            new_l_string, matched = self._expand_deterministic(l_string)
+            for instance in group:
+                _finish_iteration(instance, new_l_string, matched)
+            return
+        for instance in group:
+            new_l_string, matched = self._expand_stochastic(instance, stochastic)
+            _finish_iteration(instance, new_l_string, matched)
+
+
+    def _expand_deterministic(self, l_string: list[ASTNode]) -> tuple[list[ASTNode], bool]:
+        new_l_string = []
+        matched = False
+        rule_set = self.spec.rule_set
+        for node in l_string:
+            if issubclass(type(node), IdentifierNode):
+                rules = rule_set(node.ident)
+                if len(rules) > 0:
+                    matched = True
+                    new_l_string += rules[0].rule_elements
+                    continue
+            new_l_string.append(node)
+        return new_l_string, matched
+
+
+    def _expand_stochastic(self, instance: LSystemInstance, stochastic: set[str]) -> tuple[list[ASTNode], bool]:
+        """ Expands a generation with symbols that have several rules, choosing rules
+            like LSystemSpecification.select_rule() """
+        ctx = instance.ctx
+        if not all(self._has_static_biases(name, ctx) for name in stochastic):
+            matched = instance._do_iteration()
+            return instance.l_string, matched
+
+        l_string = instance.l_string
+        rule_set = self.spec.rule_set
+        # biases only change between generations
+        weights: dict[str, tuple[list[float], float]] = {}
+        draw_count = 0
+        for node in l_string:
+            if issubclass(type(node), IdentifierNode) and node.ident in stochastic:
+                draw_count += 1
+        random = ctx.rng.random
+        draws = [random() for _ in range(draw_count)]
+
+        new_l_string = []
+        matched = False
+        drawn = 0
+        for node in l_string:
+            if issubclass(type(node), IdentifierNode):
+                rules = rule_set(node.ident)
+                if len(rules) == 1:
+                    matched = True
+                    new_l_string += rules[0].rule_elements
+                    continue
+                if len(rules) > 1:
+                    matched = True
+                    entry = weights.get(node.ident)
+                    if entry == None:
+                        # same arithmetic as select_rule(), so the same rule is chosen
+                        rule_weights = [rule.rule_bias.eval(ctx) for rule in rules]
+                        total_weight = 0.0
+                        for weight in rule_weights:
+                            total_weight += weight
+                        entry = (rule_weights, total_weight)
+                        weights[node.ident] = entry
+                    rule_weights, total_weight = entry
+                    rng = draws[drawn] * total_weight
+                    drawn += 1
+                    i = 0
+                    while rng > 0:
+                        last_rule = rules[i]
+                        rng -= rule_weights[i]
+                        i += 1
+                    new_l_string += last_rule.rule_elements
+                    continue
+            new_l_string.append(node)
+        return new_l_string, matched
+
+
+    def _has_static_biases(self, rule_name: str, ctx: EvalContext) -> bool:
+        """ Checks if the biases of a rule set keep their value during a generation """
+        static = self._static_biases.get(rule_name)
+        if static == None:
+            static = not draws_random([rule.rule_bias for rule in self.spec.rule_set(rule_name)], ctx)
+            self._static_biases[rule_name] = static
+        return static
+
+
+    def render(self, make_renderer=None, lattice: bool = False) -> SeedMetrics:
+        """ Renders every seed with the renderer make_renderer(seed) returns, or only
+            collects the metrics if make_renderer is None """
+        metrics = SeedMetrics(list(self.seeds))
+        shared = make_renderer == None and not self._transforms_draw_random()
+        rendered: dict[tuple, _BoundsRenderer] = {}
+        for seed, instance in zip(self.seeds, self.instances):
+            key = (id(instance.l_string), instance._max_iterations)
+            bounds_renderer = rendered.get(key) if shared else None
+            if bounds_renderer == None:
+                output = make_renderer(seed) if make_renderer != None else None
+                bounds_renderer = _BoundsRenderer(output)
+                bounds_renderer.render(instance, lattice=lattice)
+                rendered[key] = bounds_renderer
+            metrics.iterations.append(instance._iteration_count)
+            metrics.symbols.append(len(instance.l_string))
+            metrics.line_count.append(bounds_renderer._line_count)
+            metrics.complexity_rating.append(bounds_renderer._complexity_rating)
+            min_x, min_y, max_x, max_y = bounds_renderer.bounds
+            metrics.min_x.append(min_x)
+            metrics.min_y.append(min_y)
+            metrics.max_x.append(max_x)
+            metrics.max_y.append(max_y)
+        return metrics
+
+
+    def _transforms_draw_random(self) -> bool:
+        spec = self.spec
+        nodes = [spec.length_node.length, spec.width_node.width, spec.color_node.color] + spec.transform_nodes
+        return draws_random(nodes, self.instances[0].ctx) if len(self.instances) > 0 else False
+
+
+class _BoundsRenderer(LSystemRenderer):
+    """ Tracks the drawn extent and passes the backend calls on to another renderer,
+        if one is given """
+
+    def __init__(self, output: LSystemRenderer = None):
+        self.output = output
+
+
+    def _begin(self, instance: LSystemInstance, lattice: bool = False):
+        if self.output != None:
+            self.output._begin(instance, lattice)
+        super()._begin(instance, lattice)
+
+
+    def _reset(self):
+        self.bounds = [0.0, 0.0, 0.0, 0.0]
+
+
+    def _line(self, x1, y1, x2, y2, width, color):
+        self.bounds = [
+            min(self.bounds[0], x1, x2),
+            min(self.bounds[1], y1, y2),
+            max(self.bounds[2], x1, x2),
+            max(self.bounds[3], y1, y2),
+        ]
+        if self.output != None:
+            self.output._line(x1, y1, x2, y2, width, color)
+
+
+    def _start_polygon(self):
+        if self.output != None:
+            self.output._start_polygon()
+
+
+    def _stop_polygon(self):
+        if self.output != None:
+            self.output._stop_polygon()
+
+
+    def _finalize(self):
+        if self.output != None:
+            self.output._line_count = self._line_count
+            self.output._complexity_rating = self._complexity_rating
+            self.output._finalize()
+
+
+def _finish_iteration(instance: LSystemInstance, new_l_string: list[ASTNode], matched: bool):
+    """ Ends an iteration of an instance like LSystemInstance.advance() """
+    instance.l_string = new_l_string
+    if not matched:
+        instance._exhausted = True
+    else:
+        instance._iteration_count += 1
+        instance.ctx.vars["depth"] = NumNode(instance._iteration_count)
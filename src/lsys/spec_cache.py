@@ -0,0 +1,153 @@
+from .parser import Parser, PARSER_VERSION
+from .interpreter import LSystemSpecification
+import hashlib
+import os
+import pickle
+import tempfile
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, eviction is then not serialized between processes
+    fcntl = None
+
+
+_ENTRY_SUFFIX = ".spec"
+
+
+def source_hash(source: str) -> str:
+    """ Content hash of an L-system source string """
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+class SpecificationCache:
+    """ On-disk cache of compiled L-system specifications, keyed by the hash of the
+        source and the parser version.
+
+        Entries are pickled specifications, written to a temporary file and atomically
+        renamed into place, so several processes can share one cache directory. Reading
+        an entry refreshes its modification time, which is used as the LRU order when
+        the cache grows beyond max_size bytes. """
+
+    def __init__(self, directory: str, max_size: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+
+    def key(self, source: str) -> str:
+        return f"{source_hash(source)}-p{PARSER_VERSION}"
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+
+    def get(self, source: str) -> LSystemSpecification:
+        """ Returns the cached specification for the source, or None """
+        path = self._path(self.key(source))
+        try:
+            with open(path, "rb") as file:
+                spec = pickle.load(file)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # unreadable or outdated entry, drop it
+            self._remove(path)
+            return None
+        return spec
+
+
+    def put(self, source: str, spec: LSystemSpecification):
+        """ Stores the specification compiled from the source """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(spec, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(self.key(source)))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._evict()
+
+
+    def load(self, source: str, parser: Parser = None) -> LSystemSpecification:
+        """ Returns the specification for the source, parsing and caching it on a miss """
+        spec = self.get(source)
+        if spec == None:
+            parser = parser or Parser()
+            spec = LSystemSpecification.create(parser.parse(source))
+            self.put(source, spec)
+        return spec
+
+
+    def clear(self):
+        for path in self._entries():
+            self._remove(path)
+
+
+    def _entries(self) -> list[str]:
+        return [
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.endswith(_ENTRY_SUFFIX)
+        ]
+
+
+    def _evict(self):
+        """ Removes least recently used entries until the cache fits into max_size """
+        with _EvictionLock(self.directory) as acquired:
+            if not acquired:
+                # another process is already evicting
+                return
+
+            entries = []
+            total_size = 0
+            for path in self._entries():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                self._remove(path)
+                total_size -= size
+
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _EvictionLock:
+    """ Non-blocking inter-process lock on the cache directory """
+
+    def __init__(self, directory: str):
+        self._path = os.path.join(directory, ".lock")
+        self._file = None
+
+
+    def __enter__(self) -> bool:
+        if fcntl == None:
+            return True
+        self._file = open(self._path, "a")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+
+    def __exit__(self, *exc_info):
+        if self._file != None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,122 @@
+from .renderer import LSystemRenderer, SVG_SCALE
+from .progress import PROGRESS_CHUNK
+from xml.etree import ElementTree
+import svgwrite
+import io
+import os
+
+
+class LSystemSVGRenderer(LSystemRenderer):
+    """ Renders to an SVG file. Without a file name, the document is kept in
+        svg_string instead. If bounds are given (lowest x, lowest y, highest x,
+        highest y in SVG coordinates), they are used instead of the drawn extent.
+        Building and writing the document can be cancelled like the walk (see
+        LSystemRenderer.render()), an incomplete file is removed """
+    
+    def __init__(self, file_name: str = None, bounds: list[float] = None):
+        self._file_name = file_name
+        self._fixed_bounds = bounds
+        self.svg_string: str = None
+        self._file = None
+
+
+    def _reset(self):
+        self._bounds = [0, 0, 0, 0]
+        self._lines = []
+        self._polygon_mode = False
+        self._polygon_close = (0, 0)
+        self._polygons = []
+
+
+    def _line(self, x1, y1, x2, y2, width, color):
+        line = (x1, -y1, x2, -y2, width, color)
+        if self._polygon_mode:
+            self._polygons[-1].append((line[0], line[1]))
+            self._polygon_close = (line[2], line[3])
+        else:
+            self._lines.append(line)
+        
+        self._bounds = [
+            min(self._bounds[0], x1, x2), # lowest x value
+            min(self._bounds[1], -y1, -y2), # lowest y value
+            max(self._bounds[2], x1, x2), # highest x value
+            max(self._bounds[3], -y1, -y2), # highest y value
+        ]
+
+
+    def _start_polygon(self):
+        self._polygon_mode = True
+        self._polygons.append([])
+
+    
+    def _stop_polygon(self):
+        self._polygon_mode = False
+        self._polygons[-1].append(self._polygon_close)
+        # self._polygons[-1].append(self._polygons[-1][0])
+
+
+    def _finalize(self):
+        scale = SVG_SCALE
+        if self._fixed_bounds != None:
+            self._bounds = list(self._fixed_bounds)
+
+        width = (self._bounds[2] - self._bounds[0]) * scale
+        height = (self._bounds[3] - self._bounds[1]) * scale
+        svg: svgwrite.Drawing = svgwrite.Drawing(self._file_name, size=(width, height))
+
+        offset = (-self._bounds[0], -self._bounds[1])
+        for i, (x1, y1, x2, y2, width, color) in enumerate(self._lines):
+            if i % PROGRESS_CHUNK == 0:
+                self._check_cancelled()
+            r, g, b = color
+            svg.add(
+                svg.line(
+                    ((x1 + offset[0]) * scale, (y1 + offset[1]) * scale), 
+                    ((x2 + offset[0]) * scale, (y2 + offset[1]) * scale),
+                    stroke=svgwrite.rgb(r, g, b),
+                    stroke_width=width
+                )
+            )
+        
+        for points in self._polygons:
+            svg.add(
+                svg.polygon(
+                    points=[((x + offset[0]) * scale, (y + offset[1]) * scale) for x, y in points],
+                    fill="black",
+                    stroke="black"
+                )
+            )
+
+        if self._file_name != None:
+            self._file = open(self._file_name, "w", encoding="utf-8")
+            self._write(svg, self._file)
+            self._file.close()
+            self._file = None
+        else:
+            buffer = io.StringIO()
+            self._write(svg, buffer)
+            self.svg_string = buffer.getvalue()
+
+
+    def _write(self, svg: svgwrite.Drawing, file):
+        """ Writes the document like svgwrite.Drawing.write(), one element at a time
+            instead of building the whole tree first, so it can be cancelled """
+        file.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        elements = svg.elements
+        svg.elements = []
+        end_tag = f"</{svg.elementname}>"
+        file.write(ElementTree.tostring(svg.get_xml(), encoding="unicode", short_empty_elements=False)[:-len(end_tag)])
+        svg.elements = elements
+        for i, element in enumerate(elements):
+            if i % PROGRESS_CHUNK == 0:
+                self._check_cancelled()
+            file.write(ElementTree.tostring(element.get_xml(), encoding="unicode"))
+        file.write(end_tag)
+
+
+    def _abort(self):
+        """ Removes the incomplete file """
+        if self._file != None:
+            self._file.close()
+            self._file = None
+            os.remove(self._file_name)
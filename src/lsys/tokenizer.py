@@ -41,37 +41,48 @@ _KEYWORDS = [
 ]
 
 _TOKENIZER_SPEC = [
-    (r"^(//|#)", TokenType.COMMENT),
-    (r"^(def|var)", TokenType.VAR),
-    (r"^transform", TokenType.TRANSFORM),
-    (r"^rule", TokenType.RULE),
-    (r"^axiom", TokenType.AXIOM),
-    (r"^length", TokenType.LENGTH),
-    (r"^width", TokenType.WIDTH),
-    (r"^color", TokenType.COLOR),
-    (r"^iterate", TokenType.ITERATE),
-    (r"^bias", TokenType.BIAS),
-    (r"^rotate", TokenType.ROTATE),
-    (r"^translate", TokenType.TRANSLATE),
-    (r"^rad", TokenType.RAD),
-    (r"^deg", TokenType.DEG),
-    (r"^=", TokenType.ASSIGN),
-    (r"^\[", TokenType.OPEN_BRACKET),
-    (r"^\]", TokenType.CLOSE_BRACKET),
-    (r"^{", TokenType.OPEN_CURLY),
-    (r"^}", TokenType.CLOSE_CURLY),
-    (r"^\(", TokenType.OPEN_PAREN),
-    (r"^\)", TokenType.CLOSE_PAREN),
-    (r"^(\d+(\.\d+)?|\.\d+)", TokenType.NUM),
-    (r"^\+", TokenType.PLUS),
-    (r"^-", TokenType.MINUS),
-    (r"^\*", TokenType.ASTERISK),
-    (r"^/", TokenType.SLASH),
-    (r"^[a-zA-Z_]\w*", TokenType.IDENTIFIER),
-    (r"^,", TokenType.COMMA),
-    (r"^;", TokenType.SEMICOLON),
+    (r"//|#", TokenType.COMMENT),
+    (r"def|var", TokenType.VAR),
+    (r"transform", TokenType.TRANSFORM),
+    (r"rule", TokenType.RULE),
+    (r"axiom", TokenType.AXIOM),
+    (r"length", TokenType.LENGTH),
+    (r"width", TokenType.WIDTH),
+    (r"color", TokenType.COLOR),
+    (r"iterate", TokenType.ITERATE),
+    (r"bias", TokenType.BIAS),
+    (r"rotate", TokenType.ROTATE),
+    (r"translate", TokenType.TRANSLATE),
+    (r"rad", TokenType.RAD),
+    (r"deg", TokenType.DEG),
+    (r"=", TokenType.ASSIGN),
+    (r"\[", TokenType.OPEN_BRACKET),
+    (r"\]", TokenType.CLOSE_BRACKET),
+    (r"{", TokenType.OPEN_CURLY),
+    (r"}", TokenType.CLOSE_CURLY),
+    (r"\(", TokenType.OPEN_PAREN),
+    (r"\)", TokenType.CLOSE_PAREN),
+    (r"\d+(?:\.\d+)?|\.\d+", TokenType.NUM),
+    (r"\+", TokenType.PLUS),
+    (r"-", TokenType.MINUS),
+    (r"\*", TokenType.ASTERISK),
+    (r"/", TokenType.SLASH),
+    (r"[a-zA-Z_]\w*", TokenType.IDENTIFIER),
+    (r",", TokenType.COMMA),
+    (r";", TokenType.SEMICOLON),
 ]
 
+# Keywords only match if no identifier character follows
+_KEYWORD_BOUNDARY = r"(?!\w)"
+
+# Leading whitespace and all token patterns as one regular expression, the
+# patterns are tried in the order of the specification
+_TOKEN_PATTERN = re.compile("[ \n]*(?:" + "|".join(
+    f"(?P<{token_type.name}>{rx}){_KEYWORD_BOUNDARY if token_type in _KEYWORDS else ''}" for rx, token_type in _TOKENIZER_SPEC
+) + ")")
+_WHITESPACE_PATTERN = re.compile(r"[ \n]*")
+_TOKEN_TYPES = {token_type.name: token_type for token_type in TokenType}
+
 
 @dataclass
 class RawToken:
@@ -80,15 +91,16 @@ class RawToken:
 
 
 class Tokenizer:
-    """ Lazily pulls a token from a stream """
+    """ Lazily pulls a token from a stream. Every token is matched in place, so
+        tokenizing takes linear time in the length of the source """
 
     def initialize(self, string):
         self._string: str = string
         self._cursor: int = 0
         self._line_number: int = 1
-        self._line_cursor: int = 0
+        self._line_start: int = 0
         self._buffered_line_number: int = self._line_number
-        self._buffered_line_cursor: int = self._line_cursor
+        self._buffered_line_cursor: int = 0
 
 
     def has_more_tokens(self) -> bool:
@@ -100,64 +112,47 @@ class Tokenizer:
 
 
     def get_next_token(self) -> RawToken:
-        self._buffered_line_cursor = self._line_cursor
-        self._buffered_line_number = self._line_number
-
-        if not self.has_more_tokens():
-            return TokenType.EOF
-        
-        # get string from cursor position and remove leading whitespace
-        string = self._string[self._cursor:]
-        
-        while self.has_more_tokens() and string[0] in " \n":
-            self._incr_cursor()
-            if string[0] == "\n":
-                self._line_number += 1
-                self._line_cursor = 0
-            string = string[1:]
-
-        if self.is_eof():
-            return TokenType.EOF
-        
-        # try to read a token
-        for rx, token_type in _TOKENIZER_SPEC:
-            match = re.search(rx, string)
-            if match:
-                if token_type in _KEYWORDS:
-                    # TODO rework this incredibly dirty hack!
-                    token_length = len(str(token_type).split(".")[1])
-                    if self._cursor + token_length < len(self._string):
-                        next_char = self._string[self._cursor + token_length]
-                        if self._is_id_char(next_char):
-                            continue
-                if token_type == TokenType.COMMENT:
-                    self._advance_to_next_line()
-                    return self.get_next_token()
-                else:
-                    self._incr_cursor(match.end() - match.start())
-                    return RawToken(token_type, string[match.start():match.end()])
-
-        raise SyntaxError(f"Unexpected token '{string[0]}' in line {self._line_number}:{self._line_cursor + 1}\n{self.get_error_excerpt()}")
-    
-
-    def _is_id_char(self, char) -> bool:
-        return re.search(char, r"^[a-zA-Z0-9_]$") != None
-
-    def _incr_cursor(self, inc=1):
-        self._cursor += inc
-        self._line_cursor += inc
-    
-
-    def _advance_to_next_line(self):
-        while not self.is_eof() and self._string[self._cursor] != "\n":
-            self._incr_cursor()
+        """ Returns the next token, a token of type EOF at the end of the source """
+        string = self._string
+        while True:
+            start = self._cursor
+            self._buffered_line_cursor = start - self._line_start
+            self._buffered_line_number = self._line_number
+
+            match = _TOKEN_PATTERN.match(string, start)
+            if match == None:
+                # only whitespace, or an unknown character after it
+                end = _WHITESPACE_PATTERN.match(string, start).end()
+                self._skip_whitespace(start, end)
+                if end == len(string):
+                    return RawToken(TokenType.EOF, "")
+                raise SyntaxError(f"Unexpected token '{string[end]}' in line {self._line_number}:{end - self._line_start + 1}\n{self.get_error_excerpt()}")
+
+            token_name = match.lastgroup
+            token_start = match.start(token_name)
+            if token_start != start:
+                self._skip_whitespace(start, token_start)
+            if token_name == "COMMENT":
+                newline = string.find("\n", token_start)
+                self._cursor = newline if newline != -1 else len(string)
+                continue
+            self._cursor = match.end()
+            return RawToken(_TOKEN_TYPES[token_name], match.group(token_name))
+
+
+    def _skip_whitespace(self, start: int, end: int):
+        newlines = self._string.count("\n", start, end)
+        if newlines > 0:
+            self._line_number += newlines
+            self._line_start = self._string.rindex("\n", start, end) + 1
+        self._cursor = end
 
 
     def get_pos(self, buffered=False) -> tuple[int, int]:
         if buffered:
             return self._buffered_line_number, self._buffered_line_cursor + 1
         else:
-            return self._line_number, self._line_cursor + 1
+            return self._line_number, self._cursor - self._line_start + 1
 
 
     def get_error_excerpt(self, use_buffered_pos=False) -> str:
@@ -165,4 +160,3 @@ class Tokenizer:
         line = self._string.split("\n")[line_number - 1]
         indicator = " " * line_cursor + "^"
         return f"{line}\n{indicator}"
-
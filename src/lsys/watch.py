@@ -0,0 +1,201 @@
+from .parser import Parser
+from .interpreter import LSystemSpecification
+from .instance import LSystemInstance, GenerationSnapshot
+from .renderer import LSystemRecordingRenderer, OP_LINE
+from .svg_renderer import LSystemSVGRenderer
+from .pipeline import draws_random
+from .ast_nodes import *
+import os
+import time
+
+
+# Amount of work a source change requires, in increasing order
+CHANGE_NONE = 0
+CHANGE_STYLE = 1 # re-evaluate widths and colors of the default transform, reuse geometry
+CHANGE_TURTLE = 2 # walk the expanded string again
+CHANGE_EXPANSION = 3 # expand again from the axiom
+
+CHANGE_NAMES = {
+    CHANGE_NONE: "no change",
+    CHANGE_STYLE: "style change",
+    CHANGE_TURTLE: "transform change",
+    CHANGE_EXPANSION: "expansion change",
+}
+
+
+def declaration_key(node: DeclarationNode) -> tuple:
+    """ Identifies the declaration a node belongs to across edits of a source """
+    if type(node) == VarDeclarationNode:
+        return ("var", node.var_name.ident)
+    if issubclass(type(node), TransformDeclarationNode):
+        return ("transform", node.transform_name.ident)
+    return (type(node).__name__,)
+
+
+def _declarations(root: RootNode) -> dict[tuple, object]:
+    declarations = {}
+    rule_counts = {}
+    for node in root.body:
+        if type(node) == RuleDeclarationNode:
+            # rules with the same name form an ordered rule set
+            index = rule_counts.get(node.rule_name.ident, 0)
+            rule_counts[node.rule_name.ident] = index + 1
+            declarations[("rule", node.rule_name.ident, index)] = node
+        else:
+            # later transform declarations replace earlier ones
+            declarations[declaration_key(node)] = node
+    return declarations
+
+
+def diff_declarations(old_root: RootNode, new_root: RootNode) -> list[tuple]:
+    """ Returns the keys of all declarations that were added, removed or changed """
+    old = _declarations(old_root)
+    new = _declarations(new_root)
+    return [key for key in old.keys() | new.keys() if old.get(key) != new.get(key)]
+
+
+def _expansion_variables(root: RootNode) -> set[str]:
+    """ Names of the variables rule selection and the iteration count can depend on """
+    var_values = {key[1]: node.var_value for key, node in _declarations(root).items() if key[0] == "var"}
+    pending = [node.rule_bias for node in root.body if type(node) == RuleDeclarationNode]
+    pending += [node.iterations for node in root.body if type(node) == IterateDeclarationNode]
+    names = set()
+    while len(pending) > 0:
+        for node in walk(pending.pop()):
+            if type(node) == IdentifierNode and node.ident not in names:
+                names.add(node.ident)
+                if node.ident in var_values:
+                    pending.append(var_values[node.ident])
+    return names
+
+
+def _style_draws_random(root: RootNode) -> bool:
+    """ Checks if the width or color of the default transform can call random() """
+    declarations = _declarations(root)
+    ctx = EvalContext.create()
+    ctx.vars = {key[1]: node.var_value for key, node in declarations.items() if key[0] == "var"}
+    nodes = []
+    if ("WidthDeclarationNode",) in declarations:
+        nodes.append(declarations[("WidthDeclarationNode",)].width)
+    if ("ColorDeclarationNode",) in declarations:
+        nodes.append(declarations[("ColorDeclarationNode",)].color)
+    return draws_random(nodes, ctx)
+
+
+def change_level(old_root: RootNode, new_root: RootNode) -> int:
+    """ Classifies the changes between two versions of a source """
+    level = CHANGE_NONE
+    expansion_variables = _expansion_variables(old_root) | _expansion_variables(new_root)
+    for key in diff_declarations(old_root, new_root):
+        if key[0] in ("WidthDeclarationNode", "ColorDeclarationNode"):
+            # restyling evaluates the style after the walk, so random numbers would be
+            # drawn in another order than by a render
+            if _style_draws_random(old_root) or _style_draws_random(new_root):
+                level = max(level, CHANGE_TURTLE)
+            else:
+                level = max(level, CHANGE_STYLE)
+        elif key[0] in ("transform", "LengthDeclarationNode"):
+            level = max(level, CHANGE_TURTLE)
+        elif key[0] == "var" and key[1] not in expansion_variables:
+            level = max(level, CHANGE_TURTLE)
+        else:
+            level = CHANGE_EXPANSION
+    return level
+
+
+class _GeometryRecorder(LSystemRecordingRenderer):
+    """ Recording renderer that also remembers which lines were drawn by the default
+        transform, with the turtle heading and depth their style was evaluated at """
+
+    def _reset(self):
+        super()._reset()
+        self.default_lines = []
+
+
+    def _apply_transform(self, transform_node: TransformDeclarationNode):
+        op_count = len(self.ops)
+        super()._apply_transform(transform_node)
+        if transform_node is self._default_transform and len(self.ops) > op_count:
+            self.default_lines.append((len(self.ops) - 1, self._state().heading, self._depth))
+
+
+class LSystemWatcher:
+    """ Re-renders a source file whenever it changes, redoing only the stages the
+        changed declarations affect """
+
+    def __init__(self, file_name: str, out_file_name: str, seed=None, iterations: int = None):
+        self._file_name = file_name
+        self._out_file_name = out_file_name
+        self._seed = seed
+        self._iterations = iterations
+        self._parser = Parser()
+        self._root: RootNode = None
+        self._snapshot: GenerationSnapshot = None
+        self._recorder: _GeometryRecorder = None
+
+
+    def run(self, interval: float = 0.25):
+        """ Polls the source file for changes until interrupted """
+        mtime = None
+        while True:
+            try:
+                new_mtime = os.stat(self._file_name).st_mtime_ns
+            except FileNotFoundError:
+                new_mtime = None
+            if new_mtime != None and new_mtime != mtime:
+                mtime = new_mtime
+                self.update()
+            time.sleep(interval)
+
+
+    def update(self) -> int:
+        """ Reads the source file and re-renders it. Returns the change level """
+        start = time.perf_counter()
+        try:
+            with open(self._file_name) as file:
+                root = self._parser.parse(file.read())
+            spec = LSystemSpecification.create(root)
+        except Exception as e:
+            print(f"[watch] {type(e).__name__}: {e}")
+            return CHANGE_NONE
+
+        level = CHANGE_EXPANSION if self._root == None else change_level(self._root, root)
+        if level == CHANGE_NONE:
+            return level
+
+        instance = LSystemInstance(spec, seed=self._seed)
+        if level == CHANGE_EXPANSION:
+            instance.iterate(self._iterations)
+            self._snapshot = instance.snapshot()
+        else:
+            instance.restore(self._snapshot)
+
+        if level >= CHANGE_TURTLE:
+            self._recorder = _GeometryRecorder()
+            self._recorder.render(instance)
+        else:
+            self._restyle(instance)
+
+        renderer = LSystemSVGRenderer(self._out_file_name)
+        renderer._begin(instance)
+        renderer._replay(self._recorder.ops)
+        renderer._finalize()
+
+        self._root = root
+        print(f"[watch] {CHANGE_NAMES[level]}: rendered {self._recorder._line_count} lines in {(time.perf_counter() - start) * 1000.0:.0f}ms")
+        return level
+
+
+    def _restyle(self, instance: LSystemInstance):
+        """ Re-evaluates width and color of the lines drawn by the default transform """
+        recorder = self._recorder
+        ctx = EvalContext.create_from(instance.ctx)
+        width_node = instance.spec.width_node.width
+        color_node = instance.spec.color_node.color
+        for index, heading, depth in recorder.default_lines:
+            op = recorder.ops[index]
+            ctx.vars["x"] = NumNode(op[3])
+            ctx.vars["y"] = NumNode(op[4])
+            ctx.vars["heading"] = NumNode(heading)
+            ctx.vars["depth"] = NumNode(depth)
+            recorder.ops[index] = (OP_LINE, op[1], op[2], op[3], op[4], width_node.eval(ctx), color_node.rgb(ctx))
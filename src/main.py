@@ -1,23 +1,23 @@
-import sys
-import json
-import dataclasses
 import time
+_import_start = time.perf_counter()
+import sys
+import os
+import argparse
+import contextlib
 from math import floor
 from lsys.parser import Parser
 from lsys.interpreter import LSystemSpecification
 from lsys.instance import LSystemInstance
-from lsys.renderer import LSystemDebugPrintRenderer, LSystemSVGRenderer
-from pprint import pprint, pformat
-
-_start_time = None
+from lsys.renderer import RENDERER_BACKENDS, create_renderer
+from lsys.progress import Progress, CancellationToken, Cancelled
+from common import read_file, parse_int_list
+# Modules used by a single option (svgwrite, multiprocessing, threads, codegen, ...)
+# are imported where the option is handled, so they don't slow down every run
 
+# Time spent on the imports above (see import_profile())
+_import_time = time.perf_counter() - _import_start
 
-def read_file(file_name):
-    file_string = ""
-    with open(file_name) as file:
-        for line in file.readlines():
-            file_string += line
-    return file_string
+_start_time = None
 
 
 def timer_start():
@@ -31,51 +31,376 @@ def timer_stop():
     t = (_stop_time - _start_time) * 1000.0
     unit = "ms"
     if t < 1.0:
-        unit = "ns"
+        unit = "µs"
         t *= 1000.0
     return f"{floor(t)}{unit}"
 
 
-def main(argc, argv):
-    file_name = argv[1]
-    out_file_name = "out.svg"
-    if argc > 2:
-        out_file_name = argv[2]
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Renders an L-system source file")
+    arg_parser.add_argument("file_name", help="L-system source file")
+    arg_parser.add_argument("out_file_name", nargs="?", default="out.svg", help="output SVG file (default: out.svg)")
+    arg_parser.add_argument("--seed", type=int, default=None, help="seed for the random number generator")
+    arg_parser.add_argument("--iterations", type=int, default=None, help="overrides the number of iterations")
+    arg_parser.add_argument("--spec-cache", metavar="DIR", default=None, help="directory for caching compiled specifications")
+    arg_parser.add_argument("--parallel", type=int, nargs="?", const=0, default=None, metavar="PROCESSES",
+        help="render top-level branches in a process pool (default pool size: number of CPUs)")
+    arg_parser.add_argument("--watch", action="store_true",
+        help="keep running and re-render whenever the source file changes")
+    arg_parser.add_argument("--animate", action="store_true",
+        help="render one frame per generation; the output file name may contain a '{frame}' and '{generation}' pattern")
+    arg_parser.add_argument("--frames-per-generation", type=int, default=1,
+        help="frames per generation when animating, in between frames morph the previous generation into the next one")
+    arg_parser.add_argument("--lattice", action="store_true",
+        help="use an exact integer lattice turtle if all angles and distances of the grammar allow it")
+    arg_parser.add_argument("--hashcons", action="store_true",
+        help="store generations as a DAG of shared subtrees and render repeated subtrees once where possible "
+            "(not with --optimize, --lattice, --compile, --spill-threshold or --spill-dir)")
+    arg_parser.add_argument("--spill-threshold", type=int, default=None, metavar="SYMBOLS",
+        help="write generations with more symbols than this to memory-mapped temporary files")
+    arg_parser.add_argument("--spill-dir", default=None, metavar="DIR",
+        help="directory for spilled generations (default: system temporary directory)")
+    arg_parser.add_argument("--pipeline", action="store_true",
+        help="overlap the last expansion step, the turtle and the SVG writer, streaming between them (not with --max-branch-depth)")
+    arg_parser.add_argument("--profile", metavar="FILE", default=None,
+        help="write stage timings, generation sizes and rule, transform and expression counters to a JSON file")
+    arg_parser.add_argument("--trace", metavar="FILE", default=None,
+        help="write stage timings as a Chrome trace (chrome://tracing, Perfetto)")
+    arg_parser.add_argument("--compile", nargs="?", const="", default=None, metavar="DIR",
+        help="expand and render with Python code generated for the grammar, cached in DIR (default: ~/.cache/lsys/codegen)")
+    arg_parser.add_argument("--max-branch-depth", type=int, default=None, metavar="DEPTH",
+        help="skip all branches opened at this nesting depth or deeper, using a bracket index kept during expansion")
+    arg_parser.add_argument("--merge-segments", action="store_true",
+        help="join forward moves continuing each other in the same direction, width and color into single segments")
+    arg_parser.add_argument("--optimize", action="store_true",
+        help="strip symbols whose transforms do nothing from the generations where they can't draw anymore, "
+            "and skip zero-length segments (not with --hashcons)")
+    arg_parser.add_argument("--level", action="append", default=[], metavar="FILE[:MIN_SEGMENT[:PRECISION[:SCALE]]]",
+        help="also write a level of detail to FILE in the same turtle walk; may be given several times")
+    arg_parser.add_argument("--renderer", choices=RENDERER_BACKENDS, default=None,
+        help="renderer backend, only its modules are imported (default: svg, svg-stream with --pipeline)")
+    arg_parser.add_argument("--dry-run", action="store_true",
+        help="parse and expand the L-system, but don't render it")
+    arg_parser.add_argument("--import-profile", metavar="FILE", default=None,
+        help="write the time spent on startup imports and the modules loaded by the run to a JSON file")
+    arg_parser.add_argument("--seeds", default=None, metavar="SEEDS",
+        help="expand and render these seeds together, eg. '1,2,10-20', and print their metrics; "
+            "files are written if the output file name contains '{seed}'")
+    arg_parser.add_argument("--progress", type=float, nargs="?", const=1.0, default=None, metavar="SECONDS",
+        help="print the progress of expansion and rendering to stderr every SECONDS (default: 1); "
+            "not with --animate, --pipeline, --seeds, --parallel or --hashcons")
+    arg_parser.add_argument("--timeout", type=float, default=None, metavar="SECONDS",
+        help="stop expansion and rendering once they took this long in total; "
+            "not with --animate, --pipeline, --seeds, --parallel or --hashcons")
+    args = arg_parser.parse_args(argv)
+    if args.hashcons:
+        # hash-consed instances don't spill or run compiled code, and shared geometry
+        # is recorded with the float turtle
+        unsupported = [("--optimize", args.optimize), ("--lattice", args.lattice), ("--compile", args.compile != None),
+            ("--spill-threshold", args.spill_threshold != None), ("--spill-dir", args.spill_dir != None)]
+        for option, given in unsupported:
+            if given:
+                arg_parser.error(f"{option} can't be combined with --hashcons")
+    if args.pipeline and args.max_branch_depth != None:
+        arg_parser.error("--max-branch-depth can't be combined with --pipeline")
+    if args.progress != None or args.timeout != None:
+        # these paths don't check a cancellation token or report progress
+        untracked = [("--animate", args.animate), ("--pipeline", args.pipeline), ("--seeds", args.seeds != None),
+            ("--parallel", args.parallel is not None), ("--hashcons", args.hashcons)]
+        for option, given in untracked:
+            if given:
+                arg_parser.error(f"{'--progress' if args.progress != None else '--timeout'} can't be combined with {option}")
+    return args
+
 
-    parser = Parser()
-    print(f"Parsing source file '{file_name}'...", end="")
+def parse_level(text: str):
+    """ Parses FILE[:MIN_SEGMENT[:PRECISION[:SCALE]]] into a DetailLevel, empty fields
+        keep their default """
+    from lsys.detail_levels import DetailLevel
+    fields = text.split(":")
+    if len(fields) > 4:
+        raise ValueError(f"Invalid level of detail '{text}'")
+    level = DetailLevel(fields[0])
+    if len(fields) > 1 and fields[1] != "":
+        level.min_segment = float(fields[1])
+    if len(fields) > 2 and fields[2] != "":
+        level.precision = int(fields[2])
+    if len(fields) > 3 and fields[3] != "":
+        level.scale = float(fields[3])
+    return level
+
+
+def make_renderer(args, default_backend: str):
+    """ Renderer selected by --renderer, or the multi-resolution renderer if levels of
+        detail are given """
+    if len(args.level) > 0:
+        from lsys.detail_levels import DetailLevel, LSystemMultiResolutionRenderer
+        return LSystemMultiResolutionRenderer([DetailLevel(args.out_file_name)] + [parse_level(level) for level in args.level])
+    return create_renderer(args.renderer or default_backend, args.out_file_name)
+
+
+def animate(args, instance):
+    from lsys.animation import LSystemAnimator
+    file_pattern = args.out_file_name
+    if "{" not in file_pattern:
+        stem, extension = os.path.splitext(file_pattern)
+        file_pattern = stem + "_{frame:04d}" + (extension or ".svg")
+
+    print(f"Rendering animation frames to '{file_pattern}'...", end="")
     timer_start()
-    ast = parser.parse(read_file(file_name))
+    animator = LSystemAnimator(file_pattern, frames_per_generation=args.frames_per_generation)
+    file_names = animator.render(instance, args.iterations)
     print(f" ({timer_stop()})")
-    # print("Parsing successful!")
-    # print("Printing abstract syntax tree (AST):\n")
-    # pprint(ast)
+    print(f"All done, {len(file_names)} frame(s) written.")
+
 
-    print("Building L-system specification...", end="")
+def pipeline_render(args, instance):
+    from lsys.pipeline import LSystemPipeline
+    print(f"Expanding and rendering to file '{args.out_file_name}'...", end="")
     timer_start()
-    spec = LSystemSpecification.create(ast)
+    renderer = make_renderer(args, "svg-stream")
+    renderer.merge_segments = args.merge_segments
+    renderer.drop_zero_length = args.optimize
+    if args.optimize:
+        from lsys.optimizer import SpecOptimization
+        instance.optimization = SpecOptimization(instance.spec, instance.ctx)
+    pipeline = LSystemPipeline()
+    pipeline.run(instance, renderer, args.iterations, lattice=args.lattice)
     print(f" ({timer_stop()})")
-    # print("Printing L-system specification object:\n")
-    # pprint(spec)
+    stats = pipeline.stats
+    print(f"Pipeline: {stats['symbols']} symbols in {stats['chunks']} chunks, {stats['batches']} segment batches, "
+        f"stages {'overlapped' if stats['overlapped'] else 'sequential (random transforms)'}")
+    print("All done.")
+    print("Complexity rating:", renderer._complexity_rating)
+    print("Line Count:", renderer._line_count)
+    if len(args.level) > 0:
+        for level, segments in zip(renderer.levels, renderer.level_segments):
+            print(f"Level '{level.stream}': {segments} segments")
+
+
+def render_seeds(args, spec: LSystemSpecification):
+    from lsys.seed_batch import LSystemSeedBatch
+    seeds = parse_int_list(args.seeds)
+    print(f"Expanding {len(seeds)} seeds in lockstep...", end="")
+    timer_start()
+    seed_batch = LSystemSeedBatch(spec, seeds)
+    seed_batch.iterate(args.iterations)
+    print(f" ({timer_stop()})")
+
+    make_renderer = None
+    if "{seed" in args.out_file_name:
+        make_renderer = lambda seed: create_renderer(args.renderer or "svg", args.out_file_name.format(seed=seed))
+        print(f"Rendering to files '{args.out_file_name}'...", end="")
+    else:
+        print("Rendering metrics only (the output file name has no '{seed}' pattern)...", end="")
+    timer_start()
+    metrics = seed_batch.render(make_renderer, lattice=args.lattice)
+    print(f" ({timer_stop()})")
+    print(f"{'seed':>8} {'iterations':>10} {'symbols':>10} {'lines':>8} {'complexity':>10} {'width':>9} {'height':>9}")
+    for i, seed in enumerate(metrics.seeds):
+        print(f"{seed:>8} {metrics.iterations[i]:>10} {metrics.symbols[i]:>10} {metrics.line_count[i]:>8} {metrics.complexity_rating[i]:>10} "
+            f"{metrics.max_x[i] - metrics.min_x[i]:>9.2f} {metrics.max_y[i] - metrics.min_y[i]:>9.2f}")
+    print("All done.")
+
+
+def evaluation_counting(instrumentation):
+    return instrumentation.counting_evaluations() if instrumentation != None else contextlib.nullcontext()
+
+
+def write_profile(args, instrumentation):
+    if args.profile != None:
+        instrumentation.write_json(args.profile)
+    if args.trace != None:
+        instrumentation.write_chrome_trace(args.trace)
+    rule_hits = sum(instrumentation.rule_hits.values())
+    transforms = sum(instrumentation.transform_applications.values())
+    print(f"Profile: {rule_hits} rule hits, {instrumentation.bias_evaluations} bias evaluations, "
+        f"{transforms} transform applications, {instrumentation.expression_evaluations} expression evaluations")
+
+
+def print_progress(progress: Progress):
+    line = f"[{progress.elapsed:.1f}s] {progress.stage} generation {progress.generation}/{progress.generations}"
+    if progress.fraction != None:
+        line += f", {progress.symbols}/{progress.total_symbols} symbols ({progress.fraction:.0%})"
+    if progress.stage == "render":
+        line += f", {progress.segments} segments"
+    if progress.done:
+        line += ", done"
+    print(line, file=sys.stderr)
+
+
+def import_profile() -> dict:
+    """ Time spent on the startup imports of main.py, and the modules loaded so far:
+        those of lsys, and the top-level ones outside of the standard library """
+    top_level = sorted(set(name.split(".")[0] for name in sys.modules))
+    return {
+        "import_time": _import_time,
+        "modules": len(sys.modules),
+        "lsys_modules": sorted(name for name in sys.modules if name.startswith("lsys.")),
+        "third_party": [name for name in top_level if name not in sys.stdlib_module_names and not name.startswith("_")
+            and name not in ("lsys", "main", "common")],
+    }
+
+
+def write_import_profile(file_name: str):
+    import json
+    profile = import_profile()
+    with open(file_name, "w") as file:
+        json.dump(profile, file, indent=2)
+    print(f"Import profile: {profile['import_time'] * 1000.0:.1f}ms startup imports, {profile['modules']} modules loaded, "
+        f"third party: {', '.join(profile['third_party']) or 'none'}")
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    try:
+        run(args)
+    except Cancelled as e:
+        print(f"\n{e}", file=sys.stderr)
+        sys.exit(1)
+    if args.import_profile != None:
+        write_import_profile(args.import_profile)
+
+
+def run(args):
+    file_name = args.file_name
+    out_file_name = args.out_file_name
+    instrumentation = None
+    if args.profile != None or args.trace != None:
+        from lsys.instrumentation import Instrumentation
+        instrumentation = Instrumentation()
+
+    if args.watch:
+        from lsys.watch import LSystemWatcher
+        print(f"Watching '{file_name}', press Ctrl+C to stop.")
+        try:
+            LSystemWatcher(file_name, out_file_name, seed=args.seed, iterations=args.iterations).run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    source = read_file(file_name)
+    spec = None
+    spec_cache = None
+    if args.spec_cache != None:
+        from lsys.spec_cache import SpecificationCache
+        spec_cache = SpecificationCache(args.spec_cache)
+        print("Loading L-system specification from cache...", end="")
+        timer_start()
+        spec = spec_cache.get(source)
+        print(f" ({timer_stop()}, {'hit' if spec != None else 'miss'})")
+
+    if spec == None:
+        parser = Parser()
+        parser.instrumentation = instrumentation
+        print(f"Parsing source file '{file_name}'...", end="")
+        timer_start()
+        ast = parser.parse(source)
+        print(f" ({timer_stop()})")
+        # print("Parsing successful!")
+        # print("Printing abstract syntax tree (AST):\n")
+        # pprint(ast)
+
+        print("Building L-system specification...", end="")
+        timer_start()
+        if instrumentation != None:
+            with instrumentation.span("spec"):
+                spec = LSystemSpecification.create(ast)
+        else:
+            spec = LSystemSpecification.create(ast)
+        print(f" ({timer_stop()})")
+        # print("Printing L-system specification object:\n")
+        # pprint(spec)
+
+        if spec_cache != None:
+            spec_cache.put(source, spec)
+
+    compiled = None
+    if args.compile != None:
+        from lsys.codegen import compile_specification
+        print("Compiling L-system specification...", end="")
+        timer_start()
+        compiled = compile_specification(spec, source, args.compile or None)
+        print(f" ({timer_stop()})")
+
+    if args.animate:
+        animate(args, LSystemInstance(spec, seed=args.seed))
+        return
+
+    if args.pipeline:
+        pipeline_render(args, LSystemInstance(spec, seed=args.seed))
+        return
+
+    if args.seeds != None:
+        render_seeds(args, spec)
+        return
+
+    # progress reports and the timeout cover the default expansion and render
+    tracking = {}
+    if args.progress != None:
+        tracking.update(progress=print_progress, progress_interval=args.progress)
+    if args.timeout != None:
+        tracking["cancel"] = CancellationToken()
+        tracking["cancel"].cancel_after(args.timeout)
 
     print("Generating L-system instance...", end="")
     timer_start()
-    instance = LSystemInstance(spec)
+    if args.hashcons:
+        from lsys.hashcons import HashConsedInstance, render_shared
+        instance = HashConsedInstance(spec, seed=args.seed)
+    else:
+        instance = LSystemInstance(spec, seed=args.seed, spill_threshold=args.spill_threshold, spill_directory=args.spill_dir,
+            index_brackets=args.max_branch_depth != None)
+        instance.compiled = compiled
+        if args.optimize:
+            from lsys.optimizer import SpecOptimization
+            instance.optimization = SpecOptimization(spec, instance.ctx)
+    instance.instrumentation = instrumentation
     # print(f"Axiom: {pformat(instance.l_string, compact=True)}")
-    instance.iterate()
+    with evaluation_counting(instrumentation):
+        instance.iterate(args.iterations, **tracking)
     # print(f"L-String after {instance._iteration_count} iterations:")
     # pprint(instance.l_string)
     print(f" ({timer_stop()})")
+    if instance.optimization != None:
+        no_op = ", ".join(sorted(instance.optimization.no_op)) or "none"
+        print(f"Optimization: no-op symbols {no_op}, {len(instance.l_string)} symbols left")
+    if args.hashcons:
+        stats = instance.dedup_stats()
+        print(f"Deduplication: {stats['symbols']} symbols in {stats['subtrees']} subtrees with {stats['stored_items']} items (ratio {stats['ratio']:.1f})")
+
+    if args.dry_run:
+        print(f"Dry run, {len(instance.l_string)} symbols not rendered.")
+        return
 
     print(f"Rendering to file '{out_file_name}'...", end="")
     timer_start()
-    # renderer = LSystemDebugPrintRenderer()
-    renderer = LSystemSVGRenderer(out_file_name)
-    renderer.render(instance)
+    renderer = make_renderer(args, "svg")
+    renderer.instrumentation = instrumentation
+    renderer.max_branch_depth = args.max_branch_depth
+    renderer.merge_segments = args.merge_segments
+    renderer.drop_zero_length = args.optimize
+    with evaluation_counting(instrumentation):
+        if args.parallel is not None:
+            from lsys.parallel import render_parallel
+            render_parallel(renderer, instance, processes=args.parallel or None, lattice=args.lattice)
+        elif args.hashcons:
+            shared = render_shared(renderer, instance)
+        else:
+            renderer.render(instance, lattice=args.lattice, **tracking)
     print(f" ({timer_stop()})")
     print("All done.")
+    if args.lattice:
+        print("Lattice turtle:", "used" if renderer.lattice_active else "not applicable")
+    if args.hashcons and args.parallel is None:
+        print("Shared subtree geometry:", "used" if shared else "not applicable")
     print("Complexity rating:", renderer._complexity_rating)
     print("Line Count:", renderer._line_count)
+    if len(args.level) > 0:
+        for level, segments in zip(renderer.levels, renderer.level_segments):
+            print(f"Level '{level.stream}': {segments} segments")
+    if instrumentation != None:
+        write_profile(args, instrumentation)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,456 @@
+import sys
+import os
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from lsys.parser import Parser
+from lsys.interpreter import LSystemSpecification
+from lsys.svg_renderer import LSystemSVGRenderer
+from lsys.result_cache import ResultCache
+from lsys.spec_cache import source_hash
+from lsys.progress import CancellationToken, Cancelled
+
+_MAX_SPECS_PER_WORKER = 128
+_MAX_FINISHED_JOBS = 1000
+_LATENCY_WINDOW = 1000
+
+_STATUS_TEXT = {
+    200: "OK", 202: "Accepted", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+############################
+# Worker process functions #
+############################
+
+# Warm state of a pool worker, set up by _init_worker
+_parser: Parser = None
+_specs: OrderedDict = None
+_result_cache: ResultCache = None
+
+
+def _init_worker(result_cache_mb: int):
+    global _parser, _specs, _result_cache
+    _parser = Parser()
+    _specs = OrderedDict()
+    _result_cache = ResultCache(result_cache_mb * 1024 * 1024)
+
+
+def _get_spec(source: str, key: str) -> LSystemSpecification:
+    spec = _specs.get(key)
+    if spec != None:
+        _specs.move_to_end(key)
+        return spec
+    spec = LSystemSpecification.create(_parser.parse(source))
+    _specs[key] = spec
+    if len(_specs) > _MAX_SPECS_PER_WORKER:
+        _specs.popitem(last=False)
+    return spec
+
+
+def _render_svg(instance, cancel: CancellationToken) -> tuple[str, int, int]:
+    renderer = LSystemSVGRenderer()
+    renderer.render(instance, cancel=cancel)
+    return renderer.svg_string, renderer._line_count, renderer._complexity_rating
+
+
+def render_job(source: str, seed, iterations, cancel_event=None, timeout: float = None) -> dict:
+    """ Renders a job inside a pool worker, using the worker's warm caches. Raises
+        Cancelled once cancel_event (shared with the server process) is set or the
+        timeout (in seconds) has passed """
+    start = time.perf_counter()
+    key = source_hash(source)
+    spec = _get_spec(source, key)
+    cancel = CancellationToken(cancel_event)
+    timer = cancel.cancel_after(timeout) if timeout != None else None
+    try:
+        svg, line_count, complexity_rating = _result_cache.render(spec, key, seed, iterations, ("svg",),
+            lambda instance: _render_svg(instance, cancel), cancel)
+    finally:
+        if timer != None:
+            timer.cancel()
+    return {
+        "svg": svg,
+        "line_count": line_count,
+        "complexity_rating": complexity_rating,
+        "render_time": time.perf_counter() - start,
+        "pid": os.getpid(),
+        "cache_stats": _result_cache.stats(),
+    }
+
+
+###############
+# HTTP server #
+###############
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class Job:
+    id: str
+    source: str
+    seed: int
+    iterations: int
+    timeout: float = None # seconds a worker may spend on the job
+    status: str = "queued" # queued, running, done, failed, cancelled
+    created: float = field(default_factory=time.monotonic)
+    started: float = None
+    finished: float = None
+    result: dict = None
+    error: str = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    cancel_event: object = None # shared with the worker while running
+
+
+    def info(self) -> dict:
+        info = {"id": self.id, "status": self.status, "seed": self.seed, "iterations": self.iterations, "timeout": self.timeout}
+        if self.error != None:
+            info["error"] = self.error
+        if self.result != None:
+            info["line_count"] = self.result["line_count"]
+            info["complexity_rating"] = self.result["complexity_rating"]
+        if self.finished != None:
+            info["latency"] = self.finished - self.created
+        return info
+
+
+class RenderServer:
+    """ Long-running render service. Requests are queued in a bounded job queue (a full
+        queue is answered with 503) and handed to a process pool by one dispatcher task
+        per worker process. Each worker keeps its parsed specifications and a result
+        cache warm between jobs.
+
+        Endpoints:
+            POST   /render      renders synchronously and returns the SVG document;
+                                closing the connection cancels the job
+            POST   /jobs        queues a job and returns its id
+            GET    /jobs/<id>   job status
+            GET    /jobs/<id>/svg  result of a finished job
+            DELETE /jobs/<id>   cancels a job
+            GET    /metrics     queue depth, job counters, latency percentiles, cache stats
+        Jobs are JSON objects with either 'source' or 'file', and optional 'seed',
+        'iterations' and 'timeout'. 'file' is a path relative to the grammar root, files
+        outside of it are refused, and without a grammar root only 'source' is accepted.
+
+        A running job is stopped at its next chunk boundary (see lsys.progress) when it
+        is cancelled, or when it has run for its 'timeout' in seconds, which is capped
+        by the job timeout of the server. Timed out jobs fail. """
+
+    def __init__(self, processes: int = None, queue_size: int = 64, result_cache_mb: int = 256, max_body_size: int = 4 * 1024 * 1024, grammar_root: str = None, job_timeout: float = None):
+        self._processes = processes or os.cpu_count() or 1
+        self._queue_size = queue_size
+        self._result_cache_mb = result_cache_mb
+        self._max_body_size = max_body_size
+        self._grammar_root = os.path.realpath(grammar_root) if grammar_root != None else None
+        self._job_timeout = job_timeout
+        self._jobs: dict[str, Job] = {}
+        self._finished: deque[str] = deque()
+        self._latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self._counters = {"accepted": 0, "rejected": 0, "done": 0, "failed": 0, "cancelled": 0}
+        self._running = 0
+        self._cache_stats: dict[int, dict] = {}
+
+
+    async def serve(self, host: str, port: int):
+        self._queue: asyncio.Queue[Job] = asyncio.Queue(self._queue_size)
+        self._executor = ProcessPoolExecutor(self._processes, initializer=_init_worker, initargs=(self._result_cache_mb,))
+        # cancellation events of running jobs live in a manager process, so the
+        # workers can see them being set
+        self._manager = multiprocessing.Manager()
+        dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self._processes)]
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} with {self._processes} worker process(es)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+            self._executor.shutdown(cancel_futures=True)
+            self._manager.shutdown()
+
+
+    ###############
+    # Job queue   #
+    ###############
+
+    def _submit(self, request: dict) -> Job:
+        source = request.get("source")
+        if source == None and "file" in request:
+            source = self._read_grammar(request["file"])
+        if type(source) != str:
+            raise HTTPError(400, "Expected 'source' or 'file'")
+
+        seed = self._integer(request, "seed")
+        iterations = self._integer(request, "iterations", 0)
+        job = Job(uuid.uuid4().hex, source, seed, iterations, self._timeout(request.get("timeout")))
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._counters["rejected"] += 1
+            raise HTTPError(503, "Job queue is full, try again later")
+        self._jobs[job.id] = job
+        self._counters["accepted"] += 1
+        return job
+
+
+    def _read_grammar(self, file_name) -> str:
+        """ Reads the file a job names, which must be inside the grammar root """
+        if self._grammar_root == None:
+            raise HTTPError(403, "The server has no grammar root, send the grammar as 'source'")
+        if type(file_name) != str:
+            raise HTTPError(400, "Expected 'file' to be a string")
+        # resolves '..' and symbolic links before checking the location
+        path = os.path.realpath(os.path.join(self._grammar_root, file_name))
+        if os.path.commonpath([self._grammar_root, path]) != self._grammar_root:
+            raise HTTPError(403, f"'{file_name}' is outside of the grammar root")
+        try:
+            with open(path) as file:
+                return file.read()
+        except OSError as e:
+            raise HTTPError(400, f"Can't read '{file_name}': {e.strerror}")
+
+
+    def _integer(self, request: dict, name: str, minimum: int = None) -> int:
+        """ Optional integer field of a request, at least minimum if given """
+        value = request.get(name)
+        if value == None:
+            return None
+        if type(value) != int or (minimum != None and value < minimum):
+            qualifier = "an integer" if minimum == None else f"an integer of at least {minimum}"
+            raise HTTPError(400, f"Expected '{name}' to be {qualifier}")
+        return value
+
+
+    def _timeout(self, timeout) -> float:
+        """ Timeout of a job, at most the job timeout of the server """
+        if timeout == None:
+            return self._job_timeout
+        if type(timeout) not in (int, float) or timeout <= 0:
+            raise HTTPError(400, "Expected 'timeout' to be a positive number of seconds")
+        return min(timeout, self._job_timeout) if self._job_timeout != None else timeout
+
+
+    def _cancel(self, job: Job):
+        if job.status in ("queued", "running"):
+            # stops the worker, the dispatcher waits for it to give up the job
+            if job.cancel_event != None:
+                job.cancel_event.set()
+            self._finish(job, "cancelled")
+
+
+    def _finish(self, job: Job, status: str, result: dict = None, error: str = None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = time.monotonic()
+        job.source = None
+        job.done.set()
+        self._counters[status] += 1
+        if status == "done":
+            self._latencies.append(job.finished - job.created)
+        self._finished.append(job.id)
+        while len(self._finished) > _MAX_FINISHED_JOBS:
+            self._jobs.pop(self._finished.popleft(), None)
+
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.status != "queued":
+                continue # cancelled while waiting
+
+            job.status = "running"
+            job.started = time.monotonic()
+            job.cancel_event = self._manager.Event()
+            self._running += 1
+            try:
+                result = await loop.run_in_executor(self._executor, render_job, job.source, job.seed, job.iterations, job.cancel_event, job.timeout)
+                self._cache_stats[result["pid"]] = result.pop("cache_stats")
+                if job.status == "running":
+                    self._finish(job, "done", result=result)
+            except Cancelled as e:
+                if job.status == "running":
+                    self._finish(job, "failed", error=f"Timed out after {job.timeout} seconds ({e})")
+            except Exception as e:
+                if job.status == "running":
+                    self._finish(job, "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                job.cancel_event = None
+                self._running -= 1
+
+
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            if len(latencies) == 0:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+        cache_totals = {}
+        for stats in self._cache_stats.values():
+            for key, value in stats.items():
+                cache_totals[key] = cache_totals.get(key, 0) + value
+
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue_size,
+            "running": self._running,
+            "processes": self._processes,
+            "jobs": dict(self._counters),
+            "latency": {
+                "samples": len(latencies),
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+            },
+            "cache": cache_totals,
+        }
+
+
+    ###############
+    # HTTP        #
+    ###############
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+                status, content_type, content = await self._route(method, path, body, reader)
+            except HTTPError as e:
+                status, content_type, content = e.status, "application/json", json.dumps({"error": str(e)})
+            except Exception as e:
+                status, content_type, content = 500, "application/json", json.dumps({"error": f"{type(e).__name__}: {e}"})
+            if status != None:
+                await self._write_response(writer, status, content_type, content)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        if length > self._max_body_size:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length > 0 else b""
+        return parts[0], parts[1], body
+
+
+    async def _write_response(self, writer: asyncio.StreamWriter, status: int, content_type: str, content: str):
+        data = content.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+
+    def _parse_json(self, body: bytes) -> dict:
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}")
+        if type(request) != dict:
+            raise HTTPError(400, "Expected a JSON object")
+        return request
+
+
+    def _get_job(self, job_id: str) -> Job:
+        job = self._jobs.get(job_id)
+        if job == None:
+            raise HTTPError(404, f"No job with id '{job_id}'")
+        return job
+
+
+    async def _route(self, method: str, path: str, body: bytes, reader: asyncio.StreamReader):
+        parts = [part for part in path.split("?")[0].split("/") if part != ""]
+
+        if parts == ["metrics"] and method == "GET":
+            return 200, "application/json", json.dumps(self.metrics(), indent=2)
+
+        if parts == ["render"] and method == "POST":
+            job = self._submit(self._parse_json(body))
+            # the client closing the connection cancels the job
+            disconnected = asyncio.create_task(reader.read(1))
+            done = asyncio.create_task(job.done.wait())
+            await asyncio.wait([disconnected, done], return_when=asyncio.FIRST_COMPLETED)
+            if not done.done():
+                done.cancel()
+                self._cancel(job)
+                return None, None, None
+            disconnected.cancel()
+            if job.status != "done":
+                raise HTTPError(500 if job.status == "failed" else 409, job.error or f"Job {job.status}")
+            return 200, "image/svg+xml", job.result["svg"]
+
+        if parts == ["jobs"] and method == "POST":
+            job = self._submit(self._parse_json(body))
+            return 202, "application/json", json.dumps(job.info())
+
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = self._get_job(parts[1])
+            if len(parts) == 2 and method == "GET":
+                return 200, "application/json", json.dumps(job.info())
+            if len(parts) == 2 and method == "DELETE":
+                self._cancel(job)
+                return 200, "application/json", json.dumps(job.info())
+            if parts[2:] == ["svg"] and method == "GET":
+                if job.status != "done":
+                    raise HTTPError(409, f"Job is {job.status}")
+                return 200, "image/svg+xml", job.result["svg"]
+
+        raise HTTPError(404, f"Unknown endpoint '{method} {path}'")
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Local L-system render server")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--processes", type=int, default=None, help="worker processes (default: number of CPUs)")
+    arg_parser.add_argument("--queue-size", type=int, default=64, help="maximum number of queued jobs (default: 64)")
+    arg_parser.add_argument("--result-cache-size", type=int, default=256, metavar="MB",
+        help="size of the result cache of each worker (default: 256)")
+    arg_parser.add_argument("--grammar-root", default=None, metavar="DIR",
+        help="directory jobs can read grammar files from by 'file' (default: none, jobs must send 'source')")
+    arg_parser.add_argument("--job-timeout", type=float, default=None, metavar="SECONDS",
+        help="maximum time a worker spends on a job, also caps the 'timeout' of jobs (default: none)")
+    return arg_parser.parse_args(argv)
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    server = RenderServer(args.processes, args.queue_size, args.result_cache_size, grammar_root=args.grammar_root, job_timeout=args.job_timeout)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(len(sys.argv), sys.argv)
@@ -0,0 +1,95 @@
+import sys
+import os
+import argparse
+import glob
+import random
+import time
+from common import read_file
+from differential import GrammarGenerator
+from lsys.render_pool import RenderJob, RenderResult, render_job, render_many
+
+_TEST_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_files", "*.lsys")
+
+
+def _outcome(result: RenderResult) -> tuple:
+    """ Everything a render produces, compared between concurrent and sequential renders """
+    if result.error != None:
+        return ("error", f"{type(result.error).__name__}: {result.error}")
+    instance = result.instance
+    renderer = result.renderer
+    return (
+        instance._iteration_count,
+        len(instance.l_string),
+        instance.ctx.rng.getstate(),
+        renderer._line_count,
+        renderer._complexity_rating,
+        renderer.ops,
+    )
+
+
+def _describe(outcome: tuple) -> str:
+    if outcome[0] == "error":
+        return outcome[1]
+    return f"{outcome[0]} iterations, {outcome[1]} symbols, {outcome[3]} lines"
+
+
+def parse_args(argv):
+    arg_parser = argparse.ArgumentParser(description="Renders grammars concurrently with lsys.render_pool and checks every result against a sequential render of the same job")
+    arg_parser.add_argument("files", nargs="*", help="L-system source files (default: the test files)")
+    arg_parser.add_argument("--count", type=int, default=20, help="number of random grammars in addition to the files (default: 20)")
+    arg_parser.add_argument("--generator-seed", type=int, default=0, help="seed of the grammar generator (default: 0)")
+    arg_parser.add_argument("--seeds", default="1,2,3", help="seeds every grammar is expanded with (default: 1,2,3)")
+    arg_parser.add_argument("--repeat", type=int, default=4, help="concurrent renders of every job (default: 4)")
+    arg_parser.add_argument("--threads", type=int, default=8, help="worker threads (default: 8)")
+    arg_parser.add_argument("--switch-interval", type=float, default=1e-5, metavar="SECONDS",
+        help="thread switch interval while rendering concurrently, short intervals interleave the renders more (default: 1e-5)")
+    arg_parser.add_argument("--max-symbols", type=int, default=100000,
+        help="grammars whose sequential render expands to more symbols are left out (default: 100000)")
+    return arg_parser.parse_args(argv)
+
+
+def main(argc, argv):
+    args = parse_args(argv[1:argc])
+    seeds = [int(seed) for seed in args.seeds.split(",")]
+
+    sources = [(file_name, read_file(file_name)) for file_name in (args.files or sorted(glob.glob(_TEST_FILES)))]
+    generator = GrammarGenerator(random.Random(args.generator_seed))
+    sources += [(f"generated #{i}", generator.source()) for i in range(args.count)]
+
+    # sequential reference renders, every job parses its own specification
+    expected: dict[tuple, tuple] = {}
+    jobs: list[tuple[tuple, RenderJob]] = []
+    skipped = 0
+    for label, source in sources:
+        references = {seed: render_job(RenderJob(source, seed)) for seed in seeds}
+        if any(result.instance != None and len(result.instance.l_string) > args.max_symbols for result in references.values()):
+            skipped += 1
+            continue
+        for seed, result in references.items():
+            expected[(label, seed)] = _outcome(result)
+            jobs += [((label, seed), RenderJob(source, seed)) for _ in range(args.repeat)]
+
+    random.Random(args.generator_seed).shuffle(jobs)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(args.switch_interval)
+    start = time.perf_counter()
+    try:
+        results = render_many([job for _, job in jobs], args.threads)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    elapsed = time.perf_counter() - start
+
+    mismatches = 0
+    for (key, _), result in zip(jobs, results):
+        outcome = _outcome(result)
+        if outcome != expected[key]:
+            mismatches += 1
+            print(f"{key[0]} (seed {key[1]}): got {_describe(outcome)}, expected {_describe(expected[key])}")
+
+    print(f"{len(expected)} job(s) from {len(sources) - skipped} grammar(s) ({skipped} skipped), "
+        f"{len(jobs)} concurrent render(s) on {args.threads} thread(s) in {elapsed:.3f}s, {mismatches} mismatch(es)")
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(len(sys.argv), sys.argv))